@@ -1,5 +1,12 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_migrate
 
 
 class DataConfig(AppConfig):
     name = 'data'
+
+    def ready(self):
+        from . import search, spatial, visibility
+        post_migrate.connect(search.install_search_index, sender=self)
+        post_migrate.connect(spatial.install_spatial_index, sender=self)
+        post_migrate.connect(visibility.install_visibility_index, sender=self)
@@ -0,0 +1,365 @@
+"""
+In process prefix index for the autocompletion of the search box.
+
+Site names, institution acronyms and titles, variable names and long names and the keywords of public files are kept
+in one sorted array of normalized terms, a prefix is looked up with bisect. Every word of a label is a term of its
+own, so "temp" finds "air temperature". Suggestions are weighted by the number of current (neither old nor invalid)
+public files using them, like the catalog lists them. The best suggestions of the short prefixes are kept
+precomputed.
+
+Changes in this process update the index through signals once their transaction commits, rolled back changes leave it
+alone and other requests never suggest uncommitted data. Changes of other workers are noticed through the Generation
+counters, which are checked at most every FILE_AUTOCOMPLETE_CHECK_INTERVAL seconds and lead to a rebuild.
+"""
+import heapq
+import re
+import threading
+import time
+from bisect import bisect_left, insort
+from collections import Counter, namedtuple
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete, pre_save
+
+from .licences import licence_cache
+from .models import Generation, Institution, License, Site, UC2Observation, Variable
+
+Suggestion = namedtuple("Suggestion", ["kind", "value", "label"])
+
+SITE = "site"
+INSTITUTION = "institution"
+VARIABLE = "variable"
+KEYWORD = "keyword"
+KINDS = (SITE, INSTITUTION, VARIABLE, KEYWORD)
+GENERATION_KEYS = ("site", "institution", "variable", "file", "license")
+
+# prefixes up to this length have their best suggestions precomputed, they match too many terms to rank per request
+TOP_PREFIX_LENGTH = 2
+TOP_SIZE = 50
+MIN_KEYWORD_LENGTH = 2
+KEYWORD_SEPARATORS = re.compile(r"[\s,;]+")
+# observation fields counted by the index, saves changing none of them leave it alone
+COUNTED_FIELDS = ("site", "acronym", "keywords", "licence", "is_old", "is_invalid")
+
+
+def normalize(text):
+    return " ".join(text.casefold().split())
+
+
+def terms(label):
+    """
+    :return: the label and every part of it starting at a later word
+    """
+    words = normalize(label).split(" ")
+    return {" ".join(words[i:]) for i in range(len(words)) if words[i]}
+
+
+def keywords(text):
+    return {word for word in KEYWORD_SEPARATORS.split(text.casefold()) if len(word) >= MIN_KEYWORD_LENGTH}
+
+
+def prefix_end(prefix):
+    """
+    :return: the smallest string sorting after every string starting with prefix
+    """
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+class PrefixIndex:
+    """
+    Suggestions by entry key, e.g. ("site", pk) or ("keyword", word), their terms in a sorted array and their weights
+    """
+
+    def __init__(self):
+        self.entries = {}  # entry key -> Suggestion
+        self.entry_terms = {}  # entry key -> set of terms
+        self.keys = []  # sorted (term, entry key)
+        self.weights = Counter()  # entry key -> weight
+        self.top = {}  # prefix up to TOP_PREFIX_LENGTH -> entry keys, best first
+        self.pending = set()  # terms whose prefixes are ranked again by update_top
+
+    def put(self, key, suggestion, labels):
+        """
+        Add an entry without sorting, only while building, see finish
+        """
+        self.entries[key] = suggestion
+        self.entry_terms[key] = set().union(*(terms(label) for label in labels if label))
+        self.keys.extend((term, key) for term in self.entry_terms[key])
+
+    def finish(self):
+        self.keys.sort()
+        self.pending.update(term for term, key in self.keys)
+        self.update_top()
+
+    def add(self, key, suggestion, labels):
+        self.remove(key)
+        self.entries[key] = suggestion
+        self.entry_terms[key] = set().union(*(terms(label) for label in labels if label))
+        for term in self.entry_terms[key]:
+            insort(self.keys, (term, key))
+        self.pending.update(self.entry_terms[key])
+
+    def remove(self, key):
+        if key not in self.entries:
+            return
+        del self.entries[key]
+        removed = self.entry_terms.pop(key)
+        for term in removed:
+            i = bisect_left(self.keys, (term, key))
+            if i < len(self.keys) and self.keys[i] == (term, key):
+                del self.keys[i]
+        self.pending.update(removed)
+
+    def weigh(self, key, delta):
+        self.weights[key] += delta
+        if key in self.entries:
+            self.pending.update(self.entry_terms[key])
+
+    def matches(self, prefix):
+        """
+        :return: the entry keys with a term starting with prefix, with duplicates
+        """
+        lo = bisect_left(self.keys, (prefix,))
+        hi = bisect_left(self.keys, (prefix_end(prefix),), lo)
+        return (key for term, key in self.keys[lo:hi])
+
+    def ranked(self, keys, limit):
+        return heapq.nlargest(limit, set(keys), key=lambda key: (self.weights[key], self.entries[key].label))
+
+    def update_top(self):
+        """
+        Rank the short prefixes of the pending terms again, once per change of the index however many weights it moved
+        """
+        prefixes = {term[:n] for term in self.pending for n in range(1, TOP_PREFIX_LENGTH + 1)}
+        self.pending = set()
+        for prefix in prefixes:
+            self.top[prefix] = self.ranked(self.matches(prefix), TOP_SIZE)
+
+    def lookup(self, prefix, limit, kinds=KINDS):
+        """
+        :return: the keys of the limit best entries with a term starting with prefix
+        """
+        prefix = normalize(prefix)
+        if not prefix:
+            return []
+        best = self.top.get(prefix) if len(prefix) <= TOP_PREFIX_LENGTH else None
+        if best is not None:
+            selected = [key for key in best if key[0] in kinds][:limit]
+            # a short list holds every match
+            if len(selected) == limit or len(best) < TOP_SIZE:
+                return selected
+        return self.ranked((key for key in self.matches(prefix) if key[0] in kinds), limit)
+
+
+class Autocomplete:
+    """
+    The process wide PrefixIndex, built on first use
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._index = None
+        self._generation = None
+        self._checked = 0.0
+
+    def generation(self):
+        values = dict(Generation.objects.filter(key__in=GENERATION_KEYS).values_list("key", "value"))
+        return tuple(values.get(key, 0) for key in GENERATION_KEYS)
+
+    @staticmethod
+    def public_licences():
+        return {info.pk for info in licence_cache.all() if info.public}
+
+    def build(self):
+        index = PrefixIndex()
+        for pk, site, description in Site.objects.values_list("pk", "site", "description"):
+            index.put((SITE, pk), Suggestion(SITE, site, description or site), [site])
+        for pk, acronym, en_title, ge_title in Institution.objects.values_list("pk", "acronym", "en_title", "ge_title"):
+            index.put((INSTITUTION, pk), Suggestion(INSTITUTION, acronym, en_title), [acronym, en_title, ge_title])
+        for pk, variable, long_name in Variable.objects.values_list("pk", "variable", "long_name"):
+            index.put((VARIABLE, pk), Suggestion(VARIABLE, variable, long_name), [variable, long_name])
+
+        public = UC2Observation.objects.filter(
+            licence__in=self.public_licences(), is_old=False, is_invalid=False).order_by()
+        sites = dict(Site.objects.values_list("site", "pk"))
+        institutions = dict(Institution.objects.values_list("acronym", "pk"))
+        for site, count in public.values_list("site_id").annotate(count=Count("id")):
+            index.weights[(SITE, sites.get(site))] += count
+        for acronym, count in public.values_list("acronym_id").annotate(count=Count("id")):
+            index.weights[(INSTITUTION, institutions.get(acronym))] += count
+        for pk, count in public.filter(variables__isnull=False).values_list("variables").annotate(count=Count("id")):
+            index.weights[(VARIABLE, pk)] += count
+        words = Counter()
+        for text in public.values_list("keywords", flat=True).iterator():
+            words.update(keywords(text))
+        for word, count in words.items():
+            index.put((KEYWORD, word), Suggestion(KEYWORD, word, word), [word])
+            index.weights[(KEYWORD, word)] = count
+        index.finish()
+        return index
+
+    def index(self):
+        """
+        :return: the current index, rebuilt if another process changed the indexed tables
+        """
+        now = time.monotonic()
+        with self._lock:
+            if self._index is not None and now - self._checked < settings.FILE_AUTOCOMPLETE_CHECK_INTERVAL:
+                return self._index
+            generation = self.generation()
+            if generation != self._generation:
+                self._index = self.build()
+                self._generation = generation
+            self._checked = now
+            return self._index
+
+    def lookup(self, prefix, limit=10, kinds=KINDS):
+        """
+        :return: the limit best suggestions for prefix as dicts with kind, value, label and weight
+        """
+        index = self.index()
+        with self._lock:
+            return [dict(index.entries[key]._asdict(), weight=index.weights[key])
+                    for key in index.lookup(prefix, limit, kinds)]
+
+    def invalidate(self, *args, **kwargs):
+        with self._lock:
+            self._index = None
+            self._generation = None
+
+    def changed(self, apply):
+        """
+        Apply a change to the built index once the current transaction commits, nothing to do if it is rolled back or
+        the index is built later
+        """
+        def run():
+            with self._lock:
+                if self._index is not None:
+                    apply(self._index)
+                    self._index.update_top()
+        transaction.on_commit(run)
+
+    # signal receivers
+
+    def site_saved(self, sender, instance, *args, **kwargs):
+        self.changed(lambda index: index.add(
+            (SITE, instance.pk), Suggestion(SITE, instance.site, instance.description or instance.site),
+            [instance.site]))
+
+    def institution_saved(self, sender, instance, *args, **kwargs):
+        self.changed(lambda index: index.add(
+            (INSTITUTION, instance.pk), Suggestion(INSTITUTION, instance.acronym, instance.en_title),
+            [instance.acronym, instance.en_title, instance.ge_title]))
+
+    def variable_saved(self, sender, instance, *args, **kwargs):
+        self.changed(lambda index: index.add(
+            (VARIABLE, instance.pk), Suggestion(VARIABLE, instance.variable, instance.long_name),
+            [instance.variable, instance.long_name]))
+
+    def reference_deleted(self, sender, instance, *args, **kwargs):
+        kind = {Site: SITE, Institution: INSTITUTION, Variable: VARIABLE}[sender]
+        self.changed(lambda index: index.remove((kind, instance.pk)))
+
+    def is_counted(self, observation):
+        """
+        :param observation: the counted() fields of an observation
+        """
+        site_id, acronym_id, text, licence_id, is_old, is_invalid = observation
+        return licence_id in self.public_licences() and not is_old and not is_invalid
+
+    def observation_counts(self, index, observation, sign):
+        """
+        Add sign to the weights of everything a current public observation uses, but its variables
+        """
+        if not self.is_counted(observation):
+            return
+        site_id, acronym_id, text = observation[:3]
+        site = Site.objects.filter(site=site_id).values_list("pk", flat=True).first()
+        institution = Institution.objects.filter(acronym=acronym_id).values_list("pk", flat=True).first()
+        index.weigh((SITE, site), sign)
+        index.weigh((INSTITUTION, institution), sign)
+        for word in keywords(text):
+            key = (KEYWORD, word)
+            if key not in index.entries:
+                index.add(key, Suggestion(KEYWORD, word, word), [word])
+            index.weigh(key, sign)
+            if index.weights[key] <= 0:
+                index.remove(key)
+
+    @staticmethod
+    def counted(instance):
+        return (instance.site_id, instance.acronym_id, instance.keywords, instance.licence_id, instance.is_old,
+                instance.is_invalid)
+
+    def observation_saving(self, sender, instance, update_fields=None, raw=False, *args, **kwargs):
+        instance._autocomplete_counted = None
+        if raw or instance.pk is None or (update_fields and not set(update_fields) & set(COUNTED_FIELDS)):
+            return
+        if self._index is not None:
+            instance._autocomplete_counted = UC2Observation.objects.filter(pk=instance.pk).values_list(
+                "site_id", "acronym_id", "keywords", "licence_id", "is_old", "is_invalid").first()
+
+    def observation_saved(self, sender, instance, created, update_fields=None, raw=False, *args, **kwargs):
+        if raw or (update_fields and not set(update_fields) & set(COUNTED_FIELDS)):
+            return
+        old = getattr(instance, "_autocomplete_counted", None)
+        if not created and old is None:
+            return
+
+        counted = self.is_counted(self.counted(instance))
+        # variables count once the observation counts, so do variables added later
+        sign = counted - self.is_counted(old) if old is not None else 0
+        variables = list(instance.variables.values_list("pk", flat=True)) if sign and self._index is not None else []
+
+        def apply(index):
+            if old is not None:
+                self.observation_counts(index, old, -1)
+            self.observation_counts(index, self.counted(instance), 1)
+            for pk in variables:
+                index.weigh((VARIABLE, pk), sign)
+        self.changed(apply)
+
+    def observation_deleting(self, sender, instance, *args, **kwargs):
+        # the variables are gone once post_delete is sent
+        instance._autocomplete_variables = list(instance.variables.values_list("pk", flat=True)) \
+            if self._index is not None and self.is_counted(self.counted(instance)) else []
+
+    def observation_deleted(self, sender, instance, *args, **kwargs):
+        def apply(index):
+            self.observation_counts(index, self.counted(instance), -1)
+            for pk in getattr(instance, "_autocomplete_variables", []):
+                index.weigh((VARIABLE, pk), -1)
+        self.changed(apply)
+
+    def variables_changed(self, sender, instance, action, reverse, pk_set, *args, **kwargs):
+        if action == "pre_clear" or (action == "post_clear" and not reverse):
+            self.invalidate()  # the cleared variables are unknown after the fact
+            return
+        if action not in ("post_add", "post_remove") or not pk_set:
+            return
+        sign = 1 if action == "post_add" else -1
+        if reverse:
+            observations = UC2Observation.objects.filter(
+                pk__in=pk_set, licence__in=self.public_licences(), is_old=False, is_invalid=False).count()
+            self.changed(lambda index: index.weigh((VARIABLE, instance.pk), sign * observations))
+        elif self.is_counted(self.counted(instance)):
+            self.changed(lambda index: [index.weigh((VARIABLE, pk), sign) for pk in pk_set])
+
+
+autocomplete = Autocomplete()
+
+post_save.connect(autocomplete.site_saved, sender=Site, weak=False)
+post_save.connect(autocomplete.institution_saved, sender=Institution, weak=False)
+post_save.connect(autocomplete.variable_saved, sender=Variable, weak=False)
+for model in (Site, Institution, Variable):
+    post_delete.connect(autocomplete.reference_deleted, sender=model, weak=False)
+pre_save.connect(autocomplete.observation_saving, sender=UC2Observation, weak=False)
+post_save.connect(autocomplete.observation_saved, sender=UC2Observation, weak=False)
+pre_delete.connect(autocomplete.observation_deleting, sender=UC2Observation, weak=False)
+post_delete.connect(autocomplete.observation_deleted, sender=UC2Observation, weak=False)
+m2m_changed.connect(autocomplete.variables_changed, sender=UC2Observation.variables.through, weak=False)
+# a licence made public or private changes the counts of all its files
+post_save.connect(autocomplete.invalidate, sender=License, weak=False)
+post_delete.connect(autocomplete.invalidate, sender=License, weak=False)
@@ -0,0 +1,359 @@
+"""
+Synthetic catalogs and timings for the benchmark management command.
+
+Every scenario runs inside a transaction which is rolled back afterwards, so the database is left untouched.
+"""
+import random
+import statistics
+import time
+from datetime import timedelta
+
+from django.contrib.auth.models import AnonymousUser, Group, Permission
+from django.db import connection
+from django.db.models import Prefetch, Q
+from django.utils import timezone
+
+from guardian.utils import get_anonymous_user
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+
+from auth.models import User
+from .models import (Institution, License, Site, UC2Observation, UC2ObservationGroupObjectPermission,
+                     UC2ObservationUserObjectPermission, Variable)
+from .autocomplete import Autocomplete
+from .export import csv_chunks, ndjson_chunks
+from .facets import facet_counts
+from .rows import RowSerializer
+from .search import rebuild_search_documents, search
+from .serializers import UC2Serializer
+from .spatial import bbox_condition, filter_bbox
+from .streaming import gzipped
+from .visibility import guardian_observations, index_observations
+
+BATCH_SIZE = 5000
+
+
+class Catalog:
+    """
+    A synthetic catalog of n UC2Observations spread over a public and a restricted licence
+    """
+
+    def __init__(self, n, seed=0):
+        self.n = n
+        self.random = random.Random(seed)
+        permission = Permission.objects.get(codename="view_uc2observation", content_type__app_label="data")
+        self.public, created = License.objects.get_or_create(
+            short_name="bench open", defaults={"full_text": "bench open licence", "public": True,
+                                               "view_permission": permission})
+        self.restricted, created = License.objects.get_or_create(
+            short_name="bench restricted", defaults={"full_text": "bench restricted licence", "public": False,
+                                                     "view_permission": permission})
+        self.group = Group.objects.get(name="bench restricted")
+        self.restricted.view_groups.add(self.group)
+
+        self.institutions = [
+            Institution.objects.get_or_create(acronym="BENCH%s" % i, defaults={
+                "ge_title": "Bench Institut %s" % i, "en_title": "Bench institute %s" % i})[0]
+            for i in range(10)
+        ]
+        self.sites = [
+            Site.objects.get_or_create(site="benchsite%s" % i, defaults={
+                "location": "B", "description": "bench site %s" % i, "address": "Street %s" % i,
+                "campaign": Site.LTO})[0]
+            for i in range(20)
+        ]
+        self.variables = [
+            Variable.objects.create(variable="bvar%s" % i, long_name="bench variable %s" % i, units="1",
+                                    AMIP=False, deprecated=False)
+            for i in range(30)
+        ]
+        self.uploader, created = User.objects.get_or_create(username="bench", defaults={"email": "bench@localhost"})
+        self.member, created = User.objects.get_or_create(username="bench_member",
+                                                          defaults={"email": "member@localhost"})
+        self.member.groups.add(self.group, Group.objects.get_or_create(name="users")[0])
+        self.outsider, created = User.objects.get_or_create(username="bench_outsider",
+                                                            defaults={"email": "outsider@localhost"})
+        self.outsider.groups.add(Group.objects.get(name="users"))
+        self.fill()
+
+    def observation(self, i):
+        r = self.random
+        created = timezone.now() - timedelta(days=r.randint(0, 3000))
+        lon, lat = r.uniform(5, 15), r.uniform(47, 55)
+        width, height = r.uniform(0.001, 0.5), r.uniform(0.001, 0.5)
+        e, n = r.uniform(300000, 800000), r.uniform(5200000, 6100000)
+        return UC2Observation(
+            data_type="UC2",
+            file_standard_name="LTO-B-bench%s-BENCH-plev-20150401-%s-001.nc" % (i % 20, i),
+            file="bench/%s.nc" % i,
+            keywords="bench synthetic %s" % r.choice(["wind", "temperature", "humidity", "radiation"]),
+            uploader=self.uploader,
+            author="Author %s" % (i % 50),
+            source="source %s" % (i % 7),
+            institution="Bench institute %s" % (i % 10),
+            acronym=self.institutions[i % len(self.institutions)],
+            licence=self.public if i % 3 else self.restricted,
+            version=1,
+            is_old=r.random() < 0.3,
+            is_invalid=r.random() < 0.05,
+            featureType=r.choice(["timeSeries", "trajectory", "grid"]),
+            data_content=r.choice(["airtemp", "wind", "radiation", "humidity"]),
+            location="B",
+            site=self.sites[i % len(self.sites)],
+            origin_lon=lon, origin_lat=lat,
+            campaign=r.choice(["LTO", "IOP01", "IOP02"]),
+            creation_time=created, origin_time=created,
+            ll_lon=lon, ll_lat=lat, ur_lon=lon + width, ur_lat=lat + height, lat_lon_epsg="EPSG:4258",
+            ll_e_utm=e, ll_n_utm=n, ur_e_utm=e + width * 70000, ur_n_utm=n + height * 110000,
+            utm_epsg="EPSG:25833",
+            checkerVersionMajor=0, checkerVersionMinor=1, checkerVersionSub=0,
+        )
+
+    def fill(self):
+        permission = self.public.view_permission
+        anonymous = get_anonymous_user()
+        users_group = Group.objects.get(name="users")
+        through = UC2Observation.variables.through
+
+        for start in range(0, self.n, BATCH_SIZE):
+            objs = UC2Observation.objects.bulk_create(
+                [self.observation(i) for i in range(start, min(start + BATCH_SIZE, self.n))]
+            )
+            if objs and objs[0].pk is None:  # backends without RETURNING
+                objs = list(UC2Observation.objects.filter(
+                    file_standard_name__in=[o.file_standard_name for o in objs]))
+            links, group_perms, user_perms = [], [], []
+            for obj in objs:
+                for variable in self.random.sample(self.variables, 3):
+                    links.append(through(uc2observation_id=obj.pk, variable_id=variable.pk))
+                # the same permissions FileView.create assigns
+                if obj.licence_id == self.public.pk:
+                    user_perms.append(UC2ObservationUserObjectPermission(
+                        permission=permission, user=anonymous, content_object_id=obj.pk))
+                    group_perms.append(UC2ObservationGroupObjectPermission(
+                        permission=permission, group=users_group, content_object_id=obj.pk))
+                else:
+                    group_perms.append(UC2ObservationGroupObjectPermission(
+                        permission=permission, group=self.group, content_object_id=obj.pk))
+            through.objects.bulk_create(links)
+            UC2ObservationGroupObjectPermission.objects.bulk_create(group_perms)
+            UC2ObservationUserObjectPermission.objects.bulk_create(user_perms)
+            # bulk_create sends no signals
+            rebuild_search_documents(UC2Observation.objects.filter(pk__in=[obj.pk for obj in objs]))
+
+        # planner statistics as a production database would have them
+        with connection.cursor() as cursor:
+            cursor.execute("ANALYZE")
+
+    @property
+    def users(self):
+        return [("anonymous", AnonymousUser()), ("member", self.member), ("outsider", self.outsider)]
+
+
+# UC2Filter parameters of the list queries the frontend sends, checked by the explain_queries command
+CANONICAL_QUERIES = [
+    ("current files", {"is_old": "false", "is_invalid": "false"}),
+    ("data content", {"data_content": "wind"}),
+    ("current data content", {"data_content": "wind", "is_old": "false", "is_invalid": "false"}),
+    ("campaign", {"campaign": "IOP01"}),
+    ("feature type", {"featureType": "grid"}),
+    ("author", {"author": "Author 7"}),
+    ("source", {"source": "source 3"}),
+    ("institution", {"institution": "Bench institute 3"}),
+    ("acronyms", {"acronym": "BENCH1,bench2,BENCH3"}),
+    ("sites", {"site": "benchsite1,benchsite7"}),
+    ("variables", {"variables__variable": "bvar1,bvar2"}),
+    ("creation time", {"creation_time_after": "2019-01-01", "creation_time_before": "2019-02-01"}),
+    ("origin time", {"origin_time_after": "2019-01-01", "origin_time_before": "2019-02-01"}),
+]
+
+
+def measure(func, repeat=5):
+    """
+    :return: median and best wall time of func in milliseconds
+    """
+    timings = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings), min(timings)
+
+
+def bench_visibility(catalog, repeat):
+    """
+    First list page (100 rows) and total count of the visible files, guardian against the licence index
+    """
+    rows = []
+    for name, user in catalog.users:
+        for label, queryset in [("guardian", guardian_observations), ("index", index_observations)]:
+            rows.append((
+                "%s / %s page" % (name, label),
+                measure(lambda: list(queryset(user).order_by("-upload_date", "id")[:100]), repeat),
+            ))
+            rows.append(("%s / %s count" % (name, label), measure(lambda: queryset(user).count(), repeat)))
+    return rows
+
+
+LEGACY_SEARCH_FIELDS = [
+    "site__site", "site__address", "acronym__ge_title", "acronym__en_title", "acronym__acronym",
+    "variables__variable", "variables__long_name", "variables__standard_name",
+    "file_standard_name", "keywords", "author", "source", "data_content",
+]
+
+
+def legacy_search(queryset, term):
+    """
+    What DRF's SearchFilter did with FileView.search_fields before the search document existed
+    """
+    condition = Q()
+    for field in LEGACY_SEARCH_FIELDS:
+        condition |= Q(**{field + "__icontains": term})
+    return queryset.filter(condition).distinct()
+
+
+def bench_search(catalog, repeat):
+    """
+    First page (100 rows) and count of a search, icontains over 13 joined columns against the search document index
+    """
+    rows = []
+    for term in ["benchsite7", "humidity", "bvar12", "Author 42"]:
+        for label, func in [("icontains", legacy_search), ("full text", lambda qs, t: search(qs, [t]))]:
+            rows.append(("%s / %s page" % (term, label),
+                         measure(lambda: list(func(UC2Observation.objects.all(), term)[:100]), repeat)))
+            rows.append(("%s / %s count" % (term, label),
+                         measure(lambda: func(UC2Observation.objects.all(), term).count(), repeat)))
+    return rows
+
+
+def bench_bbox(catalog, repeat):
+    """
+    Viewports of different sizes over the catalog area, column comparison against the spatial index
+    """
+    rows = []
+    viewports = [
+        ("city", (13.2, 52.3, 13.6, 52.7), False),
+        ("region", (8, 48, 11, 51), False),
+        ("country", (5, 47, 15, 55), False),
+        ("utm district", (390000, 5800000, 410000, 5820000), True),
+    ]
+    for name, box, utm in viewports:
+        for within in (False, True):
+            relation = "within" if within else "intersects"
+            rows.append(("%s %s / columns" % (name, relation), measure(
+                lambda: list(UC2Observation.objects.filter(bbox_condition(box, within, utm))[:100]), repeat)))
+            rows.append(("%s %s / index" % (name, relation), measure(
+                lambda: list(filter_bbox(UC2Observation.objects.all(), box, within, utm)[:100]), repeat)))
+            rows.append(("%s %s / columns count" % (name, relation), measure(
+                lambda: UC2Observation.objects.filter(bbox_condition(box, within, utm)).count(), repeat)))
+            rows.append(("%s %s / index count" % (name, relation), measure(
+                lambda: filter_bbox(UC2Observation.objects.all(), box, within, utm).count(), repeat)))
+    return rows
+
+
+def bench_pagination(catalog, repeat):
+    """
+    Page N of the visible files of a licence group member, limit / offset against keyset
+    """
+    rows = []
+    page_size = 100
+    ordered = index_observations(catalog.member).order_by("-upload_date", "-id")
+    for page in [1, 10, 100, 1000]:
+        offset = (page - 1) * page_size
+        if offset >= catalog.n:
+            break
+        rows.append(("page %s / offset" % page,
+                     measure(lambda: list(ordered[offset:offset + page_size]), repeat)))
+        if offset:
+            last = ordered[offset - 1]
+            keyset = ordered.filter(Q(upload_date__lt=last.upload_date) | Q(id__lt=last.pk),
+                                    upload_date__lte=last.upload_date)
+        else:
+            keyset = ordered
+        rows.append(("page %s / keyset" % page, measure(lambda: list(keyset[:page_size + 1]), repeat)))
+    return rows
+
+
+def bench_facets(catalog, repeat):
+    """
+    All facet counts of the visible files, unfiltered and filtered, as computed on a cache miss
+    """
+    rows = []
+    for name, user in catalog.users:
+        rows.append(("%s / all files" % name, measure(lambda: facet_counts(index_observations(user)), repeat)))
+        rows.append(("%s / campaign IOP01" % name, measure(
+            lambda: facet_counts(index_observations(user).filter(campaign="IOP01")), repeat)))
+        rows.append(("%s / search humidity" % name, measure(
+            lambda: facet_counts(search(index_observations(user), ["humidity"], rank=False)), repeat)))
+    return rows
+
+
+def bench_serialization(catalog, repeat):
+    """
+    Rendering list pages through the serializers against the values() rows of RowSerializer, rows/s in the labels
+    """
+    request = Request(APIRequestFactory().get("/data/file/", HTTP_HOST="localhost"))
+    rows = []
+    for page_size in [100, 1000, 5000]:
+        page = index_observations(catalog.member).order_by("-upload_date", "-id")[:page_size]
+        slow = lambda: UC2Serializer(  # noqa: E731
+            page.select_related("site", "acronym", "licence", "uploader").prefetch_related(
+                Prefetch("variables", queryset=Variable.objects.only("id", "variable").order_by("id"))),
+            many=True, context={"request": request}).data
+        fast_serializer = RowSerializer(UC2Serializer(context={"request": request}))
+        fast = lambda: fast_serializer.render(fast_serializer.values(page))  # noqa: E731
+        for label, func in [("serializer", slow), ("values rows", fast)]:
+            median, best = measure(func, repeat)
+            rows.append(("%s rows / %s (%d rows/s)" % (page_size, label, page_size / median * 1000), (median, best)))
+    return rows
+
+
+def bench_export(catalog, repeat):
+    """
+    Streamed export of every file the member sees, rows/s in the labels
+    """
+    request = Request(APIRequestFactory().get("/data/file/export/", HTTP_HOST="localhost"))
+    rows = RowSerializer(UC2Serializer(context={"request": request}))
+    queryset = rows.values(index_observations(catalog.member).order_by("id"))
+    count = queryset.count()
+    results = []
+    for label, chunks in [
+        ("ndjson", lambda: ndjson_chunks(rows, queryset)),
+        ("csv", lambda: csv_chunks(rows, queryset)),
+        ("ndjson gzip", lambda: gzipped(ndjson_chunks(rows, queryset))),
+    ]:
+        median, best = measure(lambda: sum(len(chunk) for chunk in chunks()), repeat)
+        results.append(("%s rows / %s (%d rows/s)" % (count, label, count / median * 1000), (median, best)))
+    return results
+
+
+def bench_autocomplete(catalog, repeat):
+    """
+    Suggestions for prefixes of different lengths, istartswith queries against the prefix index, and its build
+    """
+    index = Autocomplete()
+    rows = [("build index", measure(index.build, repeat))]
+    index.index()
+
+    def queried(prefix):
+        return (list(Site.objects.filter(site__istartswith=prefix)[:10])
+                + list(Institution.objects.filter(Q(acronym__istartswith=prefix) | Q(en_title__istartswith=prefix)
+                                                  | Q(ge_title__istartswith=prefix))[:10])
+                + list(Variable.objects.filter(Q(variable__istartswith=prefix)
+                                               | Q(long_name__istartswith=prefix))[:10]))
+    for prefix in ["b", "be", "bench", "bvar1", "hum"]:
+        rows.append(("%s / queries" % prefix, measure(lambda: queried(prefix), repeat)))
+        rows.append(("%s / index" % prefix, measure(lambda: index.lookup(prefix), repeat)))
+    return rows
+
+
+SCENARIOS = {
+    "autocomplete": bench_autocomplete,
+    "bbox": bench_bbox,
+    "export": bench_export,
+    "facets": bench_facets,
+    "pagination": bench_pagination,
+    "search": bench_search,
+    "serialization": bench_serialization,
+    "visibility": bench_visibility,
+}
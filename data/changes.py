@@ -0,0 +1,99 @@
+"""
+Change feed of the file catalog for mirrors.
+
+Every creation, update (including is_old, is_invalid and download counts) and deletion of a UC2Observation is
+logged as a FileChange with an increasing seq. A counted download replaces the earlier updates of its file in the log,
+so popular files do not flood it. A mirror lists the catalog once, remembers the last seq and from then
+on reads only the changes after it, see FileView.changes. Changes of a page are merged per file, only the last one is
+returned together with the current entry.
+
+A seq is only visible once all smaller ones are committed, see FileChange, so no change is skipped by moving on. A
+file moved to another licence is deleted for the readers of the old licence and created for those of the new one. A
+"reset" tells that the groups of a licence changed, the mirror lists the catalog again and continues after it. So it
+does when it asks for changes older than FILE_CHANGES_RETENTION days, they are pruned and answered with 410 Gone.
+"""
+from collections import OrderedDict
+
+from django.db.models import Max, Q
+from rest_framework.exceptions import ValidationError
+from rest_framework.utils.urls import replace_query_param
+
+from .models import FileChange
+from .visibility import visible_licences
+
+SINCE_PARAM = "since"
+LIMIT_PARAM = "limit"
+DEFAULT_LIMIT = 1000
+MAX_LIMIT = 10000
+# changes returned with the current entry
+ENTRY_ACTIONS = (FileChange.CREATED, FileChange.UPDATED)
+
+
+class ChangesPruned(Exception):
+    """
+    Raised for a since older than the retained changes
+    """
+    detail = "Changes after this seq were pruned, list the catalog again and continue after last_seq"
+
+    def __init__(self, last_seq):
+        super().__init__(self.detail)
+        self.last_seq = last_seq
+
+
+def non_negative(request, name, default):
+    value = request.query_params.get(name, default)
+    try:
+        value = int(value)
+        if value < 0:
+            raise ValueError
+    except (TypeError, ValueError):
+        raise ValidationError({name: ["A non negative integer is required"]})
+    return value
+
+
+def changes_page(request):
+    """
+    :return: the last change per file after ?since= visible to the user, oldest first, the seq to continue after and
+        whether more changes follow
+    """
+    since = non_negative(request, SINCE_PARAM, 0)
+    limit = min(non_negative(request, LIMIT_PARAM, DEFAULT_LIMIT), MAX_LIMIT) or DEFAULT_LIMIT
+
+    if since < FileChange.pruned():
+        last_seq = FileChange.objects.aggregate(last_seq=Max("seq"))["last_seq"] or 0
+        raise ChangesPruned(last_seq)
+
+    changes = FileChange.objects.filter(seq__gt=since).order_by("seq")
+    licences = visible_licences(request.user)
+    if licences is not None:
+        changes = changes.filter(Q(licence_id__in=licences) | Q(licence_id__isnull=True))
+    page = list(changes.values("seq", "observation_id", "action", "changed")[:limit + 1])
+    more = len(page) > limit
+    page = page[:limit]
+
+    last = OrderedDict()
+    for change in page:
+        last.pop(change["observation_id"], None)
+        last[change["observation_id"]] = change
+    return list(last.values()), page[-1]["seq"] if page else since, more
+
+
+def feed_response_data(request, changes, last_seq, more, entries):
+    """
+    :param entries: id -> current entry of the created and updated files in changes
+    """
+    url = replace_query_param(request.build_absolute_uri(), SINCE_PARAM, last_seq)
+    return OrderedDict([
+        ("last_seq", last_seq),
+        ("next", url if more else None),
+        ("changes", [
+            OrderedDict([
+                ("seq", change["seq"]),
+                ("action", change["action"]),
+                ("id", change["observation_id"]),
+                ("changed", change["changed"]),
+                ("entry", entries.get(change["observation_id"]) if change["action"] in ENTRY_ACTIONS else None),
+            ])
+            for change in changes
+        ]),
+    ])
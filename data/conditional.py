@@ -0,0 +1,69 @@
+import calendar
+import hashlib
+
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+
+from .models import Generation
+
+
+def timestamp(value):
+    if value is None:
+        return None
+    return calendar.timegm(value.utctimetuple())
+
+
+def weak_etag(*parts):
+    digest = hashlib.sha1("|".join(str(p) for p in parts).encode('utf-8')).hexdigest()
+    return "W/" + quote_etag(digest)
+
+
+def generation_state(keys):
+    """
+    :return: the values of the generations keys joined by "." and the time the newest of them changed, in one query
+    """
+    rows = list(Generation.objects.filter(key__in=keys).values_list("key", "value", "changed"))
+    values = {key: value for key, value, changed in rows}
+    changed = max((changed for key, value, changed in rows), default=None)
+    return ".".join(str(values.get(key, 0)) for key in keys), changed
+
+
+def not_modified(request, etag=None, last_modified=None):
+    """
+    :return: a 304 response if the validators match the If-None-Match / If-Modified-Since headers, else None
+    """
+    return get_conditional_response(request, etag=etag, last_modified=timestamp(last_modified))
+
+
+def set_validators(response, etag=None, last_modified=None):
+    if etag:
+        response["ETag"] = etag
+    if last_modified:
+        response["Last-Modified"] = http_date(timestamp(last_modified))
+    return response
+
+
+class ConditionalListMixin:
+    """
+    Answers list requests with 304 Not Modified before the queryset is evaluated if the client copy is current.
+
+    By default the validators come from the Generation counter named by generation_key. Views with cheaper or
+    more precise validators override list_validators.
+    """
+    generation_key = None
+
+    def list_validators(self, request):
+        """
+        :return: etag, last_modified
+        """
+        generation = Generation.current(self.generation_key)
+        etag = weak_etag(self.generation_key, generation.value, request.GET.urlencode())
+        return etag, generation.changed
+
+    def list(self, request, *args, **kwargs):
+        etag, last_modified = self.list_validators(request)
+        response = not_modified(request, etag=etag, last_modified=last_modified)
+        if response is not None:
+            return response
+        response = super().list(request, *args, **kwargs)
+        return set_validators(response, etag=etag, last_modified=last_modified)
@@ -0,0 +1,67 @@
+"""
+Total counts of file lists without counting on every request.
+
+Counts are cached per filter signature and visibility class. The key contains the 'file' and 'license' Generations, so
+uploads, deletions and licence changes start new keys at once, anything else is picked up after FILE_COUNT_TIMEOUT
+seconds.
+"""
+import hashlib
+import json
+from urllib.parse import urlencode
+
+from django.conf import settings
+from django.db import connection
+
+from .conditional import generation_state
+from .singleflight import SingleFlight
+from .visibility import visibility_class
+
+# tables deciding which files a caller counts
+GENERATION_KEYS = ("file", "license")
+# parameters selecting a page, not the rows
+PAGINATION_PARAMS = {"limit", "offset", "cursor", "pagination", "count", "stream"}
+
+# in the cache of the list pages, shared by the workers if DMS_LIST_CACHE is set
+count_flight = SingleFlight("count", settings.FILE_LIST_CACHE)
+
+
+def filter_signature(request, ignored=PAGINATION_PARAMS):
+    """
+    :return: a hash of the query parameters which select the rows, independent of their order
+    """
+    items = sorted((key, value) for key, values in request.GET.lists() if key not in ignored for value in values)
+    return hashlib.md5(urlencode(items).encode()).hexdigest()
+
+
+def cache_key(prefix, request):
+    return "%s:%s:%s:%s" % (
+        prefix, generation_state(GENERATION_KEYS)[0], visibility_class(request.user), filter_signature(request)
+    )
+
+
+def planner_estimate(queryset):
+    """
+    :return: the number of rows the PostgreSQL planner expects for queryset
+    """
+    sql, params = queryset.query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute("EXPLAIN (FORMAT JSON) " + sql, params)
+        plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]["Plan"]["Plan Rows"])
+
+
+def estimated_count(queryset, request):
+    """
+    The cached count of queryset. On a cache miss large results on PostgreSQL are estimated by the planner, everything
+    else is counted, once for concurrent requests.
+    :return: the count and whether it was counted rather than estimated
+    """
+    def count():
+        if connection.vendor == "postgresql":
+            estimate = planner_estimate(queryset.order_by())
+            if estimate >= settings.FILE_COUNT_ESTIMATE_THRESHOLD:
+                return estimate, False
+        return queryset.count(), True
+    return count_flight.cached(cache_key("file-count-exact", request), count, settings.FILE_COUNT_TIMEOUT)
@@ -0,0 +1,56 @@
+"""
+Export of the catalog metadata as NDJSON or CSV.
+
+The rows are read from a server side cursor and rendered chunk by chunk through a RowSerializer, so memory stays the
+same for any number of rows. Optionally the stream is gzip compressed on the fly.
+"""
+import csv
+import io
+
+from django.http import StreamingHttpResponse
+
+from .rows import STREAM_CHUNK_SIZE
+from .streaming import buffered, dumps, gzipped
+
+KINDS = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+# separates the values of many to many columns in CSV cells
+CSV_LIST_SEPARATOR = " "
+
+
+def ndjson_chunks(rows, queryset, chunk_size=STREAM_CHUNK_SIZE):
+    for chunk in rows.chunks(queryset, chunk_size):
+        yield b"".join(dumps(item) + b"\n" for item in rows.render(chunk))
+
+
+def csv_chunks(rows, queryset, chunk_size=STREAM_CHUNK_SIZE):
+    keys = [key for key, lookup, converter in rows.columns]
+    many = [key for key, lookup, converter in rows.columns if lookup is None]
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(keys)
+    for chunk in rows.chunks(queryset, chunk_size):
+        for item in rows.render(chunk):
+            for key in many:
+                item[key] = CSV_LIST_SEPARATOR.join(str(value) for value in item[key])
+            # the csv module writes None as an empty cell
+            writer.writerow([item[key] for key in keys])
+        yield buffer.getvalue().encode("utf-8")
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():  # the header of an empty export
+        yield buffer.getvalue().encode("utf-8")
+
+
+def export_response(rows, queryset, kind, compress=False):
+    """
+    :param rows: the RowSerializer of the exported columns
+    :param queryset: the values() rows to export
+    """
+    chunks = ndjson_chunks(rows, queryset) if kind == "ndjson" else csv_chunks(rows, queryset)
+    filename = "catalog." + kind
+    if compress:
+        chunks = gzipped(chunks)
+        filename += ".gz"
+    response = StreamingHttpResponse(buffered(chunks), content_type="application/gzip" if compress else KINDS[kind])
+    response["Content-Disposition"] = "attachment; filename=%s" % filename
+    return response
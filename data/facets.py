@@ -0,0 +1,83 @@
+"""
+Counts per value of the catalog's filter facets, for the filter sidebars of the frontend.
+
+The facets are counted with three grouped queries over the filtered, visible files. Results are cached per filter
+signature and visibility class in the FILE_LIST_CACHE; the 'file' Generation in the key drops them on uploads and
+deletions. Concurrent misses of one key are counted once, across the workers if that cache is shared, see
+singleflight.py.
+"""
+import datetime
+from collections import Counter, OrderedDict
+
+from django.conf import settings
+from django.db.models import Count, Max, Min, Q
+from django.utils import timezone
+
+from .counts import cache_key
+from .models import UC2Observation
+from .singleflight import SingleFlight
+
+# facet name and the grouped column, the foreign keys to_field values are the acronym and site names
+FIELD_FACETS = [
+    ("institution", "acronym_id"),
+    ("site", "site_id"),
+    ("campaign", "campaign"),
+    ("featureType", "featureType"),
+    ("data_content", "data_content"),
+]
+
+facet_flight = SingleFlight("facets", settings.FILE_LIST_CACHE)
+
+
+def facet_counts(queryset):
+    """
+    :return: facet name -> list of {"value", "count"}, most frequent values first, years in order
+    """
+    queryset = queryset.order_by()
+    # one scan grouped by all columns, the few combinations are summed up per facet here
+    counters = [Counter() for facet in FIELD_FACETS]
+    fields = [field for name, field in FIELD_FACETS]
+    for row in queryset.values_list(*fields).annotate(count=Count("id")):
+        for counter, value in zip(counters, row):
+            counter[value] += row[-1]
+
+    facets = OrderedDict()
+    for (name, field), counter in zip(FIELD_FACETS, counters):
+        values = sorted(counter.items(), key=lambda item: (-item[1], item[0]))
+        facets[name] = [{"value": value, "count": count} for value, count in values]
+
+    # grouped over the join and not in a subquery, the search and bbox filters refer to the observation table by name
+    rows = queryset.filter(variables__isnull=False).values("variables__variable").annotate(
+        count=Count("id")).order_by("-count", "variables__variable")
+    facets["variable"] = [{"value": row["variables__variable"], "count": row["count"]} for row in rows]
+
+    facets["year"] = year_counts(queryset)
+    return facets
+
+
+def year_counts(queryset):
+    """
+    Counts per year of creation_time, as one conditional count per year. Unlike grouping by the extracted year this
+    needs no date function per row, which SQLite evaluates in Python.
+    """
+    # the range of the whole table is read from the creation_time index
+    bounds = UC2Observation.objects.aggregate(first=Min("creation_time"), last=Max("creation_time"))
+    if bounds["first"] is None:
+        return []
+    first = timezone.localtime(bounds["first"]).year
+    last = timezone.localtime(bounds["last"]).year
+
+    def start(year):
+        return timezone.make_aware(datetime.datetime(year, 1, 1))
+
+    counts = queryset.aggregate(**{
+        str(year): Count("id", filter=Q(creation_time__gte=start(year), creation_time__lt=start(year + 1)))
+        for year in range(first, last + 1)
+    })
+    return [{"value": year, "count": counts[str(year)]} for year in range(first, last + 1) if counts[str(year)]]
+
+
+def cached_facet_counts(queryset, request):
+    return facet_flight.cached(
+        cache_key("file-facets", request), lambda: facet_counts(queryset), settings.FILE_FACETS_TIMEOUT
+    )
@@ -1,28 +1,101 @@
 import django_filters.rest_framework as drf_filter
-from data.models import UC2Observation, Variable
+from django.db import connection
+from django.db.models import Q
+from rest_framework.exceptions import ValidationError
+
+from data.models import Institution, UC2Observation, Variable
+from data.spatial import filter_bbox
 
 
 class ListFilter(drf_filter.BaseCSVFilter, drf_filter.CharFilter):
+    """
+    Comma separated values, all matched in one query with a single __in lookup
+    """
+
+    def normalize(self, values):
+        return sorted({v.strip() for v in values if v and v.strip()})
+
+    def lookup_values(self, values):
+        return values
+
+    def filter(self, qs, value):
+        values = self.normalize(value or [])
+        if not values:
+            return qs
+        return self.get_method(qs)(**{self.field_name + "__in": self.lookup_values(values)})
+
+
+class AcronymListFilter(ListFilter):
+    """
+    Each value matches the acronyms containing it, case insensitively. They are resolved in a subquery on the
+    institution table, the observations are then found through the acronym_id index without a join.
+    """
+
+    def lookup_values(self, values):
+        condition = Q()
+        for v in values:
+            condition |= Q(acronym__icontains=v)
+        return Institution.objects.filter(condition).values("acronym")
+
+    def filter(self, qs, value):
+        values = self.normalize(value or [])
+        if not values or self.exclude or connection.vendor != "sqlite":
+            return super().filter(qs, value)
+        # SQLite walks the upload_date index for the newest first order instead, which reads the whole table for
+        # rare acronyms. unlikely() marks the condition as selective, the matches are searched and sorted.
+        sql, params = self.lookup_values(values).query.sql_with_params()
+        return qs.extra(where=["unlikely({table}.acronym_id IN ({sql}))".format(
+            table=UC2Observation._meta.db_table, sql=sql)], params=params)
+
+
+class VariableListFilter(ListFilter):
+    """
+    Matches observations with any of the variables through a subquery, so no distinct is needed
+    """
+
+    def filter(self, qs, value):
+        values = self.normalize(value or [])
+        if not values:
+            return qs
+        through = UC2Observation.variables.through.objects.filter(**{"variable__%s__in" % self.field_name: values})
+        return self.get_method(qs)(pk__in=through.values("uc2observation_id"))
+
+
+class BBoxFilter(drf_filter.BaseCSVFilter, drf_filter.NumberFilter):
+    """
+    Filter by bounding rectangle, the value is west,south,east,north
+    """
+
+    def __init__(self, *args, within=False, utm=False, **kwargs):
+        self.within = within
+        self.utm = utm
+        super().__init__(*args, **kwargs)
+
     def filter(self, qs, value):
         if not value:
             return qs
-        base = None
-        for v in value:
-            if not base:
-                base = super().filter(qs, v)
-            else:
-                base.union(super().filter(qs, v))
-        return base
+        if len(value) != 4:
+            raise ValidationError({self.field_name: ["Expected west,south,east,north"]})
+        return filter_bbox(qs, [float(v) for v in value], within=self.within, utm=self.utm)
 
 
 class UC2Filter(drf_filter.FilterSet):
-    acronym = ListFilter(field_name="acronym__acronym", lookup_expr='icontains')
+    acronym = AcronymListFilter(field_name="acronym_id")
+    site = ListFilter(field_name="site_id")
+    campaign = ListFilter(field_name="campaign")
+    data_content = ListFilter(field_name="data_content")
+    variables__variable = VariableListFilter(field_name="variable")
 
     file_standard_name = drf_filter.CharFilter(field_name='file_standard_name', lookup_expr='icontains')
     upload_date = drf_filter.DateFromToRangeFilter()
     creation_time = drf_filter.DateFromToRangeFilter()
     origin_time = drf_filter.DateFromToRangeFilter()
 
+    bbox_intersects = BBoxFilter()
+    bbox_within = BBoxFilter(within=True)
+    utm_bbox_intersects = BBoxFilter(utm=True)
+    utm_bbox_within = BBoxFilter(within=True, utm=True)
+
     class Meta:
         model = UC2Observation
         fields = {
@@ -36,15 +109,12 @@ class UC2Filter(drf_filter.FilterSet):
             'is_old': ['exact'],
             'version': ['exact', 'gt', 'lt'],
             'featureType': ['exact'],
-            'data_content': ['exact'],
             'location': ['icontains'],
             'site__site': ['icontains'],
             'site__id': ['exact'],
             'origin_lon': ['exact'],
             'origin_lat': ['exact'],
-            'campaign': ['exact'],
             'variables__id': ['exact'],
-            'variables__variable': ['exact'],
             'variables__long_name': ['icontains'],
             'variables__standard_name': ['icontains'],
         }
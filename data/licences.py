@@ -0,0 +1,87 @@
+import threading
+import time
+from collections import namedtuple
+
+from django.contrib.auth.models import Group
+from django.db.models.signals import post_save, post_delete, m2m_changed
+
+from .models import Generation, License
+
+LicenceInfo = namedtuple(
+    "LicenceInfo", ["pk", "short_name", "full_text", "public", "view_permission", "view_groups"]
+)
+
+
+class LicenceCache:
+    """
+    Process wide copy of all licences with their view permission and groups.
+
+    Changes in this process drop the copy through signals. Changes made by other workers are noticed through the
+    shared 'license' Generation counter, which is checked at most every check_interval seconds.
+    """
+
+    def __init__(self, check_interval=1.0):
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._generation = None
+        self._checked = 0.0
+        self._by_short_name = {}
+        self._by_full_text = {}
+
+    def invalidate(self, *args, **kwargs):
+        with self._lock:
+            self._generation = None
+
+    def _current(self):
+        now = time.monotonic()
+        with self._lock:
+            if self._generation is not None and now - self._checked < self.check_interval:
+                return self._by_short_name, self._by_full_text
+        generation = Generation.current("license").value
+        with self._lock:
+            if generation != self._generation:
+                self._load(generation)
+            self._checked = now
+            return self._by_short_name, self._by_full_text
+
+    def _load(self, generation):
+        by_short_name = {}
+        for licence in License.objects.select_related("view_permission").prefetch_related("view_groups"):
+            by_short_name[licence.short_name] = LicenceInfo(
+                pk=licence.pk,
+                short_name=licence.short_name,
+                full_text=licence.full_text,
+                public=licence.public,
+                view_permission=licence.view_permission,
+                view_groups=tuple(licence.view_groups.all()),
+            )
+        self._by_short_name = by_short_name
+        self._by_full_text = {info.full_text: info for info in by_short_name.values()}
+        self._generation = generation
+
+    def all(self):
+        return list(self._current()[0].values())
+
+    def get(self, short_name=None, full_text=None):
+        """
+        Look a licence up like License.objects.get, raises License.DoesNotExist
+        """
+        by_short_name, by_full_text = self._current()
+        try:
+            if short_name is not None:
+                return by_short_name[short_name]
+            return by_full_text[full_text]
+        except KeyError:
+            raise License.DoesNotExist("No licence %s" % (short_name if short_name is not None else full_text))
+
+    def view_codenames(self):
+        return {info.view_permission.codename for info in self.all()}
+
+
+licence_cache = LicenceCache()
+
+post_save.connect(licence_cache.invalidate, sender=License, weak=False)
+post_delete.connect(licence_cache.invalidate, sender=License, weak=False)
+m2m_changed.connect(licence_cache.invalidate, sender=License.view_groups.through, weak=False)
+# deleting a group drops its view_groups rows without m2m_changed
+post_delete.connect(licence_cache.invalidate, sender=Group, weak=False)
@@ -0,0 +1,86 @@
+"""
+Batch lookup of files by id and file_standard_name, with signed download links.
+
+The ids and names are resolved in IN queries of at most FILE_LOOKUP_CHUNK_SIZE values under the visibility of the
+caller. A download link carries the signed id, content checksum and licence of the file, so it can be fetched
+without credentials until it expires after FILE_LINK_MAX_AGE seconds. A file invalidated, moved to another licence or
+changed since, or another file reusing the id, is not served.
+"""
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core import signing
+from django.urls import reverse
+from rest_framework.exceptions import NotFound, PermissionDenied
+
+from .models import StoredBlob, UC2Observation
+
+LINK_SALT = "data.file-download"
+
+
+def chunked(values, size):
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+def resolve(rows, queryset, lookup, values):
+    """
+    :param rows: RowSerializer of the entries
+    :param queryset: the visible files
+    :param lookup: the column matched against values
+    :return: value -> (id, rendered entry) for every value found
+    """
+    found = {}
+    for chunk in chunked(list(dict.fromkeys(values)), settings.FILE_LOOKUP_CHUNK_SIZE):
+        page = list(rows.values(queryset.filter(**{lookup + "__in": chunk}), (lookup,)))
+        for row, entry in zip(page, rows.render(page)):
+            found[row[lookup]] = (row[rows.pk_name], entry)
+    return found
+
+
+def lookup_files(rows, queryset, ids, names):
+    """
+    :return: the entries of the files found in the order asked for, without duplicates, and the ids and names not
+        found or not visible
+    """
+    by_id = resolve(rows, queryset, "id", ids)
+    by_name = resolve(rows, queryset, "file_standard_name", names)
+    results = OrderedDict()
+    for pk, entry in [by_id[value] for value in ids if value in by_id] + \
+            [by_name[value] for value in names if value in by_name]:
+        results.setdefault(pk, entry)
+    missing = OrderedDict([
+        ("ids", [value for value in dict.fromkeys(ids) if value not in by_id]),
+        ("file_standard_names", [value for value in dict.fromkeys(names) if value not in by_name]),
+    ])
+    return results, missing
+
+
+def download_links(request, pks):
+    """
+    :return: id -> signed download link of the files pks
+    """
+    links = {}
+    for chunk in chunked(list(pks), settings.FILE_LOOKUP_CHUNK_SIZE):
+        files = list(UC2Observation.objects.filter(pk__in=chunk).values_list("pk", "file", "licence_id"))
+        checksums = dict(StoredBlob.objects.filter(name__in=[name for pk, name, licence_id in files]).values_list(
+            "name", "checksum"))
+        for pk, name, licence_id in files:
+            token = signing.dumps([pk, checksums.get(name), licence_id], salt=LINK_SALT)
+            links[pk] = request.build_absolute_uri(reverse("file-download", kwargs={"token": token}))
+    return links
+
+
+def linked_file(token):
+    """
+    :return: the file signed in token, as it was when signed
+    """
+    try:
+        pk, checksum, licence_id = signing.loads(token, salt=LINK_SALT, max_age=settings.FILE_LINK_MAX_AGE)
+    except (signing.BadSignature, TypeError, ValueError):
+        raise PermissionDenied("Invalid or expired link")
+    obj = UC2Observation.objects.filter(pk=pk, licence_id=licence_id, is_invalid=False).first()
+    if obj is None or StoredBlob.objects.filter(name=obj.file.name).values_list(
+            "checksum", flat=True).first() != checksum:
+        raise NotFound("The file was changed or withdrawn since the link was signed")
+    return obj
@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from data.benchmarks import SCENARIOS, Catalog
+
+
+class Command(BaseCommand):
+    help = "Time catalog queries on a synthetic dataset. All generated rows are rolled back afterwards."
+
+    def add_arguments(self, parser):
+        parser.add_argument('scenarios', nargs='*', choices=sorted(SCENARIOS) + [[]], help="Default all scenarios")
+        parser.add_argument('--files', type=int, default=100000, help="Size of the synthetic catalog")
+        parser.add_argument('--repeat', type=int, default=5, help="Runs per measurement")
+
+    def handle(self, *args, **options):
+        scenarios = options['scenarios'] or sorted(SCENARIOS)
+        row = "{:<48} {:>12} {:>12}"
+
+        with transaction.atomic():
+            self.stdout.write("Creating %s synthetic files ..." % options['files'])
+            catalog = Catalog(options['files'])
+            for scenario in scenarios:
+                self.stdout.write("\n%s (%s files)" % (scenario, options['files']))
+                self.stdout.write(row.format("query", "median ms", "best ms"))
+                for label, (median, best) in SCENARIOS[scenario](catalog, options['repeat']):
+                    self.stdout.write(row.format(label, "%.2f" % median, "%.2f" % best))
+            transaction.set_rollback(True)
@@ -0,0 +1,49 @@
+from django.contrib.auth.models import AnonymousUser
+from django.core.management.base import BaseCommand, CommandError
+
+from guardian.conf import settings as guardian_settings
+
+from auth.models import User
+from data.visibility import guardian_observations, index_observations, rebuild_visibility_index
+
+
+class Command(BaseCommand):
+    help = "Compare the files visible through the licence visibility index with guardian's object permissions"
+
+    def add_arguments(self, parser):
+        parser.add_argument('usernames', nargs='*', help="Users to check, default all users and anonymous")
+        parser.add_argument('--repair', action='store_true',
+                            help="Rebuild the visibility index of every licence before comparing")
+
+    def handle(self, *args, **options):
+        if options['repair']:
+            self.stdout.write("Rebuilt the visibility index of %s licences" % rebuild_visibility_index())
+
+        if options['usernames']:
+            users = list(User.objects.filter(username__in=options['usernames']))
+        else:
+            # guardian's stand-in user for anonymous requests is checked as AnonymousUser
+            users = [AnonymousUser()] + list(
+                User.objects.filter(is_active=True).exclude(username=guardian_settings.ANONYMOUS_USER_NAME)
+            )
+
+        mismatches = 0
+        for user in users:
+            by_index = set(index_observations(user).values_list('id', flat=True))
+            by_guardian = set(guardian_observations(user).values_list('id', flat=True))
+            if by_index == by_guardian:
+                continue
+            mismatches += 1
+            self.stdout.write(
+                "%s: %s only visible by licence, %s only by object permission (e.g. %s)" % (
+                    user.username or "anonymous",
+                    len(by_index - by_guardian),
+                    len(by_guardian - by_index),
+                    sorted(by_index ^ by_guardian)[:5],
+                )
+            )
+
+        if mismatches:
+            # the index follows the licences, what is left after a repair are object permissions gone astray
+            raise CommandError("%s of %s users see different files" % (mismatches, len(users)))
+        self.stdout.write("Visibility of %s users matches" % len(users))
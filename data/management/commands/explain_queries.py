@@ -0,0 +1,82 @@
+import re
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.http import QueryDict
+
+from data.benchmarks import CANONICAL_QUERIES, Catalog
+from data.filters import UC2Filter
+from data.models import UC2Observation
+from data.visibility import index_observations
+
+TABLE = UC2Observation._meta.db_table
+# walking these covers only the rows of their condition
+PARTIAL_INDEXES = {index.name for index in UC2Observation._meta.indexes if index.condition is not None}
+# a walk over the whole table, in table or in index order
+FULL_SCAN = {
+    "sqlite": re.compile(r"\bSCAN (?:TABLE )?%s\b(?: USING (?:COVERING )?INDEX (\w+))?" % TABLE),
+    "postgresql": re.compile(r"\b(?:Seq Scan|Index (?:Only )?Scan(?: Backward)? using (\w+)) on %s\b" % TABLE),
+}
+
+
+def full_scans(vendor, plan):
+    """
+    :return: the lines of plan walking the whole table. Index scans with a bound (SEARCH on SQLite, an Index Cond on
+        PostgreSQL) and walks of a partial index pass.
+    """
+    lines = plan.splitlines()
+    scans = []
+    for i, line in enumerate(lines):
+        match = FULL_SCAN[vendor].search(line)
+        if match is None or match.group(1) in PARTIAL_INDEXES:
+            continue
+        if vendor == "postgresql" and match.group(1):
+            # the conditions of a node follow it up to the next node
+            details = []
+            for detail in lines[i + 1:]:
+                if "->" in detail:
+                    break
+                details.append(detail)
+            if any("Index Cond:" in detail for detail in details):
+                continue
+        scans.append(line.strip())
+    return scans
+
+
+class Command(BaseCommand):
+    help = "EXPLAIN the canonical file list queries on a synthetic dataset and fail if one walks the whole table, " \
+           "also in index order. All generated rows are rolled back afterwards."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--files', type=int, default=100000, help="Size of the synthetic catalog")
+        parser.add_argument('--plans', action='store_true', help="Print every plan")
+
+    def handle(self, *args, **options):
+        if connection.vendor not in FULL_SCAN:
+            raise CommandError("Plans of %s databases can not be checked" % connection.vendor)
+
+        failed = []
+        with transaction.atomic():
+            self.stdout.write("Creating %s synthetic files ..." % options['files'])
+            catalog = Catalog(options['files'])
+            for user_name, user in catalog.users:
+                for name, params in CANONICAL_QUERIES:
+                    query = QueryDict(mutable=True)
+                    query.update(params)
+                    queryset = UC2Filter(query, queryset=index_observations(user)).qs
+                    plan = queryset.order_by("-upload_date", "-id")[:100].explain()
+
+                    label = "%s / %s" % (name, user_name)
+                    scans = full_scans(connection.vendor, plan)
+                    if scans:
+                        failed.append(label)
+                        self.stdout.write("%-48s FULL SCAN" % label)
+                    else:
+                        self.stdout.write("%-48s ok" % label)
+                    if options['plans'] or scans:
+                        self.stdout.write("    " + plan.replace("\n", "\n    "))
+            transaction.set_rollback(True)
+
+        if failed:
+            raise CommandError("%s of %s queries walk all of %s" % (
+                len(failed), len(CANONICAL_QUERIES) * len(catalog.users), TABLE))
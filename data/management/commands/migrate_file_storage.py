@@ -0,0 +1,63 @@
+import os
+import shutil
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from data.models import StoredBlob, UC2Observation
+from data.storage import content_addressed_storage, file_digest, is_sharded_name, sharded_name
+
+
+class Command(BaseCommand):
+    help = "Move files stored under their upload name into the content addressed storage and rewrite the paths"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help="Only report what would be done")
+
+    def handle(self, *args, **options):
+        storage = content_addressed_storage
+        dry_run = options['dry_run']
+
+        legacy_names = list(
+            UC2Observation.objects.exclude(file='').order_by().values_list('file', flat=True).distinct()
+        )
+        moved = deduplicated = missing = 0
+
+        for name in legacy_names:
+            if is_sharded_name(name):
+                continue
+            legacy_path = storage.path(name)
+            if not os.path.exists(legacy_path):
+                self.stderr.write("Missing on disk: %s" % name)
+                missing += 1
+                continue
+
+            with open(legacy_path, 'rb') as f:
+                digest = file_digest(f)
+            target = sharded_name(digest, name)
+            if dry_run:
+                self.stdout.write("%s -> %s" % (name, target))
+                continue
+
+            with transaction.atomic():
+                blob, created = StoredBlob.objects.select_for_update().get_or_create(
+                    checksum=digest, defaults={'name': target, 'size': os.path.getsize(legacy_path)}
+                )
+                if not storage.exists(target):
+                    target_path = storage.path(target)
+                    os.makedirs(os.path.dirname(target_path), exist_ok=True)
+                    try:
+                        os.link(legacy_path, target_path)
+                    except OSError:
+                        shutil.copy2(legacy_path, target_path)
+                    moved += 1
+                else:
+                    deduplicated += 1
+                blob.ref_count += UC2Observation.objects.filter(file=name).update(file=target)
+                blob.save(update_fields=['ref_count'])
+            # the rows point to the new path now, the old name can go
+            os.remove(legacy_path)
+
+        self.stdout.write(
+            "Moved %s files, %s duplicates removed, %s missing" % (moved, deduplicated, missing)
+        )
@@ -0,0 +1,38 @@
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from guardian.models import GroupObjectPermission, UserObjectPermission
+
+from data.models import UC2Observation, UC2ObservationGroupObjectPermission, UC2ObservationUserObjectPermission
+
+BATCH_SIZE = 5000
+
+
+class Command(BaseCommand):
+    help = ("Move guardian's generic object permissions of UC2Observation into the direct foreign key tables. "
+            "Rows of deleted observations are dropped.")
+
+    def handle(self, *args, **options):
+        content_type = ContentType.objects.get_for_model(UC2Observation)
+        existing = set(UC2Observation.objects.values_list('pk', flat=True))
+
+        for generic, direct, owner in [(UserObjectPermission, UC2ObservationUserObjectPermission, 'user'),
+                                       (GroupObjectPermission, UC2ObservationGroupObjectPermission, 'group')]:
+            generic_rows = generic.objects.filter(content_type=content_type)
+            copied = dropped = 0
+            with transaction.atomic():
+                batch = []
+                for row in generic_rows.values('permission_id', owner + '_id', 'object_pk').iterator():
+                    pk = int(row['object_pk'])
+                    if pk not in existing:
+                        dropped += 1
+                        continue
+                    batch.append(direct(permission_id=row['permission_id'], content_object_id=pk,
+                                        **{owner + '_id': row[owner + '_id']}))
+                    if len(batch) >= BATCH_SIZE:
+                        copied += len(direct.objects.bulk_create(batch, ignore_conflicts=True))
+                        batch = []
+                copied += len(direct.objects.bulk_create(batch, ignore_conflicts=True))
+                generic_rows.delete()
+            self.stdout.write("%s permissions: %s moved, %s of deleted files dropped" % (owner, copied, dropped))
@@ -0,0 +1,33 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from data.models import FileChange, Generation
+
+
+class Command(BaseCommand):
+    help = "Remove old entries of the change feed, mirrors reading after them have to list the catalog again"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=settings.FILE_CHANGES_RETENTION,
+                            help="Keep the changes of this many days, defaults to FILE_CHANGES_RETENTION")
+
+    def handle(self, *args, **options):
+        older_than = timezone.now() - timedelta(days=options['days'])
+        with transaction.atomic():
+            # the lock of FileChange.log, its value is the last pruned seq
+            lock, created = Generation.objects.select_for_update().get_or_create(key=FileChange.LOCK)
+            pruned = FileChange.objects.filter(changed__lt=older_than)
+            last = pruned.order_by('-seq').values_list('seq', flat=True).first()
+            if last is None:
+                self.stdout.write("Nothing to prune")
+                return
+            # seqs are increasing, everything up to the newest old change goes
+            count, per_model = FileChange.objects.filter(seq__lte=last).delete()
+            lock.value = max(lock.value, last)
+            lock.changed = timezone.now()
+            lock.save()
+        self.stdout.write("Pruned %s changes up to seq %s" % (count, last))
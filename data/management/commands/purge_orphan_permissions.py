@@ -0,0 +1,35 @@
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import BaseCommand
+from django.db.models import CharField
+from django.db.models.functions import Cast
+
+from guardian.models import GroupObjectPermission, UserObjectPermission
+
+
+class Command(BaseCommand):
+    help = "Delete guardian's generic object permissions whose object no longer exists"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help="Only count the orphaned rows")
+
+    def handle(self, *args, **options):
+        for generic in [UserObjectPermission, GroupObjectPermission]:
+            content_type_ids = generic.objects.order_by().values_list('content_type', flat=True).distinct()
+            for content_type in ContentType.objects.filter(pk__in=list(content_type_ids)):
+                model = content_type.model_class()
+                if model is None:  # the model was removed, every row is an orphan
+                    orphans = generic.objects.filter(content_type=content_type)
+                else:
+                    existing = model._default_manager.annotate(
+                        pk_text=Cast('pk', output_field=CharField())
+                    ).values('pk_text')
+                    orphans = generic.objects.filter(content_type=content_type).exclude(object_pk__in=existing)
+
+                if options['dry_run']:
+                    count = orphans.count()
+                else:
+                    count = orphans.delete()[0]
+                if count:
+                    self.stdout.write("%s %s: %s orphaned rows%s" % (
+                        generic.__name__, content_type, count, "" if options['dry_run'] else " deleted"
+                    ))
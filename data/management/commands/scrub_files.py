@@ -0,0 +1,180 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from data import tiering
+from data.models import StoredBlob, UC2Observation
+from data.storage import HASH_CHUNK_SIZE, content_addressed_storage, is_sharded_name
+
+MISSING = "missing"
+CORRUPTED = "corrupted"
+ORPHANED = "orphaned"
+
+
+class RateLimiter:
+    """
+    Token bucket shared by all workers, limits the read throughput to bytes_per_second
+    """
+
+    def __init__(self, bytes_per_second):
+        self.rate = bytes_per_second
+        self.allowance = bytes_per_second
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, amount):
+        if not self.rate:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.allowance = min(self.rate, self.allowance + (now - self.last) * self.rate)
+            self.last = now
+            self.allowance -= amount
+            wait = -self.allowance / self.rate if self.allowance < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+
+class Command(BaseCommand):
+    help = "Verify the stored files against their recorded checksums and report missing, corrupted and orphaned files"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=2, help="Number of parallel readers")
+        parser.add_argument('--rate', type=float, default=20,
+                            help="Read limit in MB/s over all workers, 0 disables the limit")
+        parser.add_argument('--batch-size', type=int, default=100, help="Files verified between state saves")
+        parser.add_argument('--state-file', default=None,
+                            help="Progress file, defaults to .scrub_state.json in MEDIA_ROOT")
+        parser.add_argument('--restart', action='store_true', help="Ignore saved progress and start over")
+        parser.add_argument('--delete-orphans', action='store_true',
+                            help="Remove content addressed files without a StoredBlob, left by rolled back uploads")
+        parser.add_argument('--orphan-age', type=float, default=60,
+                            help="Minutes a file without StoredBlob must be old to be removed, younger ones may "
+                                 "belong to an upload still in progress")
+
+    def handle(self, *args, **options):
+        self.options = options
+        self.limiter = RateLimiter(options['rate'] * 1024 * 1024)
+        state_file = options['state_file'] or os.path.join(settings.MEDIA_ROOT, '.scrub_state.json')
+        state = {'last_pk': 0, 'checked': 0, 'problems': []}
+        if not options['restart'] and os.path.exists(state_file):
+            with open(state_file, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+            self.stdout.write("Resuming after blob %s" % state['last_pk'])
+
+        with ThreadPoolExecutor(max_workers=options['workers']) as pool:
+            while True:
+                batch = list(
+                    StoredBlob.objects.filter(pk__gt=state['last_pk']).order_by('pk')[:options['batch_size']]
+                )
+                if not batch:
+                    break
+                for problem in pool.map(self.verify, batch):
+                    if problem:
+                        state['problems'].append(problem)
+                state['last_pk'] = batch[-1].pk
+                state['checked'] += len(batch)
+                self._save_state(state_file, state)
+
+        problems = state['problems'] + self.unrecorded_missing() + self.orphans()
+        self.summary(state['checked'], problems)
+        # a complete run leaves no progress behind, the next run starts from the beginning
+        if os.path.exists(state_file):
+            os.remove(state_file)
+
+    def verify(self, blob):
+        if blob.tier == StoredBlob.COLD:
+            if not os.path.exists(blob.cold_path()):
+                return [MISSING, blob.name, "cold copy not found"]
+            chunks = tiering.open_stream(blob, chunk_size=HASH_CHUNK_SIZE)
+        else:
+            if not content_addressed_storage.exists(blob.name):
+                return [MISSING, blob.name, "not found in MEDIA_ROOT"]
+            chunks = self._read(content_addressed_storage.path(blob.name))
+
+        sha = hashlib.sha256()
+        try:
+            for chunk in chunks:
+                self.limiter.consume(len(chunk))
+                sha.update(chunk)
+        except tiering.READ_ERRORS as e:
+            return [CORRUPTED, blob.name, "read error: %s" % e]
+        if sha.hexdigest() != blob.checksum:
+            return [CORRUPTED, blob.name, "checksum mismatch"]
+        return None
+
+    @staticmethod
+    def _read(path):
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+                yield chunk
+
+    @staticmethod
+    def _save_state(state_file, state):
+        tmp = state_file + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(state, f)
+        os.replace(tmp, state_file)
+
+    def unrecorded_missing(self):
+        """
+        Files without a StoredBlob (not yet migrated) have no checksum, only their presence is checked
+        """
+        recorded = StoredBlob.objects.values('name')
+        names = UC2Observation.objects.exclude(file='').exclude(file__in=recorded).values_list('file', flat=True)
+        return [[MISSING, name, "no checksum recorded"] for name in names if not content_addressed_storage.exists(name)]
+
+    def orphans(self):
+        referenced = set(UC2Observation.objects.values_list('file', flat=True))
+        cold = {blob.cold_path() for blob in StoredBlob.objects.filter(tier=StoredBlob.COLD)}
+        blobs = set(StoredBlob.objects.values_list('name', flat=True))
+        # files written by uploads whose transaction rolled back have no StoredBlob
+        removable_before = time.time() - self.options['orphan_age'] * 60
+        problems = []
+
+        # the catalog snapshot may be written below MEDIA_ROOT, see data/snapshot.py
+        snapshot_root = getattr(settings, 'FILE_SNAPSHOT_ROOT', None)
+        skipped = {os.path.abspath(snapshot_root)} if snapshot_root else set()
+        for root, dirs, files in os.walk(settings.MEDIA_ROOT):
+            dirs[:] = [
+                d for d in dirs if not d.startswith('.') and os.path.abspath(os.path.join(root, d)) not in skipped
+            ]
+            for file_name in files:
+                if file_name.startswith('.'):
+                    continue
+                name = os.path.relpath(os.path.join(root, file_name), settings.MEDIA_ROOT).replace(os.sep, '/')
+                if name in referenced:
+                    continue
+                path = os.path.join(root, file_name)
+                if (self.options['delete_orphans'] and is_sharded_name(name) and name not in blobs
+                        and os.path.getmtime(path) < removable_before):
+                    os.remove(path)
+                    problems.append([ORPHANED, name, "no stored blob, removed"])
+                else:
+                    problems.append([ORPHANED, name, "not referenced by any observation"])
+
+        cold_root = getattr(settings, 'COLD_STORAGE_ROOT', None)
+        if cold_root and os.path.isdir(cold_root):
+            for root, dirs, files in os.walk(cold_root):
+                for file_name in files:
+                    path = os.path.join(root, file_name)
+                    if path not in cold:
+                        problems.append([ORPHANED, os.path.relpath(path, cold_root), "not a cold copy of any file"])
+        return problems
+
+    def summary(self, checked, problems):
+        row = "{:<10} {:<72} {}"
+        self.stdout.write(row.format("status", "file", "detail"))
+        for problem in sorted(problems):
+            self.stdout.write(row.format(*problem))
+        counts = {kind: sum(1 for p in problems if p[0] == kind) for kind in [MISSING, CORRUPTED, ORPHANED]}
+        self.stdout.write(
+            "Checked %s files: %s missing, %s corrupted, %s orphaned"
+            % (checked, counts[MISSING], counts[CORRUPTED], counts[ORPHANED])
+        )
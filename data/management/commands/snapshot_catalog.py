@@ -0,0 +1,27 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from data import snapshot
+
+
+class Command(BaseCommand):
+    help = "Write the snapshot of the public catalog, rendering only entries changed since the last one"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--base-url', default=settings.FILE_SNAPSHOT_BASE_URL,
+                            help="Start of the file links, defaults to DMS_BASE_URL")
+        parser.add_argument('--full', action='store_true', help="Render every entry again")
+
+    def handle(self, *args, **options):
+        if settings.FILE_SNAPSHOT_ROOT is None:
+            raise CommandError("FILE_SNAPSHOT_ROOT is not set")
+        if not options['base_url']:
+            raise CommandError("--base-url or DMS_BASE_URL is required")
+        if not snapshot.acquire_rebuild_lock():
+            raise CommandError("The snapshot is being rebuilt by another process")
+        try:
+            manifest = snapshot.build(options['base_url'], full=options['full'])
+        finally:
+            snapshot.release_rebuild_lock()
+        self.stdout.write("%(count)s entries, %(rendered)s rendered, in %(root)s" % dict(
+            manifest, root=settings.FILE_SNAPSHOT_ROOT))
@@ -0,0 +1,51 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from data import tiering
+from data.models import StoredBlob, UC2Observation
+
+
+class Command(BaseCommand):
+    help = "Move files of old or invalid observations to the compressed cold tier and report tier per file"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=90,
+                            help="Only move files of observations uploaded more than this many days ago")
+        parser.add_argument('--codec', choices=[StoredBlob.ZSTD, StoredBlob.GZIP], default=None,
+                            help="Compression, defaults to zstd if the zstandard package is installed else gzip")
+        parser.add_argument('--dry-run', action='store_true', help="Only list the files that would be moved")
+        parser.add_argument('--report', action='store_true', help="Only print tier and compression of every file")
+
+    def handle(self, *args, **options):
+        if options['codec'] == StoredBlob.ZSTD and not tiering.zstandard:
+            raise CommandError("zstd requires the zstandard package")
+
+        if not options['report']:
+            older_than = timezone.now() - timedelta(days=options['days'])
+            for blob in list(tiering.cold_candidates(older_than)):
+                if options['dry_run']:
+                    self.stdout.write("would move %s" % blob.name)
+                    continue
+                blob = tiering.move_to_cold(blob, codec=options['codec'])
+                self.stdout.write("moved %s (%.2fx)" % (blob.name, blob.compression_ratio))
+
+        if options['report'] or not options['dry_run']:
+            self.report()
+
+    def report(self):
+        blobs = {blob.name: blob for blob in StoredBlob.objects.all()}
+        row = "{:<64} {:<5} {:<5} {:>12} {:>12} {:>7}"
+        self.stdout.write(row.format("file", "tier", "codec", "size", "stored", "ratio"))
+        for name, file_standard_name in UC2Observation.objects.order_by('file_standard_name').values_list(
+                'file', 'file_standard_name'):
+            blob = blobs.get(name)
+            if blob is None:
+                self.stdout.write(row.format(file_standard_name, "-", "-", "-", "-", "-"))
+                continue
+            stored = blob.stored_size if blob.tier == StoredBlob.COLD else blob.size
+            self.stdout.write(row.format(
+                file_standard_name, blob.tier, blob.codec or "-", blob.size, stored,
+                "%.2f" % blob.compression_ratio
+            ))
@@ -1,9 +1,59 @@
 # models.py django python file
+import os
+
 from django.db import models
+from django.db.models import F
 from django.utils import timezone, dateformat
 from django.conf import settings
 from django.contrib.auth.models import Group, Permission
-from django.db.models.signals import post_save, pre_save
+from django.db import transaction
+from django.db.models.signals import post_save, pre_save, post_delete, m2m_changed
+
+from guardian.models import GroupObjectPermissionBase, UserObjectPermissionBase
+
+from .storage import content_addressed_storage
+
+
+class Generation(models.Model):
+    """
+    Change counter shared by all workers. Signals bump the counter of a table whenever it changes, so cached data
+    and validators (ETag / Last-Modified) of that table can be checked with one cheap query.
+    """
+    key = models.CharField(max_length=64, primary_key=True)
+    value = models.BigIntegerField(default=0)
+    changed = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return "%s: %s" % (self.key, self.value)
+
+    @staticmethod
+    def bump(key):
+        if not Generation.objects.filter(key=key).update(value=F('value') + 1, changed=timezone.now()):
+            Generation.objects.get_or_create(key=key, defaults={'value': 1})
+
+    @staticmethod
+    def current(key):
+        """
+        :return: the generation object of key, unsaved with value 0 and changed None if the table never changed
+        """
+        try:
+            return Generation.objects.get(key=key)
+        except Generation.DoesNotExist:
+            return Generation(key=key, changed=None)
+
+    @staticmethod
+    def bump_on_change(key, ignored_fields=()):
+        """
+        Signal receiver which bumps the generation key
+        :param ignored_fields: saves updating only these fields are no change
+        """
+        def receiver(sender, *args, **kwargs):
+            update_fields = kwargs.get('update_fields')
+            if update_fields and set(update_fields) <= set(ignored_fields):
+                return
+            if kwargs.get('action', 'post_').startswith('post_'):  # m2m_changed fires before and after
+                Generation.bump(key)
+        return receiver
 
 
 class License(models.Model):
@@ -25,6 +75,59 @@ class License(models.Model):
 pre_save.connect(License.pre_create, sender=License)
 
 
+class LicenceVisibility(models.Model):
+    """
+    Who can see files of a licence. Mirrors the permissions FileView.create assigns with guardian: public licences
+    are visible for anonymous users and the 'users' group, the others for their view_groups.
+    Kept in sync with License by signals, so listing files needs a plain indexed join instead of guardian's
+    generic object permission tables.
+    """
+
+    @staticmethod
+    def rebuild(licence):
+        LicenceVisibility.objects.filter(licence=licence).delete()
+        if licence.public:
+            default_gr, created = Group.objects.get_or_create(name='users')
+            rows = [LicenceVisibility(licence=licence, anonymous=True),
+                    LicenceVisibility(licence=licence, group=default_gr)]
+        else:
+            rows = [LicenceVisibility(licence=licence, group=gr) for gr in licence.view_groups.all()]
+        LicenceVisibility.objects.bulk_create(rows)
+
+    @staticmethod
+    def post_licence_save(sender, instance, *args, **kwargs):
+        LicenceVisibility.rebuild(instance)
+
+    @staticmethod
+    def view_groups_changed(sender, instance, action, reverse, pk_set, *args, **kwargs):
+        if not action.startswith('post_'):
+            return
+        if not reverse:
+            LicenceVisibility.rebuild(instance)
+            return
+        # changed from the group side, pk_set holds licences. It is None after a clear.
+        if pk_set is None:
+            licences = License.objects.filter(visibility__group=instance).distinct()
+        else:
+            licences = License.objects.filter(pk__in=pk_set)
+        for licence in list(licences):
+            LicenceVisibility.rebuild(licence)
+
+    licence = models.ForeignKey(License, on_delete=models.CASCADE, related_name='visibility')
+    group = models.ForeignKey(Group, null=True, blank=True, on_delete=models.CASCADE)
+    anonymous = models.BooleanField(default=False)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['group', 'licence']),
+            models.Index(fields=['anonymous', 'licence']),
+        ]
+
+
+post_save.connect(LicenceVisibility.post_licence_save, sender=License)
+m2m_changed.connect(LicenceVisibility.view_groups_changed, sender=License.view_groups.through)
+
+
 class InstitutionManager(models.Manager):
     def get_by_natural_key(self, acronym=None):
         return self.get(acronym=acronym)
@@ -51,10 +154,60 @@ class Institution(models.Model):
 post_save.connect(Institution.post_create, sender=Institution)
 
 
+class StoredBlob(models.Model):
+    """
+    One file on disk in the content addressed storage. ref_count counts the DataFile rows pointing to it.
+    """
+    HOT = 'hot'
+    COLD = 'cold'
+    ZSTD = 'zstd'
+    GZIP = 'gzip'
+    CODEC_EXTENSIONS = {
+        ZSTD: '.zst',
+        GZIP: '.gz',
+    }
+
+    checksum = models.CharField(max_length=64, unique=True)  # sha256 hex digest
+    name = models.CharField(max_length=255, unique=True)  # storage path, derived from the checksum
+    size = models.BigIntegerField()
+    ref_count = models.PositiveIntegerField(default=0)
+    created = models.DateTimeField(auto_now_add=True)
+    tier = models.CharField(max_length=4, default=HOT, choices=[
+        (HOT, "uncompressed in MEDIA_ROOT"),
+        (COLD, "compressed in COLD_STORAGE_ROOT"),
+    ])
+    codec = models.CharField(max_length=8, blank=True, default='', choices=[(ZSTD, ZSTD), (GZIP, GZIP)])
+    stored_size = models.BigIntegerField(null=True, blank=True)  # size on disk in the cold tier
+
+    def __str__(self):
+        return self.name
+
+    @property
+    def compression_ratio(self):
+        if self.tier != StoredBlob.COLD or not self.stored_size:
+            return 1.0
+        return self.size / self.stored_size
+
+    def cold_path(self, codec=None):
+        return os.path.join(settings.COLD_STORAGE_ROOT, self.name + StoredBlob.CODEC_EXTENSIONS[codec or self.codec])
+
+    def remove_cold_copy(self):
+        if self.tier == StoredBlob.COLD and os.path.exists(self.cold_path()):
+            os.remove(self.cold_path())
+
+
 class DataFile(models.Model):
+
+    @staticmethod
+    def post_delete(sender, instance, *args, **kwargs):
+        # release the file only once the deletion is committed, a rollback would otherwise lose the content
+        name = instance.file.name
+        if name:
+            transaction.on_commit(lambda: instance.file.storage.release(name))
+
     data_type = models.CharField(max_length=200)
     file_standard_name = models.CharField(max_length=200, unique=True)
-    file = models.FileField()
+    file = models.FileField(storage=content_addressed_storage)
     keywords = models.CharField(max_length=200, blank=True, default='')
     uploader = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.DO_NOTHING)
     author = models.CharField(max_length=200)
@@ -65,6 +218,7 @@ class DataFile(models.Model):
     licence = models.ForeignKey(License, on_delete=models.PROTECT)
     version = models.PositiveIntegerField(default=1)
     upload_date = models.DateTimeField(auto_now_add=True)
+    last_modified = models.DateTimeField(auto_now=True)
     download_count = models.PositiveIntegerField(default=0)
     is_invalid = models.BooleanField(default=False)
     is_old = models.BooleanField(default=False)
@@ -130,6 +284,17 @@ class Site(models.Model):
 
 
 class UC2Observation(DataFile):
+
+    @staticmethod
+    def variables_changed(sender, instance, action, reverse, pk_set, *args, **kwargs):
+        # the variables are part of a listed entry, last_modified tells incremental copies which rows to refresh
+        if not action.startswith('post_'):
+            return
+        if not reverse:
+            UC2Observation.objects.filter(pk=instance.pk).update(last_modified=timezone.now())
+        elif pk_set:
+            UC2Observation.objects.filter(pk__in=pk_set).update(last_modified=timezone.now())
+
     featureType = models.CharField(max_length=32)
     data_content = models.CharField(max_length=200)
     # spatial atts
@@ -159,3 +324,179 @@ class UC2Observation(DataFile):
     checkerVersionMajor = models.IntegerField()
     checkerVersionMinor = models.IntegerField()
     checkerVersionSub = models.IntegerField()
+
+    # text of the searchable columns and relations, maintained by data.search
+    search_document = models.TextField(blank=True, default='')
+
+    class Meta:
+        indexes = [
+            # keyset pagination of FileView
+            models.Index(fields=['-upload_date', '-id']),
+            # the frontend's default list of current, valid files
+            models.Index(fields=['-upload_date', '-id'], name='data_uc2obs_current_idx',
+                         condition=models.Q(is_old=False, is_invalid=False)),
+            # UC2Filter equality filters, newest first
+            models.Index(fields=['data_content', '-upload_date', '-id']),
+            models.Index(fields=['campaign', '-upload_date', '-id']),
+            models.Index(fields=['featureType', '-upload_date', '-id']),
+            models.Index(fields=['author', '-upload_date', '-id']),
+            models.Index(fields=['source', '-upload_date', '-id']),
+            models.Index(fields=['institution', '-upload_date', '-id']),
+            models.Index(fields=['acronym', '-upload_date', '-id']),
+            # UC2Filter date ranges
+            models.Index(fields=['creation_time']),
+            models.Index(fields=['origin_time']),
+        ]
+
+
+
+class UC2ObservationUserObjectPermission(UserObjectPermissionBase):
+    """
+    guardian user permissions on UC2Observation with a real foreign key instead of the generic object_pk text
+    column. Rows are removed together with the observation.
+    """
+    content_object = models.ForeignKey(UC2Observation, on_delete=models.CASCADE)
+
+
+class UC2ObservationGroupObjectPermission(GroupObjectPermissionBase):
+    content_object = models.ForeignKey(UC2Observation, on_delete=models.CASCADE)
+
+
+# saves counting a download change no entry of the catalog
+COUNTER_FIELDS = ['download_count', 'last_modified']
+
+
+class FileChange(models.Model):
+    """
+    Change log of UC2Observation, written by signals. seq increases with every change, so mirrors read the changes
+    after the last seq they have seen instead of listing every file again.
+
+    Rows are inserted while holding a lock on the LOCK Generation row until their transaction commits, so a seq is
+    never visible before every smaller seq is committed or rolled back: a reader moving past a seq misses nothing. The
+    value of that row is the last seq removed by prune_file_changes.
+    """
+    CREATED = "created"
+    UPDATED = "updated"
+    DELETED = "deleted"
+    # visibility of a licence changed, mirrors list the catalog again
+    RESET = "reset"
+    ACTIONS = [(CREATED, CREATED), (UPDATED, UPDATED), (DELETED, DELETED), (RESET, RESET)]
+    LOCK = "file-changes"
+
+    seq = models.BigAutoField(primary_key=True)
+    # no foreign keys, changes of deleted observations are kept. Resets have neither, every reader sees them
+    observation_id = models.IntegerField(db_index=True, null=True)
+    licence_id = models.IntegerField(null=True)
+    action = models.CharField(max_length=8, choices=ACTIONS)
+    changed = models.DateTimeField(default=timezone.now)
+
+    @staticmethod
+    def log(changes, superseded=None):
+        """
+        :param superseded: queryset of earlier changes made redundant by changes, deleted under the same lock
+        """
+        with transaction.atomic():
+            Generation.objects.select_for_update().get_or_create(key=FileChange.LOCK)
+            if superseded is not None:
+                superseded.delete()
+            FileChange.objects.bulk_create(changes)
+
+    @staticmethod
+    def pruned():
+        """
+        :return: the last seq removed from the log, readers after older ones have to list the catalog again
+        """
+        return Generation.current(FileChange.LOCK).value
+
+    @staticmethod
+    def observation_saving(sender, instance, raw=False, update_fields=None, *args, **kwargs):
+        instance._logged_licence_id = None
+        if raw or instance.pk is None or (update_fields and 'licence' not in update_fields):
+            return
+        instance._logged_licence_id = UC2Observation.objects.filter(pk=instance.pk).values_list(
+            'licence_id', flat=True).first()
+
+    @staticmethod
+    def observation_saved(sender, instance, created, raw=False, update_fields=None, *args, **kwargs):
+        if raw:
+            return
+        if update_fields and set(update_fields) <= set(COUNTER_FIELDS):
+            # a counted download replaces the updates of the file still in the log, the entry served with the change
+            # carries the current count. Files downloaded over and over keep one row instead of one per download.
+            FileChange.log(
+                [FileChange(observation_id=instance.pk, licence_id=instance.licence_id, action=FileChange.UPDATED)],
+                superseded=FileChange.objects.filter(observation_id=instance.pk, licence_id=instance.licence_id,
+                                                     action=FileChange.UPDATED),
+            )
+            return
+        old_licence_id = getattr(instance, '_logged_licence_id', None)
+        if not created and old_licence_id is not None and old_licence_id != instance.licence_id:
+            # gone for the readers of the old licence, new for those of the new one
+            FileChange.log([
+                FileChange(observation_id=instance.pk, licence_id=old_licence_id, action=FileChange.DELETED),
+                FileChange(observation_id=instance.pk, licence_id=instance.licence_id, action=FileChange.CREATED),
+            ])
+            return
+        FileChange.log([FileChange(observation_id=instance.pk, licence_id=instance.licence_id,
+                                   action=FileChange.CREATED if created else FileChange.UPDATED)])
+
+    @staticmethod
+    def observation_deleted(sender, instance, *args, **kwargs):
+        FileChange.log([FileChange(observation_id=instance.pk, licence_id=instance.licence_id,
+                                   action=FileChange.DELETED)])
+
+    @staticmethod
+    def variables_changed(sender, instance, action, reverse, pk_set, *args, **kwargs):
+        if not action.startswith('post_'):
+            return
+        if not reverse:
+            changed = [(instance.pk, instance.licence_id)]
+        elif pk_set:
+            changed = UC2Observation.objects.filter(pk__in=pk_set).values_list('id', 'licence_id')
+        else:
+            return
+        FileChange.log([
+            FileChange(observation_id=pk, licence_id=licence_id, action=FileChange.UPDATED)
+            for pk, licence_id in changed
+        ])
+
+    @staticmethod
+    def visibility_changed(sender, *args, **kwargs):
+        """
+        Readers who gained or lost the files of a licence can not tell which ones from the log
+        """
+        if kwargs.get('created') or not kwargs.get('action', 'post_').startswith('post_'):
+            return
+        FileChange.log([FileChange(action=FileChange.RESET)])
+
+    class Meta:
+        indexes = [
+            # the feed of a user, filtered by the licences they may see
+            models.Index(fields=['licence_id', 'seq']),
+            models.Index(fields=['changed']),
+        ]
+
+
+post_delete.connect(DataFile.post_delete, sender=UC2Observation)
+m2m_changed.connect(UC2Observation.variables_changed, sender=UC2Observation.variables.through)
+pre_save.connect(FileChange.observation_saving, sender=UC2Observation)
+post_save.connect(FileChange.observation_saved, sender=UC2Observation)
+post_delete.connect(FileChange.observation_deleted, sender=UC2Observation)
+m2m_changed.connect(FileChange.variables_changed, sender=UC2Observation.variables.through)
+post_save.connect(FileChange.visibility_changed, sender=License)
+m2m_changed.connect(FileChange.visibility_changed, sender=License.view_groups.through)
+post_delete.connect(FileChange.visibility_changed, sender=Group)
+
+
+for model, key in [(License, 'license'), (Institution, 'institution'), (Site, 'site'), (Variable, 'variable')]:
+    post_save.connect(Generation.bump_on_change(key), sender=model, weak=False)
+    post_delete.connect(Generation.bump_on_change(key), sender=model, weak=False)
+m2m_changed.connect(Generation.bump_on_change('license'), sender=License.view_groups.through, weak=False)
+# deleting a group drops its view_groups rows without m2m_changed
+post_delete.connect(Generation.bump_on_change('license'), sender=Group, weak=False)
+m2m_changed.connect(Generation.bump_on_change('site'), sender=Site.institution.through, weak=False)
+m2m_changed.connect(Generation.bump_on_change('variable'), sender=Variable.institution.through, weak=False)
+# counted downloads do not change any list of files
+post_save.connect(Generation.bump_on_change('file', ignored_fields=COUNTER_FIELDS), sender=UC2Observation, weak=False)
+post_delete.connect(Generation.bump_on_change('file'), sender=UC2Observation, weak=False)
+m2m_changed.connect(Generation.bump_on_change('file'), sender=UC2Observation.variables.through, weak=False)
@@ -0,0 +1,175 @@
+import base64
+import json
+from collections import OrderedDict
+
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import LimitOffsetPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+from .counts import estimated_count
+
+
+class KeysetPagination(LimitOffsetPagination):
+    """
+    LimitOffsetPagination with an additional keyset mode for crawling large lists.
+
+    ?pagination=cursor starts the keyset mode, the rows are ordered newest upload first (ties by id) and every page
+    links to the next one with an opaque cursor holding the position of its last row. A page is read from the index at
+    that position, so page N costs the same as page 1. Without the parameter limit / offset work as before.
+    """
+    mode_query_param = "pagination"
+    cursor_query_param = "cursor"
+    cursor_mode = "cursor"
+    cursor_default_limit = 100
+    ordering = ("-upload_date", "-id")
+    invalid_cursor_message = "Invalid cursor"
+    count_query_param = "count"
+    count_estimate = "estimate"
+
+    def is_cursor_mode(self, request):
+        return (request.query_params.get(self.mode_query_param) == self.cursor_mode
+                or self.cursor_query_param in request.query_params)
+
+    def encode_cursor(self, obj):
+        if isinstance(obj, dict):  # values() rows of the fast list path
+            upload_date, pk = obj["upload_date"], obj["id"]
+        else:
+            upload_date, pk = obj.upload_date, obj.pk
+        position = json.dumps([upload_date.isoformat(), pk])
+        return base64.urlsafe_b64encode(position.encode()).decode()
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None
+        try:
+            upload_date, pk = json.loads(base64.urlsafe_b64decode(encoded.encode()).decode())
+            upload_date = parse_datetime(upload_date)
+            if upload_date is None:
+                raise ValueError
+            return upload_date, int(pk)
+        except (TypeError, ValueError, UnicodeDecodeError):
+            raise NotFound(self.invalid_cursor_message)
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.cursor_page = self.is_cursor_mode(request)
+        self.estimate_page = request.query_params.get(self.count_query_param) == self.count_estimate
+        if self.cursor_page:
+            return self.paginate_keyset(queryset, request)
+        if self.estimate_page:
+            return self.paginate_estimated(queryset, request)
+        return super().paginate_queryset(queryset, request, view)
+
+    def paginate_estimated(self, queryset, request):
+        self.limit = self.get_limit(request)
+        if self.limit is None:
+            return None
+        self.offset = self.get_offset(request)
+        self.request = request
+        rows = list(queryset[self.offset:self.offset + self.limit + 1])
+        self.has_next = len(rows) > self.limit
+        self.count, self.count_exact = estimated_count(queryset, request)
+        self.display_page_controls = False
+        return rows[:self.limit]
+
+    def keyset_queryset(self, queryset, request):
+        self.request = request
+        self.limit = self.get_limit(request) or self.cursor_default_limit
+        # replaces any other ordering, e.g. the search ranking
+        queryset = queryset.order_by(*self.ordering)
+        position = self.decode_cursor(request)
+        if position is not None:
+            upload_date, pk = position
+            # the redundant upload_date__lte lets the database seek in the index instead of skipping up to the position
+            queryset = queryset.filter(Q(upload_date__lt=upload_date) | Q(id__lt=pk), upload_date__lte=upload_date)
+        return queryset
+
+    def paginate_keyset(self, queryset, request):
+        queryset = self.keyset_queryset(queryset, request)
+        # one row more tells if there is a next page without counting
+        rows = list(queryset[:self.limit + 1])
+        page = rows[:self.limit]
+        self.next_cursor = self.encode_cursor(page[-1]) if len(rows) > self.limit else None
+        return page
+
+    def paginate_stream(self, queryset, request):
+        """
+        paginate_queryset for streamed responses, the page is not evaluated here
+        :return: None if the list is not paginated, else the envelope keys before the results, the lazy page rows
+            (possibly one row more than limit), limit and a function of the last row and whether more rows followed
+            giving the envelope keys after the results
+        """
+        self.request = request
+        self.cursor_page = self.is_cursor_mode(request)
+        self.estimate_page = request.query_params.get(self.count_query_param) == self.count_estimate
+
+        if self.cursor_page:
+            queryset = self.keyset_queryset(queryset, request)
+
+            def tail(last, more):
+                self.next_cursor = self.encode_cursor(last) if more else None
+                return OrderedDict([('next', self.get_next_link())])
+            return OrderedDict(), queryset[:self.limit + 1], self.limit, tail
+
+        self.limit = self.get_limit(request)
+        if self.limit is None:
+            return None
+        self.offset = self.get_offset(request)
+
+        if self.estimate_page:
+            self.count, self.count_exact = estimated_count(queryset, request)
+
+            def tail(last, more):
+                self.has_next = more
+                return OrderedDict([('has_next', self.has_next), ('next', self.get_next_link())])
+            head = OrderedDict([
+                ('count', self.count),
+                ('count_exact', self.count_exact),
+                ('previous', self.get_previous_link()),
+            ])
+            return head, queryset[self.offset:self.offset + self.limit + 1], self.limit, tail
+
+        self.count = self.get_count(queryset)
+        head = OrderedDict([
+            ('count', self.count),
+            ('next', self.get_next_link()),
+            ('previous', self.get_previous_link()),
+        ])
+        return head, queryset[self.offset:self.offset + self.limit], self.limit, lambda last, more: OrderedDict()
+
+    def get_next_link(self):
+        if self.estimate_page:
+            if not self.has_next:
+                return None
+            url = self.request.build_absolute_uri()
+            url = replace_query_param(url, self.limit_query_param, self.limit)
+            return replace_query_param(url, self.offset_query_param, self.offset + self.limit)
+        if not self.cursor_page:
+            return super().get_next_link()
+        if self.next_cursor is None:
+            return None
+        url = self.request.build_absolute_uri()
+        url = replace_query_param(url, self.mode_query_param, self.cursor_mode)
+        url = replace_query_param(url, self.limit_query_param, self.limit)
+        return replace_query_param(url, self.cursor_query_param, self.next_cursor)
+
+    def get_paginated_response(self, data):
+        if self.estimate_page:
+            return Response(OrderedDict([
+                ('count', self.count),
+                ('count_exact', self.count_exact),
+                ('has_next', self.has_next),
+                ('next', self.get_next_link()),
+                ('previous', self.get_previous_link()),
+                ('results', data),
+            ]))
+        if not self.cursor_page:
+            return super().get_paginated_response(data)
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('results', data),
+        ]))
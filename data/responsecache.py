@@ -0,0 +1,94 @@
+"""
+List responses shared by all callers who see the same files.
+
+Most requests come from anonymous users and members of the same groups, who all see the same files. A page is cached
+under the normalized query, a hash of the caller's visibility class and the generations of the tables it shows.
+Uploads, invalidations and deletions bump 'file', licence changes 'license', so every change starts new keys at once
+and the old entries expire after FILE_LIST_CACHE_TIMEOUT seconds.
+
+The cache is the FILE_LIST_CACHE entry of CACHES, local memory per process by default, see settings.py for a file
+based or a Redis cache shared by the workers.
+"""
+import hashlib
+
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.cache import get_conditional_response
+from django.utils.http import parse_http_date_safe
+
+from rest_framework.response import Response
+
+from .counts import filter_signature
+from .models import Generation
+from .singleflight import SingleFlight
+from .visibility import visibility_class
+
+# tables rendered in a page of files
+GENERATION_KEYS = ("file", "license", "variable")
+# parameters changing the rendering, not the data
+RENDER_PARAMS = {"format"}
+
+list_flight = SingleFlight("file-list", settings.FILE_LIST_CACHE)
+
+
+def generations(keys=GENERATION_KEYS):
+    """
+    :return: the values of the generations keys read in one query, joined by "."
+    """
+    values = dict(Generation.objects.filter(key__in=keys).values_list("key", "value"))
+    return ".".join(str(values.get(key, 0)) for key in keys)
+
+
+def response_key(request):
+    # links in a page are absolute, so the host is part of the query
+    query = "%s?%s" % (request.build_absolute_uri("/"), filter_signature(request, ignored=RENDER_PARAMS))
+    return "file-list:%s:%s:%s" % (
+        generations(),
+        hashlib.md5(visibility_class(request.user).encode()).hexdigest(),
+        hashlib.md5(query.encode()).hexdigest(),
+    )
+
+
+class SharedListCacheMixin:
+    """
+    Serves list() from the shared cache, including 304 answers from the cached validators. Must come before
+    ConditionalListMixin, so a hit needs neither the validator query nor the page query. Concurrent misses of a page
+    wait for the first one to render it. Streamed lists are not cached.
+    """
+
+    def list(self, request, *args, **kwargs):
+        if not settings.FILE_LIST_CACHE_TIMEOUT:
+            return super().list(request, *args, **kwargs)
+
+        cache = caches[settings.FILE_LIST_CACHE]
+        key = response_key(request)
+        entry = cache.get(key)
+        if entry is None:
+            computed = []
+
+            def compute():
+                response = super(SharedListCacheMixin, self).list(request, *args, **kwargs)
+                computed.append(response)
+                if isinstance(response, Response) and response.status_code == 200:
+                    entry = (response.data, response.get("ETag"), response.get("Last-Modified"))
+                    cache.set(key, entry, settings.FILE_LIST_CACHE_TIMEOUT)
+                    return entry
+                return None
+            # concurrent misses wait for one request to render the page
+            entry = list_flight.run(key, compute)
+            if computed:
+                return computed[0]
+            if entry is None:
+                return super().list(request, *args, **kwargs)
+
+        data, etag, last_modified = entry
+        response = get_conditional_response(
+            request, etag=etag, last_modified=parse_http_date_safe(last_modified) if last_modified else None
+        )
+        if response is None:
+            response = Response(data)
+        if etag:
+            response["ETag"] = etag
+        if last_modified:
+            response["Last-Modified"] = last_modified
+        return response
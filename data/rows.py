@@ -0,0 +1,247 @@
+"""
+Read only fast path for list endpoints.
+
+A RowSerializer takes a configured ModelSerializer and renders the same output from values() rows: the model
+columns and foreign key slugs of a page are read in one query, every many to many relation in one more, and each
+column goes through a converter picked once instead of DRF's per field, per row machinery.
+"""
+from collections import defaultdict
+
+from django.core.files.storage import FileSystemStorage
+from django.utils import timezone
+from django.utils.encoding import filepath_to_uri
+
+from rest_framework import ISO_8601, fields, relations
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+
+from .streaming import json_envelope, json_list, should_stream, streaming_json_response
+
+# rows read from the database cursor and rendered at once in streamed lists
+STREAM_CHUNK_SIZE = 1000
+# serializer fields whose to_representation returns the database value unchanged
+IDENTITY_FIELDS = (fields.CharField, fields.IntegerField, fields.FloatField, fields.BooleanField, fields.ChoiceField)
+
+
+class RowSerializer:
+    """
+    Renders rows like serializer(many=True).data would. supported is False if the serializer uses a field this path
+    can not reproduce, e.g. a nested serializer, the caller then uses the serializer.
+    """
+
+    def __init__(self, serializer):
+        self.model = serializer.Meta.model
+        self.context = serializer.context
+        self.pk_name = self.model._meta.pk.attname
+        self.columns = []  # (output key, values() lookup or None for many to many, converter or None)
+        self.many = []  # (output key, through model, owner column, value column, order column)
+        self.supported = True
+        for name, field in serializer.fields.items():
+            if not self.add_field(name, field):
+                self.supported = False
+                return
+
+    def add_field(self, name, field):
+        if field.source in ("*", None) or "." in field.source:
+            return False
+
+        if isinstance(field, relations.ManyRelatedField):
+            return self.add_many(name, field)
+
+        if isinstance(field, relations.SlugRelatedField):
+            model_field = self.model._meta.get_field(field.source)
+            if model_field.target_field.name == field.slug_field:
+                lookup = model_field.attname  # the foreign key holds the slug, no join
+            else:
+                lookup = "%s__%s" % (field.source, field.slug_field)
+            self.columns.append((name, lookup, None))
+        elif isinstance(field, relations.PrimaryKeyRelatedField):
+            self.columns.append((name, self.model._meta.get_field(field.source).attname, None))
+        elif isinstance(field, relations.RelatedField) or isinstance(field, fields.SerializerMethodField):
+            return False
+        elif isinstance(field, fields.FileField):
+            self.columns.append((name, field.source, self.file_converter(field)))
+        elif isinstance(field, fields.DateTimeField):
+            self.columns.append((name, field.source, self.datetime_converter(field)))
+        elif isinstance(field, IDENTITY_FIELDS):
+            self.columns.append((name, field.source, None))
+        elif isinstance(field, fields.Field) and not hasattr(field, "child") and not hasattr(field, "fields"):
+            self.columns.append((name, field.source, field.to_representation))
+        else:
+            return False
+        return True
+
+    def add_many(self, name, field):
+        child = field.child_relation
+        m2m = self.model._meta.get_field(field.source)
+        if not m2m.many_to_many or m2m.model is not self.model:
+            return False
+        through = m2m.remote_field.through
+        owner = m2m.m2m_field_name() + "_id"
+        target = m2m.m2m_reverse_field_name()
+        if isinstance(child, relations.SlugRelatedField):
+            value = "%s__%s" % (target, child.slug_field)
+        elif isinstance(child, relations.PrimaryKeyRelatedField):
+            value = target + "_id"
+        else:
+            return False
+        self.many.append((name, through, owner, value, target + "_id"))
+        self.columns.append((name, None, None))
+        return True
+
+    def file_converter(self, field):
+        if not getattr(field, "use_url", api_settings.UPLOADED_FILES_USE_URL):
+            return lambda name: name or None
+        storage = self.model._meta.get_field(field.source).storage
+        request = self.context.get("request")
+        if not isinstance(storage, FileSystemStorage):
+            def convert(name):
+                if not name:
+                    return None
+                url = storage.url(name)
+                return request.build_absolute_uri(url) if request is not None else url
+            return convert
+
+        # FileSystemStorage.url joins base_url, which always ends with /, and the name. The absolute base is built
+        # once instead of per row.
+        base_url = storage.base_url
+        if request is not None:
+            base_url = request.build_absolute_uri(base_url)
+
+        def convert(name):
+            return base_url + filepath_to_uri(name).lstrip("/") if name else None
+        return convert
+
+    @staticmethod
+    def datetime_converter(field):
+        """
+        DateTimeField.to_representation with the output timezone looked up once instead of per value
+        """
+        output_format = getattr(field, "format", api_settings.DATETIME_FORMAT)
+        if output_format is None or output_format.lower() != ISO_8601:
+            return field.to_representation
+        field_timezone = getattr(field, "timezone", field.default_timezone())
+        if field_timezone is None:
+            return field.to_representation
+
+        def convert(value):
+            if isinstance(value, str) or not timezone.is_aware(value):
+                return field.to_representation(value)
+            value = value.astimezone(field_timezone).isoformat()
+            return value[:-6] + "Z" if value.endswith("+00:00") else value
+        return convert
+
+    def values(self, queryset, extra=()):
+        """
+        :param extra: further columns to read, e.g. for the pagination
+        :return: queryset as values() rows with every column needed, still lazy so it can be paginated
+        """
+        lookups = {lookup for key, lookup, converter in self.columns if lookup is not None}
+        lookups.add(self.pk_name)
+        lookups.update(extra)
+        return queryset.prefetch_related(None).values(*lookups)
+
+    def related_values(self, ids):
+        related = {}
+        for key, through, owner, value, order in self.many:
+            # one IN over the page like prefetch_related, pages are bounded by the pagination
+            by_owner = defaultdict(list)
+            rows = through.objects.filter(**{owner + "__in": ids}).order_by(owner, order).values_list(owner, value)
+            for owner_id, related_value in rows:
+                by_owner[owner_id].append(related_value)
+            related[key] = by_owner
+        return related
+
+    def render(self, rows):
+        rows = list(rows)
+        related = self.related_values([row[self.pk_name] for row in rows])
+        data = []
+        for row in rows:
+            item = {}
+            for key, lookup, converter in self.columns:
+                if lookup is None:
+                    item[key] = related[key].get(row[self.pk_name], [])
+                    continue
+                value = row[lookup]
+                item[key] = converter(value) if converter is not None and value is not None else value
+            data.append(item)
+        return data
+
+    def chunks(self, queryset, chunk_size=STREAM_CHUNK_SIZE):
+        """
+        Read queryset from a server side cursor
+        :return: generator of lists of up to chunk_size values rows
+        """
+        chunk = []
+        for row in queryset.iterator(chunk_size=chunk_size):
+            chunk.append(row)
+            if len(chunk) == chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def stream(self, queryset, chunk_size=STREAM_CHUNK_SIZE):
+        """
+        Render queryset chunk by chunk from a server side cursor
+        :return: generator of (values row, rendered row)
+        """
+        for chunk in self.chunks(queryset, chunk_size):
+            yield from zip(chunk, self.render(chunk))
+
+
+class RowListMixin:
+    """
+    list() of a view rendered through a RowSerializer whenever it can reproduce the view's serializer
+    """
+    # columns the view's pagination reads from each row
+    row_lookups = ()
+
+    def list(self, request, *args, **kwargs):
+        serializer = self.get_serializer()
+        rows = RowSerializer(serializer)
+        if not rows.supported:
+            return super().list(request, *args, **kwargs)
+
+        queryset = rows.values(self.filter_queryset(self.get_queryset()), self.row_lookups)
+        streamable = self.paginator is None or hasattr(self.paginator, "paginate_stream")
+        if streamable and should_stream(request, self.page_size(request)):
+            return self.stream_list(rows, queryset)
+
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            return self.get_paginated_response(rows.render(page))
+        return Response(rows.render(queryset))
+
+    def page_size(self, request):
+        """
+        :return: the rows per page the request asks for, None if the list is not paginated
+        """
+        if self.paginator is None:
+            return None
+        if hasattr(self.paginator, "is_cursor_mode") and self.paginator.is_cursor_mode(request):
+            return self.paginator.get_limit(request) or self.paginator.cursor_default_limit
+        return self.paginator.get_limit(request)
+
+    def stream_list(self, rows, queryset):
+        """
+        The list as StreamingHttpResponse, with the envelope of the paginator if the list is paginated
+        """
+        page = self.paginator.paginate_stream(queryset, self.request) if self.paginator is not None else None
+        if page is None:
+            return streaming_json_response(json_list(item for row, item in rows.stream(queryset)))
+
+        head, page_rows, limit, tail = page
+        last = {}
+
+        def results():
+            for i, (row, item) in enumerate(rows.stream(page_rows)):
+                if i == limit:  # the one row fetched beyond the page
+                    last["more"] = True
+                    return
+                last["row"] = row
+                yield item
+
+        return streaming_json_response(json_envelope(
+            head, results(), lambda: tail(last.get("row"), last.get("more", False))
+        ))
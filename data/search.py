@@ -0,0 +1,185 @@
+"""
+Full text search over UC2Observation.
+
+Every observation carries a denormalized search_document with the text of its searchable columns and those of its
+site, institution and variables. The document is indexed with FTS5 on SQLite and a tsvector GIN index on
+PostgreSQL, on other databases the search falls back to icontains on the document column.
+"""
+import re
+from collections import defaultdict
+
+from django.db import DEFAULT_DB_ALIAS, OperationalError, connection, connections
+from django.db.models import Q
+from django.db.models.signals import m2m_changed, post_save
+from rest_framework import filters
+
+from .models import Institution, Site, UC2Observation, Variable
+
+# the columns searched besides variable, long_name and standard_name of the variables
+DOCUMENT_FIELDS = [
+    "site__site",
+    "site__address",
+    "acronym__ge_title",
+    "acronym__en_title",
+    "acronym__acronym",
+    "file_standard_name",
+    "keywords",
+    "author",
+    "source",
+    "data_content",
+]
+BATCH_SIZE = 2000
+TOKEN = re.compile(r"\w+", re.UNICODE)
+
+TABLE = UC2Observation._meta.db_table
+FTS_TABLE = TABLE + "_fts"
+GIN_INDEX = TABLE + "_search_gin"
+TS_VECTOR = "to_tsvector('simple', %s.search_document)" % TABLE
+
+
+def rebuild_search_documents(queryset):
+    """
+    Recompute the search document of all observations in queryset with a fixed number of queries per batch
+    """
+    ids = list(queryset.order_by().values_list("id", flat=True))
+    for start in range(0, len(ids), BATCH_SIZE):
+        batch = ids[start:start + BATCH_SIZE]
+        words = defaultdict(list)
+        for row in UC2Observation.objects.filter(id__in=batch).values_list("id", *DOCUMENT_FIELDS):
+            words[row[0]].extend(value for value in row[1:] if value)
+        for row in UC2Observation.variables.through.objects.filter(uc2observation_id__in=batch).values_list(
+                "uc2observation_id", "variable__variable", "variable__long_name", "variable__standard_name"):
+            words[row[0]].extend(value for value in row[1:] if value)
+
+        objs = [UC2Observation(id=pk, search_document=" ".join(words[pk])) for pk in batch]
+        UC2Observation.objects.bulk_update(objs, ["search_document"])
+
+
+def post_save_observation(sender, instance, raw=False, update_fields=None, *args, **kwargs):
+    if raw:
+        return
+    searchable = {f.split("__")[0] for f in DOCUMENT_FIELDS}
+    if update_fields is not None and not searchable.intersection(update_fields):
+        return  # e.g. download counts
+    rebuild_search_documents(UC2Observation.objects.filter(pk=instance.pk))
+
+
+def variables_changed(sender, instance, action, reverse, pk_set, *args, **kwargs):
+    if not reverse:
+        if action.startswith("post_"):
+            rebuild_search_documents(UC2Observation.objects.filter(pk=instance.pk))
+        return
+    # changed from the variable side, pk_set holds observations. A clear does not tell which, remember them before.
+    if action == "pre_clear":
+        instance._search_cleared = list(instance.datasets.values_list("pk", flat=True))
+    elif action == "post_clear":
+        rebuild_search_documents(UC2Observation.objects.filter(pk__in=instance._search_cleared))
+    elif action.startswith("post_"):
+        rebuild_search_documents(UC2Observation.objects.filter(pk__in=pk_set))
+
+
+def related_saved(lookup):
+    """
+    Receiver for the related tables, rebuilds the documents of every observation pointing to the saved row
+    """
+    def receiver(sender, instance, raw=False, created=False, *args, **kwargs):
+        if raw or created:
+            return  # new rows are not referenced yet
+        rebuild_search_documents(UC2Observation.objects.filter(**{lookup: instance}))
+    return receiver
+
+
+def install_search_index(using=DEFAULT_DB_ALIAS, **kwargs):
+    """
+    post_migrate receiver creating the database specific full text index. Observations without a document, e.g.
+    those stored before the document existed, get theirs first, the signals only cover later changes.
+    """
+    rebuild_search_documents(UC2Observation.objects.using(using).filter(search_document=""))
+    conn = connections[using]
+    with conn.cursor() as cursor:
+        if conn.vendor == "sqlite":
+            try:
+                cursor.execute(
+                    "CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5("
+                    "search_document, content='{table}', content_rowid='id', tokenize='unicode61')".format(
+                        fts=FTS_TABLE, table=TABLE)
+                )
+            except OperationalError:
+                return  # SQLite without FTS5, the search uses icontains
+            triggers = [
+                "CREATE TRIGGER IF NOT EXISTS {fts}_ai AFTER INSERT ON {table} BEGIN "
+                "INSERT INTO {fts}(rowid, search_document) VALUES (new.id, new.search_document); END",
+                "CREATE TRIGGER IF NOT EXISTS {fts}_ad AFTER DELETE ON {table} BEGIN "
+                "INSERT INTO {fts}({fts}, rowid, search_document) VALUES ('delete', old.id, old.search_document); END",
+                "CREATE TRIGGER IF NOT EXISTS {fts}_au AFTER UPDATE OF search_document ON {table} BEGIN "
+                "INSERT INTO {fts}({fts}, rowid, search_document) VALUES ('delete', old.id, old.search_document); "
+                "INSERT INTO {fts}(rowid, search_document) VALUES (new.id, new.search_document); END",
+                "INSERT INTO {fts}({fts}) VALUES ('rebuild')",
+            ]
+            for statement in triggers:
+                cursor.execute(statement.format(fts=FTS_TABLE, table=TABLE))
+        elif conn.vendor == "postgresql":
+            cursor.execute("CREATE INDEX IF NOT EXISTS {index} ON {table} USING gin ({vector})".format(
+                index=GIN_INDEX, table=TABLE, vector=TS_VECTOR))
+
+
+_fts_tables = set()
+
+
+def has_fts_table():
+    # only a positive answer is remembered, the table may be created by a later migrate
+    if connection.alias not in _fts_tables and FTS_TABLE in connection.introspection.table_names():
+        _fts_tables.add(connection.alias)
+    return connection.alias in _fts_tables
+
+
+def search(queryset, terms, rank=True):
+    """
+    Observations whose document contains every term as a word prefix, best matches first if rank is set
+    """
+    words = [word for term in terms for word in TOKEN.findall(term)]
+    if not words:
+        return queryset
+
+    if connection.vendor == "postgresql":
+        query = " & ".join("%s:*" % word for word in words)
+        condition = "{vector} @@ to_tsquery('simple', %s)".format(vector=TS_VECTOR)
+        queryset = queryset.extra(where=[condition], params=[query])
+        if rank:
+            queryset = queryset.extra(
+                select={"search_rank": "ts_rank({vector}, to_tsquery('simple', %s))".format(vector=TS_VECTOR)},
+                select_params=[query], order_by=["-search_rank"])
+        return queryset
+
+    if connection.vendor == "sqlite" and has_fts_table():
+        query = " ".join('"%s"*' % word for word in words)
+        # joined rather than a subquery, so the MATCH runs once and bm25 (lower is better) is read from the join
+        queryset = queryset.extra(tables=[FTS_TABLE], where=[
+            "{fts}.rowid = {table}.id".format(fts=FTS_TABLE, table=TABLE),
+            "{fts} MATCH %s".format(fts=FTS_TABLE),
+        ], params=[query])
+        if rank:
+            queryset = queryset.extra(select={"search_rank": "bm25({fts})".format(fts=FTS_TABLE)},
+                                      order_by=["search_rank"])
+        return queryset
+
+    condition = Q()
+    for word in words:
+        condition &= Q(search_document__icontains=word)
+    return queryset.filter(condition)
+
+
+class FullTextSearchFilter(filters.SearchFilter):
+    """
+    Drop in for SearchFilter on FileView backed by the search document index
+    """
+
+    def filter_queryset(self, request, queryset, view):
+        return search(queryset, self.get_search_terms(request))
+
+
+post_save.connect(post_save_observation, sender=UC2Observation)
+m2m_changed.connect(variables_changed, sender=UC2Observation.variables.through)
+post_save.connect(related_saved("site"), sender=Site, weak=False)
+post_save.connect(related_saved("acronym"), sender=Institution, weak=False)
+post_save.connect(related_saved("variables"), sender=Variable, weak=False)
@@ -12,6 +12,7 @@ from rest_framework.utils import  model_meta
 from data.models import *
 from auth.models import User
 
+from django.conf import settings
 from django.core.exceptions import ObjectDoesNotExist, MultipleObjectsReturned
 
 from django.core.files.uploadhandler import TemporaryUploadedFile
@@ -24,7 +25,32 @@ class LicenceSerializer(serializers.ModelSerializer):
         fields = "__all__"
 
 
-class UC2Serializer(serializers.ModelSerializer):
+class SparseFieldsMixin:
+    """
+    Renders the fields the request asks for: ?fields= keeps only the listed fields, ?omit= drops the listed fields and
+    ?expand= renders the listed relations of Meta.expandable as nested objects instead of slugs
+    """
+
+    @staticmethod
+    def _param(request, name):
+        values = request.query_params.get(name, "") if request is not None else ""
+        return {v.strip() for v in values.split(",") if v.strip()}
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        request = self.context.get("request")
+        self.expanded = self._param(request, "expand") & set(getattr(self.Meta, "expandable", {}))
+        for name in self.expanded:
+            self.fields[name] = self.Meta.expandable[name]()
+
+        keep = self._param(request, "fields")
+        drop = self._param(request, "omit")
+        for name in list(self.fields):
+            if (keep and name not in keep) or name in drop:
+                self.fields.pop(name)
+
+
+class UC2Serializer(SparseFieldsMixin, serializers.ModelSerializer):
     site = serializers.SlugRelatedField(slug_field='site', queryset=Site.objects.all())
     acronym = serializers.SlugRelatedField(slug_field='acronym', queryset=Institution.objects.all())
     variables = serializers.SlugRelatedField(slug_field='variable', queryset=Variable.objects.all(), many=True)
@@ -33,7 +59,27 @@ class UC2Serializer(serializers.ModelSerializer):
 
     class Meta:
         model = UC2Observation
-        fields = "__all__"
+        exclude = ["search_document"]
+        expandable = {
+            "variables": lambda: VariableSerializer(many=True, read_only=True),
+        }
+
+
+class FileLookupSerializer(serializers.Serializer):
+    """
+    Request body of FileView.lookup
+    """
+    ids = serializers.ListField(child=serializers.IntegerField(), required=False, default=list)
+    file_standard_names = serializers.ListField(child=serializers.CharField(), required=False, default=list)
+    links = serializers.BooleanField(required=False, default=False)
+
+    def validate(self, attrs):
+        items = len(attrs["ids"]) + len(attrs["file_standard_names"])
+        if not items:
+            raise ValidationError("ids or file_standard_names are required")
+        if items > settings.FILE_LOOKUP_MAX_ITEMS:
+            raise ValidationError("At most %s ids and names can be looked up at once" % settings.FILE_LOOKUP_MAX_ITEMS)
+        return attrs
 
 
 class VariableSerializer(serializers.ModelSerializer):
@@ -0,0 +1,133 @@
+"""
+Single flight: concurrent identical requests wait for one computation instead of each running it.
+
+Within a process the callers of a key wait for the thread computing it. Across processes a lock in the cache the
+result is stored in elects one computing worker, the others poll the cache until the result appears. This needs a
+cache shared by the workers, with a local memory cache only the threads of a process are coalesced.
+
+The computed and coalesced calls of each flight are counted in the same cache, see SingleFlight.counters().
+"""
+import threading
+import time
+from collections import namedtuple
+
+from django.conf import settings
+from django.core.cache import DEFAULT_CACHE_ALIAS, caches
+
+FlightStats = namedtuple("FlightStats", ["computed", "coalesced"])
+
+
+class Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+
+
+class SingleFlight:
+    """
+    Coalesces the calls of one kind, e.g. the facet counts, under the keys of their cached results
+    """
+    # all flights by name, to report their counters
+    registry = {}
+
+    def __init__(self, name, cache_alias=DEFAULT_CACHE_ALIAS):
+        """
+        :param cache_alias: the cache holding the results, the locks and the counters
+        """
+        self.name = name
+        self.cache_alias = cache_alias
+        self._lock = threading.Lock()
+        self._flights = {}
+        SingleFlight.registry[name] = self
+
+    @property
+    def cache(self):
+        return caches[self.cache_alias]
+
+    def count(self, event):
+        cache = self.cache
+        key = "single-flight:%s:%s" % (self.name, event)
+        cache.add(key, 0, None)
+        try:
+            cache.incr(key)
+        except ValueError:  # evicted between add and incr
+            cache.add(key, 1, None)
+
+    def counters(self):
+        return FlightStats(
+            computed=self.cache.get("single-flight:%s:computed" % self.name, 0),
+            coalesced=self.cache.get("single-flight:%s:coalesced" % self.name, 0),
+        )
+
+    def cached(self, key, compute, timeout):
+        """
+        The cached value of key. On a miss it is computed by compute and cached for timeout seconds, concurrent
+        misses of the same key wait for one computation.
+        """
+        value = self.cache.get(key)
+        if value is not None:
+            return value
+
+        def compute_and_cache():
+            value = compute()
+            self.cache.set(key, value, timeout)
+            return value
+        value = self.run(key, compute_and_cache)
+        return compute_and_cache() if value is None else value
+
+    def run(self, key, compute):
+        """
+        compute once for all concurrent callers of key
+        :param compute: function storing its result under key in the cache and returning it, or returning None if the
+            result is not cached, the waiting callers then compute on their own
+        :return: the result of compute, or None if this caller waited for a computation returning None
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = Flight()
+
+        if not leader:
+            flight.done.wait(settings.SINGLE_FLIGHT_WAIT)
+            if flight.value is not None:
+                self.count("coalesced")
+            return flight.value
+
+        try:
+            flight.value = self.run_shared(key, compute)
+            return flight.value
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+    def run_shared(self, key, compute):
+        cache = self.cache
+        lock = key + ":lock"
+        if cache.add(lock, 1, settings.SINGLE_FLIGHT_WAIT):
+            try:
+                self.count("computed")
+                return compute()
+            finally:
+                cache.delete(lock)
+
+        # another process computes key
+        deadline = time.monotonic() + settings.SINGLE_FLIGHT_WAIT
+        while time.monotonic() < deadline:
+            time.sleep(settings.SINGLE_FLIGHT_POLL)
+            value = cache.get(key)
+            if value is not None:
+                self.count("coalesced")
+                return value
+            if cache.get(lock) is None:
+                break  # finished without caching a result, or failed
+        self.count("computed")
+        return compute()
+
+
+def flight_counters():
+    """
+    :return: computed and coalesced calls by flight name
+    """
+    return {name: flight.counters()._asdict() for name, flight in sorted(SingleFlight.registry.items())}
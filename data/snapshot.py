@@ -0,0 +1,352 @@
+"""
+Static snapshot of the public catalog.
+
+The files anonymous users see change only with uploads, deletions and licence changes, so their list is written to
+FILE_SNAPSHOT_ROOT once per change instead of rendered per request: catalog.json holds the list like FileView.list
+renders it, catalog.ndjson one entry per line. Both are also written gzip compressed, and brotli compressed if the
+brotli package is installed, so nginx can serve them with gzip_static / brotli_static. All files are written in one
+pass, entry by entry, the catalog is never held in memory.
+
+A rebuild is incremental. The manifest keeps the last seq of the change feed (see data/changes.py) committed when the
+build started. Entries without a change after it are copied from the previous snapshot as they are, only new and
+changed entries are rendered. Unlike a modification time, a seq is only visible once all smaller ones are committed,
+so a change committed during a build is never mistaken for one the build has seen.
+
+A snapshot of an older catalog is never served: the first request after a change starts a rebuild in a background
+thread (FILE_SNAPSHOT_BACKGROUND) and is answered from the database like any other, so are the requests until the
+rebuild is done. ./manage.py snapshot_catalog rebuilds it ahead of the
+requests, e.g. from cron. Both take the REBUILD_LOCK, one build runs at a time.
+"""
+import json
+import logging
+import os
+import threading
+import zlib
+from itertools import islice
+from urllib.parse import urljoin
+
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import caches
+from django.db import connection
+from django.db.models import Max
+from django.http import FileResponse, QueryDict, StreamingHttpResponse
+from django.utils import timezone
+
+from .conditional import not_modified, weak_etag
+from .export import ndjson_chunks
+from .models import FileChange, UC2Observation
+from .responsecache import generations
+from .rows import STREAM_CHUNK_SIZE, RowSerializer
+from .serializers import UC2Serializer
+from .streaming import BUFFER_SIZE, buffered, dumps, json_list
+from .visibility import visible_observations
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+MANIFEST = "manifest.json"
+KINDS = {"json": "application/json", "ndjson": "application/x-ndjson"}
+# entries rendered per query
+RENDER_CHUNK_SIZE = 500
+# seconds one process may hold the rebuild lock, others start their own rebuild afterwards
+REBUILD_TIMEOUT = 600
+REBUILD_LOCK = "snapshot:rebuild"
+GZIP_LEVEL = 9
+
+_rebuilding = threading.Lock()
+
+
+class SnapshotRequest:
+    """
+    Stands in for the request in the serializer context: no query parameters, links absolute to base_url
+    """
+    query_params = QueryDict()
+
+    def __init__(self, base_url):
+        self.base_url = base_url
+
+    def build_absolute_uri(self, location="/"):
+        return urljoin(self.base_url, location)
+
+
+def path(name):
+    return os.path.join(settings.FILE_SNAPSHOT_ROOT, name)
+
+
+def read_manifest():
+    try:
+        with open(path(MANIFEST)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def read_entries():
+    """
+    :return: generator of (id, encoded entry) of the current snapshot, ordered by id
+    """
+    try:
+        with open(path("catalog.ndjson"), "rb") as f:
+            for line in f:
+                line = line.rstrip(b"\n")
+                if line:
+                    yield json.loads(line)["id"], line
+    except OSError:
+        return
+
+
+class AtomicFile:
+    """
+    Written next to name and moved in place on close, readers never see a partial file
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.temp = "%s.%s.tmp" % (name, os.getpid())
+        self.file = open(self.temp, "wb")
+
+    def write(self, data):
+        self.file.write(data)
+
+    def close(self):
+        self.file.close()
+        os.replace(self.temp, self.name)
+
+
+class CatalogFile:
+    """
+    A snapshot file with its compressed copies, all written in one pass
+    """
+
+    def __init__(self, name):
+        self.buffer = []
+        self.length = 0
+        self.targets = [(AtomicFile(path(name)), None)]
+        compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        self.targets.append((AtomicFile(path(name + ".gz")), (compressor.compress, compressor.flush)))
+        if brotli is not None:
+            compressor = brotli.Compressor()
+            self.targets.append((AtomicFile(path(name + ".br")), (compressor.process, compressor.finish)))
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.length += len(data)
+        if self.length >= BUFFER_SIZE:
+            self.flush()
+
+    def flush(self):
+        data = b"".join(self.buffer)
+        self.buffer, self.length = [], 0
+        for target, compressor in self.targets:
+            target.write(compressor[0](data) if compressor else data)
+
+    def close(self):
+        self.flush()
+        for target, compressor in self.targets:
+            if compressor:
+                target.write(compressor[1]())
+            target.close()
+
+
+def entries(queryset, rows, since):
+    """
+    :param since: seq of the change feed the previous build started at, entries without a later change are copied
+        from its snapshot, None renders every entry
+    :return: generator of (id, encoded entry, rendered) of queryset, ordered by id
+    """
+    previous = read_entries() if since is not None else iter(())
+    last = next(previous, None)
+    current = queryset.values_list("id", flat=True).iterator(chunk_size=RENDER_CHUNK_SIZE)
+    for block in iter(lambda: list(islice(current, RENDER_CHUNK_SIZE)), []):
+        reused = {}
+        if since is not None:
+            changed = set(FileChange.objects.filter(seq__gt=since, observation_id__in=block).values_list(
+                "observation_id", flat=True))
+            for pk in block:
+                # both are ordered by id
+                while last is not None and last[0] < pk:
+                    last = next(previous, None)
+                if last is not None and last[0] == pk and pk not in changed:
+                    reused[pk] = last[1]
+        stale = [pk for pk in block if pk not in reused]
+        rendered = {}
+        if stale:
+            chunk = rows.values(UC2Observation.objects.filter(pk__in=stale))
+            rendered = {item["id"]: dumps(item) for item in rows.render(chunk)}
+        for pk in block:
+            if pk in reused:
+                yield pk, reused[pk], False
+            elif pk in rendered:  # else deleted meanwhile
+                yield pk, rendered[pk], True
+
+
+def build(base_url, full=False):
+    """
+    Write the snapshot of the current public catalog
+    :param full: render every entry instead of only the new and changed ones
+    :return: the manifest of the new snapshot
+    """
+    os.makedirs(settings.FILE_SNAPSHOT_ROOT, exist_ok=True)
+    generation = generations()
+    started = timezone.now()
+    seq = FileChange.objects.aggregate(seq=Max("seq"))["seq"] or 0
+    previous = read_manifest()
+    # renamed licences or variables change every entry, pruned changes can not tell which entries changed
+    if previous is None or previous["base_url"] != base_url or previous["generation"].split(".")[1:] != \
+            generation.split(".")[1:] or previous.get("seq") is None or previous["seq"] < FileChange.pruned():
+        full = True
+    since = None if full else previous["seq"]
+
+    queryset = visible_observations(AnonymousUser()).order_by("id")
+    rows = RowSerializer(UC2Serializer(context={"request": SnapshotRequest(base_url)}))
+    as_json, as_ndjson = CatalogFile("catalog.json"), CatalogFile("catalog.ndjson")
+    count = rendered = 0
+    as_json.write(b"[")
+    for pk, entry, is_rendered in entries(queryset, rows, since):
+        if count:
+            as_json.write(b",")
+        as_json.write(entry)
+        as_ndjson.write(entry + b"\n")
+        count += 1
+        rendered += is_rendered
+    as_json.write(b"]")
+    as_json.close()
+    as_ndjson.close()
+
+    manifest = {
+        "base_url": base_url,
+        "generation": generation,
+        "started": started.isoformat(),
+        "seq": seq,
+        "count": count,
+        "rendered": rendered,
+    }
+    target = AtomicFile(path(MANIFEST))
+    target.write(json.dumps(manifest).encode())
+    target.close()
+    return manifest
+
+
+def base_url_of(request):
+    return settings.FILE_SNAPSHOT_BASE_URL or request.build_absolute_uri("/")
+
+
+def is_current(manifest, request):
+    return manifest is not None and manifest["generation"] == generations() and \
+        manifest["base_url"] == base_url_of(request)
+
+
+def acquire_rebuild_lock():
+    """
+    :return: whether no other thread or process is rebuilding the snapshot, the caller has to release_rebuild_lock()
+        then. Other processes are only seen with a FILE_LIST_CACHE shared by them.
+    """
+    if not _rebuilding.acquire(blocking=False):
+        return False
+    if not caches[settings.FILE_LIST_CACHE].add(REBUILD_LOCK, os.getpid(), REBUILD_TIMEOUT):
+        _rebuilding.release()
+        return False
+    return True
+
+
+def release_rebuild_lock():
+    caches[settings.FILE_LIST_CACHE].delete(REBUILD_LOCK)
+    _rebuilding.release()
+
+
+def refresh(request):
+    """
+    Rebuild the snapshot for the current catalog, in a background thread if FILE_SNAPSHOT_BACKGROUND is set. Nothing
+    happens while this or another process is rebuilding it.
+    """
+    base_url = base_url_of(request)
+    background = settings.FILE_SNAPSHOT_BACKGROUND
+    if not acquire_rebuild_lock():
+        return
+
+    def run():
+        try:
+            build(base_url)
+        except Exception:
+            if not background:
+                raise
+            logger.exception("Rebuilding the catalog snapshot failed")
+        finally:
+            release_rebuild_lock()
+            if background:
+                connection.close()
+    if background:
+        threading.Thread(target=run, name="snapshot-rebuild", daemon=True).start()
+    else:
+        run()
+
+
+def current_manifest(request):
+    """
+    :return: the manifest of a snapshot of the current catalog, None if it is being rebuilt
+    """
+    manifest = read_manifest()
+    if is_current(manifest, request):
+        return manifest
+    refresh(request)
+    manifest = read_manifest()
+    return manifest if is_current(manifest, request) else None
+
+
+def serves_from_snapshot(request):
+    """
+    Anonymous requests for the complete JSON list are answered from the snapshot
+    """
+    return (
+        settings.FILE_SNAPSHOT_ROOT is not None
+        and request.user.is_anonymous
+        and not set(request.query_params) - {"format"}
+        and request.accepted_renderer.format == "json"
+        and base_url_of(request) == request.build_absolute_uri("/")
+    )
+
+
+def snapshot_response(request, kind):
+    """
+    The snapshot file of kind, compressed if the client accepts it
+    :return: None while the snapshot is being rebuilt
+    """
+    manifest = current_manifest(request)
+    if manifest is None:
+        return None
+    etag = weak_etag("snapshot", manifest["generation"], manifest["base_url"], kind)
+    response = not_modified(request, etag=etag)
+    if response is not None:
+        return response
+
+    name = "catalog." + kind
+    accepted = request.META.get("HTTP_ACCEPT_ENCODING", "")
+    if brotli is not None and "br" in accepted and os.path.exists(path(name + ".br")):
+        response = FileResponse(open(path(name + ".br"), "rb"), content_type=KINDS[kind])
+        response["Content-Encoding"] = "br"
+    elif "gzip" in accepted:
+        response = FileResponse(open(path(name + ".gz"), "rb"), content_type=KINDS[kind])
+        response["Content-Encoding"] = "gzip"
+    else:
+        response = FileResponse(open(path(name), "rb"), content_type=KINDS[kind])
+    response["Vary"] = "Accept-Encoding"
+    response["ETag"] = etag
+    return response
+
+
+def live_response(request, kind):
+    """
+    The entries of the snapshot file of kind rendered from the database, while the snapshot is being rebuilt
+    """
+    rows = RowSerializer(UC2Serializer(context={"request": SnapshotRequest(base_url_of(request))}))
+    queryset = rows.values(visible_observations(AnonymousUser()).order_by("id"))
+    if kind == "ndjson":
+        chunks = ndjson_chunks(rows, queryset)
+    else:
+        chunks = json_list(item for chunk in rows.chunks(queryset, STREAM_CHUNK_SIZE) for item in rows.render(chunk))
+    return StreamingHttpResponse(buffered(chunks), content_type=KINDS[kind])
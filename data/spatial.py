@@ -0,0 +1,110 @@
+"""
+Bounding box queries over UC2Observation.
+
+The bounding rectangles in lon / lat and in UTM are indexed with an R*Tree on SQLite and a GiST index on PostgreSQL.
+The SQLite R*Tree tables are filled by triggers, so bulk inserts and updates outside the ORM stay in sync. The index
+only narrows the candidates, the exact comparison on the columns is always applied as well.
+"""
+from django.db import DEFAULT_DB_ALIAS, OperationalError, connection, connections
+from django.db.models import Q
+
+from .models import UC2Observation
+
+TABLE = UC2Observation._meta.db_table
+
+# name suffix and (west, east, south, north) columns of the two rectangles
+LON_LAT = ("bbox", ("ll_lon", "ur_lon", "ll_lat", "ur_lat"))
+UTM = ("bbox_utm", ("ll_e_utm", "ur_e_utm", "ll_n_utm", "ur_n_utm"))
+
+
+def rtree_table(system):
+    return "%s_%s" % (TABLE, system[0])
+
+
+def box_expression(system, table=TABLE):
+    west, east, south, north = system[1]
+    return "box(point({t}.{w}, {t}.{s}), point({t}.{e}, {t}.{n}))".format(
+        t=table, w=west, e=east, s=south, n=north)
+
+
+def install_spatial_index(using=DEFAULT_DB_ALIAS, **kwargs):
+    """
+    post_migrate receiver creating the bounding box indexes
+    """
+    conn = connections[using]
+    with conn.cursor() as cursor:
+        for system in (LON_LAT, UTM):
+            if conn.vendor == "sqlite":
+                try:
+                    cursor.execute(
+                        "CREATE VIRTUAL TABLE IF NOT EXISTS {rtree} USING rtree(id, min_x, max_x, min_y, max_y)"
+                        .format(rtree=rtree_table(system)))
+                except OperationalError:
+                    return  # SQLite without R*Tree, the filters compare the columns only
+                west, east, south, north = system[1]
+                # an R*Tree rejects rows with min > max, corners are sorted to never fail a save
+                row = "{p}.id, min({p}.{w}, {p}.{e}), max({p}.{w}, {p}.{e}), min({p}.{s}, {p}.{n}), " \
+                      "max({p}.{s}, {p}.{n})"
+                statements = [
+                    "CREATE TRIGGER IF NOT EXISTS {rtree}_ai AFTER INSERT ON {table} BEGIN "
+                    "INSERT OR REPLACE INTO {rtree} VALUES (%s); END" % row.replace("{p}", "new"),
+                    "CREATE TRIGGER IF NOT EXISTS {rtree}_au AFTER UPDATE OF {w}, {e}, {s}, {n} ON {table} BEGIN "
+                    "INSERT OR REPLACE INTO {rtree} VALUES (%s); END" % row.replace("{p}", "new"),
+                    "CREATE TRIGGER IF NOT EXISTS {rtree}_ad AFTER DELETE ON {table} BEGIN "
+                    "DELETE FROM {rtree} WHERE id = old.id; END",
+                    "INSERT OR REPLACE INTO {rtree} SELECT %s FROM {table}" % row.replace("{p}", "{table}"),
+                ]
+                for statement in statements:
+                    cursor.execute(statement.format(
+                        rtree=rtree_table(system), table=TABLE, w=west, e=east, s=south, n=north))
+            elif conn.vendor == "postgresql":
+                cursor.execute("CREATE INDEX IF NOT EXISTS {index} ON {table} USING gist (({box}))".format(
+                    index=rtree_table(system) + "_gist", table=TABLE, box=box_expression(system, TABLE)))
+
+
+_rtree_tables = set()
+
+
+def has_rtree_table():
+    # only a positive answer is remembered, the table may be created by a later migrate
+    if connection.alias not in _rtree_tables and rtree_table(UTM) in connection.introspection.table_names():
+        _rtree_tables.add(connection.alias)
+    return connection.alias in _rtree_tables
+
+
+def bbox_condition(box, within=False, utm=False):
+    """
+    The exact comparison on the columns, without any index
+    """
+    west, south, east, north = box
+    columns = (UTM if utm else LON_LAT)[1]
+    if within:
+        return Q(**{columns[0] + "__gte": west, columns[1] + "__lte": east,
+                    columns[2] + "__gte": south, columns[3] + "__lte": north})
+    return Q(**{columns[0] + "__lte": east, columns[1] + "__gte": west,
+                columns[2] + "__lte": north, columns[3] + "__gte": south})
+
+
+def filter_bbox(queryset, box, within=False, utm=False):
+    """
+    Observations whose bounding rectangle intersects or lies within box
+    :param box: (west, south, east, north), in lon / lat or in UTM metres if utm is set
+    """
+    system = UTM if utm else LON_LAT
+    west, south, east, north = box
+    queryset = queryset.filter(bbox_condition(box, within, utm))
+
+    if connection.vendor == "postgresql":
+        operator = "<@" if within else "&&"
+        return queryset.extra(where=["{box} {op} box(point(%s, %s), point(%s, %s))".format(
+            box=box_expression(system), op=operator)], params=[west, south, east, north])
+
+    if connection.vendor == "sqlite" and has_rtree_table():
+        # the R*Tree stores 32 bit floats rounded outwards, so it only preselects everything intersecting the box,
+        # which includes everything within it
+        return queryset.extra(where=[
+            "{table}.id IN (SELECT id FROM {rtree} WHERE min_x <= %s AND max_x >= %s AND min_y <= %s AND max_y >= %s)"
+            .format(table=TABLE, rtree=rtree_table(system))
+        ], params=[east, west, north, south])
+
+    return queryset
@@ -0,0 +1,142 @@
+import hashlib
+import os
+import tempfile
+
+from django.apps import apps
+from django.core.files.storage import FileSystemStorage
+from django.db import transaction
+from django.utils.deconstruct import deconstructible
+
+SHARD_DEPTH = 2
+SHARD_WIDTH = 2
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def file_digest(content, chunk_size=HASH_CHUNK_SIZE):
+    """
+    sha256 of a django File or a plain binary file object. The read position is reset afterwards.
+    """
+    sha = hashlib.sha256()
+    if hasattr(content, 'seek'):
+        content.seek(0)
+    if hasattr(content, 'chunks'):
+        chunks = content.chunks(chunk_size)
+    else:
+        chunks = iter(lambda: content.read(chunk_size), b'')
+    for chunk in chunks:
+        sha.update(chunk)
+    if hasattr(content, 'seek'):
+        content.seek(0)
+    return sha.hexdigest()
+
+
+def sharded_name(digest, original_name=''):
+    """
+    ab/cd/abcd....nc -> the extension of the original name is kept so the files stay recognizable on disk
+    """
+    shards = [digest[i * SHARD_WIDTH:(i + 1) * SHARD_WIDTH] for i in range(SHARD_DEPTH)]
+    ext = os.path.splitext(original_name)[1]
+    return '/'.join(shards + [digest + ext])
+
+
+def is_sharded_name(name):
+    parts = name.split('/')
+    if len(parts) != SHARD_DEPTH + 1:
+        return False
+    digest = os.path.splitext(parts[-1])[0]
+    return len(digest) == 64 and sharded_name(digest, parts[-1]) == name
+
+
+@deconstructible
+class ContentAddressedStorage(FileSystemStorage):
+    """
+    Stores every file under the sha256 of its content in hash sharded directories.
+
+    Identical content is written only once. Every save acquires a reference on the matching StoredBlob row and
+    the file is only removed from disk by release() once the last reference is gone. The reference is part of the
+    caller's transaction, so the row pointing to the file has to be saved in the same atomic block.
+    """
+
+    def get_available_name(self, name, max_length=None):
+        # the final name is derived from the content in _save. Collisions mean identical content.
+        return name
+
+    def _save(self, name, content):
+        staging_dir = self.path('.staging')
+        os.makedirs(staging_dir, exist_ok=True)
+
+        sha = hashlib.sha256()
+        size = 0
+        fd, tmp_path = tempfile.mkstemp(dir=staging_dir)
+        try:
+            with os.fdopen(fd, 'wb') as tmp:
+                content.seek(0)
+                for chunk in content.chunks():
+                    sha.update(chunk)
+                    size += len(chunk)
+                    tmp.write(chunk)
+            if self.file_permissions_mode is not None:
+                os.chmod(tmp_path, self.file_permissions_mode)
+
+            digest = sha.hexdigest()
+            name = sharded_name(digest, name)
+            self._acquire(name, digest, size, tmp_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return name
+
+    def _acquire(self, name, digest, size, tmp_path):
+        StoredBlob = apps.get_model('data', 'StoredBlob')
+        with transaction.atomic():
+            blob, created = StoredBlob.objects.select_for_update().get_or_create(
+                checksum=digest, defaults={'name': name, 'size': size}
+            )
+            # the row lock serializes us against release(). Once we hold it the file is either on disk or
+            # was garbage collected, in which case the fresh copy is moved in. If the caller's transaction rolls
+            # back, the file stays without StoredBlob, scrub_files --delete-orphans removes it.
+            if not self.exists(name):
+                full_path = self.path(name)
+                os.makedirs(os.path.dirname(full_path), exist_ok=True)
+                os.replace(tmp_path, full_path)
+            if blob.tier == blob.COLD:
+                # new uploads of retired content bring it back to the hot tier
+                blob.remove_cold_copy()
+                blob.tier = blob.HOT
+                blob.codec = ''
+                blob.stored_size = None
+            blob.ref_count += 1
+            blob.save()
+
+    def acquire_existing(self, name):
+        """
+        Register one more reference for a file that is already content addressed
+        """
+        StoredBlob = apps.get_model('data', 'StoredBlob')
+        with transaction.atomic():
+            blob = StoredBlob.objects.select_for_update().get(name=name)
+            blob.ref_count += 1
+            blob.save(update_fields=['ref_count'])
+
+    def release(self, name):
+        """
+        Drop one reference and delete the file if it was the last one
+        :return: True if the file was removed
+        """
+        StoredBlob = apps.get_model('data', 'StoredBlob')
+        with transaction.atomic():
+            try:
+                blob = StoredBlob.objects.select_for_update().get(name=name)
+            except StoredBlob.DoesNotExist:
+                return False
+            blob.ref_count -= 1
+            if blob.ref_count > 0:
+                blob.save(update_fields=['ref_count'])
+                return False
+            blob.delete()
+            blob.remove_cold_copy()
+            self.delete(name)
+        return True
+
+
+content_addressed_storage = ContentAddressedStorage()
@@ -0,0 +1,108 @@
+"""
+JSON list responses written row by row.
+
+Rows are encoded with orjson if it is installed, else with the json module and DRF's encoder. The body of a streamed
+list is never held in memory as a whole, see RowListMixin.
+"""
+import json
+import zlib
+
+from django.conf import settings
+from django.http import StreamingHttpResponse
+from rest_framework.utils.encoders import JSONEncoder
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+_encoder = JSONEncoder(ensure_ascii=False, separators=(",", ":"))
+# bytes written to the response at once
+BUFFER_SIZE = 64 * 1024
+# gzip level of compressed streams, the fastest keeps up with the rendering
+GZIP_LEVEL = 1
+
+
+def dumps(value):
+    """
+    :return: value as compact JSON bytes
+    """
+    if orjson is not None:
+        return orjson.dumps(value, default=_encoder.default)
+    return _encoder.encode(value).encode("utf-8")
+
+
+def should_stream(request, limit):
+    """
+    JSON lists are streamed if limit is at least FILE_STREAM_MIN_ROWS, lists without limit on request with ?stream=1
+    """
+    if getattr(request, "accepted_renderer", None) is None or request.accepted_renderer.format != "json":
+        return False
+    if limit is None:
+        return request.query_params.get("stream", "").lower() in ("1", "true", "yes")
+    return limit >= settings.FILE_STREAM_MIN_ROWS
+
+
+def json_list(items):
+    """
+    :param items: iterable of JSON values
+    :return: generator of the bytes of a JSON array of the items
+    """
+    yield b"["
+    first = True
+    for item in items:
+        if not first:
+            yield b","
+        first = False
+        yield dumps(item)
+    yield b"]"
+
+
+def json_envelope(head, results, tail):
+    """
+    :param head: keys before the results
+    :param results: iterable of the result rows
+    :param tail: function called once all rows are written, returns the keys after the results
+    :return: generator of the bytes of {**head, "results": [...], **tail()}
+    """
+    yield b"{"
+    for key, value in head.items():
+        yield dumps(key) + b":" + dumps(value) + b","
+    yield b'"results":'
+    yield from json_list(results)
+    for key, value in tail().items():
+        yield b"," + dumps(key) + b":" + dumps(value)
+    yield b"}"
+
+
+def buffered(chunks, size=BUFFER_SIZE):
+    """
+    Join the small pieces of chunks into blocks of about size bytes
+    """
+    buffer = []
+    length = 0
+    for chunk in chunks:
+        buffer.append(chunk)
+        length += len(chunk)
+        if length >= size:
+            yield b"".join(buffer)
+            buffer = []
+            length = 0
+    if buffer:
+        yield b"".join(buffer)
+
+
+def gzipped(chunks, level=GZIP_LEVEL):
+    """
+    :return: generator of the gzip stream of the bytes in chunks
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def streaming_json_response(chunks):
+    return StreamingHttpResponse(buffered(chunks), content_type="application/json")
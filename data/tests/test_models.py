@@ -5,7 +5,203 @@ from mixer.backend.django import mixer
 pytestmark = pytest.mark.django_db
 
 
+@pytest.fixture(autouse=True)
+def media_root(settings, tmp_path):
+    """
+    Stores the files mixer blends for UC2Observation in a temporary MEDIA_ROOT
+    """
+    settings.MEDIA_ROOT = str(tmp_path)
+
+
 class TestUC2Observation:
     def test_model(self):
         obj = mixer.blend('data.UC2Observation')
         assert obj.pk == 1, 'Should save an instance'
+
+
+@pytest.fixture
+def licences():
+    from django.contrib.auth.models import Permission
+    from data.models import License
+    permission = Permission.objects.get(codename='view_uc2observation')
+    public = License.objects.create(short_name='open', full_text='open licence', public=True,
+                                    view_permission=permission)
+    restricted = License.objects.create(short_name='restricted', full_text='restricted licence',
+                                        view_permission=permission)
+    return public, restricted
+
+
+class TestLicenceVisibility:
+
+    def test_matches_guardian(self, licences):
+        from django.contrib.auth.models import AnonymousUser, Group
+        from django.core.management import call_command
+        from auth.models import User
+        from data.licences import licence_cache
+        from data.visibility import assign_view_permissions, guardian_observations, index_observations
+
+        public, restricted = licences
+        restricted.view_groups.add(Group.objects.get(name='restricted'))
+        for i in range(6):
+            licence = public if i % 2 else restricted
+            obj = mixer.blend('data.UC2Observation', licence=licence)
+            assign_view_permissions(licence_cache.get(short_name=licence.short_name), obj)
+
+        member = User.objects.create_user('member', email='m@baa.de', password='xxx', is_active=True)
+        member.groups.add(Group.objects.get(name='restricted'))
+        outsider = User.objects.create_user('outsider', email='o@baa.de', password='xxx', is_active=True)
+
+        for user, expected in [(AnonymousUser(), 3), (member, 6), (outsider, 3)]:
+            by_index = set(index_observations(user).values_list('id', flat=True))
+            by_guardian = set(guardian_observations(user).values_list('id', flat=True))
+            assert by_index == by_guardian
+            assert len(by_index) == expected
+        call_command('check_visibility')
+
+    def test_follows_licence_changes(self, licences):
+        from django.contrib.auth.models import Group
+        from data.models import LicenceVisibility
+
+        public, restricted = licences
+        group = Group.objects.create(name='partner')
+        assert set(LicenceVisibility.objects.filter(licence=public).values_list('anonymous', flat=True)) == {
+            True, False}
+
+        restricted.view_groups.add(group)
+        assert LicenceVisibility.objects.filter(licence=restricted, group=group).exists()
+        group.license_set.remove(restricted)
+        assert not LicenceVisibility.objects.filter(licence=restricted, group=group).exists()
+
+        restricted.public = True
+        restricted.save()
+        assert LicenceVisibility.objects.filter(licence=restricted, anonymous=True).exists()
+
+    def test_filled_for_existing_licences(self, licences):
+        from django.apps import apps
+        from django.contrib.auth.models import AnonymousUser, Group
+        from django.core.management import call_command
+        from data.licences import licence_cache
+        from data.models import LicenceVisibility
+        from data.visibility import assign_view_permissions, install_visibility_index, visible_observations
+
+        public, restricted = licences
+        restricted.view_groups.add(Group.objects.get(name='restricted'))
+        obj = mixer.blend('data.UC2Observation', licence=public)
+        assign_view_permissions(licence_cache.get(short_name=public.short_name), obj)
+        expected = set(LicenceVisibility.objects.values_list('licence', 'group', 'anonymous'))
+        # licences created before the index existed
+        LicenceVisibility.objects.all().delete()
+        assert not visible_observations(AnonymousUser()).exists()
+
+        install_visibility_index(app_config=apps.get_app_config('data'))
+        assert set(LicenceVisibility.objects.values_list('licence', 'group', 'anonymous')) == expected
+        assert visible_observations(AnonymousUser()).count() == 1
+
+        LicenceVisibility.objects.filter(licence=restricted).delete()
+        call_command('check_visibility', '--repair')
+        assert set(LicenceVisibility.objects.values_list('licence', 'group', 'anonymous')) == expected
+
+
+class TestObjectPermissions:
+
+    def test_direct_foreign_key_tables(self):
+        from django.contrib.auth.models import Group
+        from guardian.models import GroupObjectPermission
+        from guardian.shortcuts import assign_perm
+        from data.models import UC2ObservationGroupObjectPermission
+
+        group = Group.objects.create(name='partner')
+        obj = mixer.blend('data.UC2Observation')
+        assign_perm('data.view_uc2observation', group, obj)
+        assert UC2ObservationGroupObjectPermission.objects.filter(content_object=obj, group=group).exists()
+        assert not GroupObjectPermission.objects.exists()
+
+        obj.delete()
+        assert not UC2ObservationGroupObjectPermission.objects.exists(), 'Permissions are deleted with the file'
+
+    def test_migrate_and_purge(self):
+        from django.contrib.auth.models import Group, Permission
+        from django.contrib.contenttypes.models import ContentType
+        from django.core.management import call_command
+        from guardian.models import GroupObjectPermission
+        from guardian.shortcuts import get_objects_for_user
+        from auth.models import User
+        from data.models import UC2Observation, UC2ObservationGroupObjectPermission
+
+        group = Group.objects.create(name='partner')
+        user = User.objects.create_user('member', email='m@baa.de', password='xxx', is_active=True)
+        user.groups.add(group)
+        permission = Permission.objects.get(codename='view_uc2observation')
+        content_type = ContentType.objects.get_for_model(UC2Observation)
+        obj = mixer.blend('data.UC2Observation')
+        # bulk_create skips guardian's check that the object exists
+        GroupObjectPermission.objects.bulk_create([
+            GroupObjectPermission(group=group, permission=permission, content_type=content_type,
+                                  object_pk=str(obj.pk)),
+            GroupObjectPermission(group=group, permission=permission, content_type=content_type, object_pk='9999'),
+            GroupObjectPermission(group=group, permission=Permission.objects.get(codename='view_group'),
+                                  content_type=ContentType.objects.get_for_model(Group), object_pk='9999'),
+        ])
+
+        call_command('migrate_object_permissions')
+        assert UC2ObservationGroupObjectPermission.objects.filter(content_object=obj, group=group).exists()
+        assert list(get_objects_for_user(user, 'data.view_uc2observation')) == [obj]
+        assert GroupObjectPermission.objects.count() == 1
+
+        call_command('purge_orphan_permissions')
+        assert not GroupObjectPermission.objects.exists()
+
+
+class TestLicenceCache:
+
+    def test_signals_invalidate(self, licences):
+        from django.contrib.auth.models import Group
+        from data.licences import licence_cache
+        from data.models import License
+
+        public, restricted = licences
+        assert licence_cache.get(full_text='open licence').public
+        assert licence_cache.get(short_name='restricted').view_groups == ()
+        with pytest.raises(License.DoesNotExist):
+            licence_cache.get(short_name='unknown')
+
+        group = Group.objects.create(name='partner')
+        restricted.view_groups.add(group)
+        assert licence_cache.get(short_name='restricted').view_groups == (group,)
+
+        public.delete()
+        with pytest.raises(License.DoesNotExist):
+            licence_cache.get(short_name='open')
+
+    def test_deleted_group(self, licences):
+        from django.contrib.auth.models import Group
+        from data.licences import LicenceCache, licence_cache
+        from data.models import Generation
+
+        public, restricted = licences
+        group = Group.objects.create(name='partner')
+        restricted.view_groups.add(group)
+        worker = LicenceCache(check_interval=0)
+        assert licence_cache.get(short_name='restricted').view_groups == (group,)
+        assert worker.get(short_name='restricted').view_groups == (group,)
+        generation = Generation.current('license').value
+
+        group.delete()  # drops the m2m rows without m2m_changed
+        assert licence_cache.get(short_name='restricted').view_groups == ()
+        assert Generation.current('license').value > generation
+        assert worker.get(short_name='restricted').view_groups == ()
+
+    def test_generation_keeps_workers_coherent(self, licences, django_assert_num_queries):
+        from data.licences import LicenceCache
+        from data.models import Generation, License
+
+        worker = LicenceCache(check_interval=3600)
+        assert not worker.get(short_name='restricted').public
+        with django_assert_num_queries(0):
+            worker.get(short_name='open')
+
+        # another worker changes the licence, only the shared counter tells
+        License.objects.filter(short_name='restricted').update(public=True)
+        Generation.bump('license')
+        worker.check_interval = 0
+        assert worker.get(short_name='restricted').public
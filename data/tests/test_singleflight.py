@@ -0,0 +1,95 @@
+# test_singleflight.py
+
+import threading
+import time
+
+import pytest
+from django.core.cache import cache
+
+from data.singleflight import SingleFlight
+
+
+@pytest.fixture
+def flight(settings):
+    settings.SINGLE_FLIGHT_WAIT = 5
+    settings.SINGLE_FLIGHT_POLL = 0.01
+    cache.clear()
+    yield SingleFlight("test")
+    cache.clear()
+
+
+class SlowComputation:
+    def __init__(self, value="result", seconds=0.2):
+        self.value = value
+        self.seconds = seconds
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        time.sleep(self.seconds)
+        return self.value
+
+
+def in_threads(n, target):
+    results = [None] * n
+    start = threading.Barrier(n)
+
+    def run(i):
+        start.wait()
+        results[i] = target()
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(n)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+class TestSingleFlight:
+
+    def test_concurrent_calls_computed_once(self, flight):
+        compute = SlowComputation()
+        results = in_threads(8, lambda: flight.cached("key", compute, 60))
+        assert results == ["result"] * 8
+        assert compute.calls == 1
+        assert flight.counters() == (1, 7)
+        assert flight.cached("key", compute, 60) == "result"
+        assert compute.calls == 1, 'Should be cached'
+
+    def test_keys_computed_separately(self, flight):
+        compute = SlowComputation(seconds=0.05)
+        in_threads(4, lambda: flight.cached("a", compute, 60))
+        in_threads(4, lambda: flight.cached("b", compute, 60))
+        assert compute.calls == 2
+
+    def test_waits_for_other_process(self, flight):
+        cache.add("key:lock", 1)  # held by another worker
+
+        def other_worker():
+            time.sleep(0.1)
+            cache.set("key", "theirs")
+            cache.delete("key:lock")
+        threading.Thread(target=other_worker).start()
+        compute = SlowComputation()
+        assert flight.cached("key", compute, 60) == "theirs"
+        assert compute.calls == 0
+        assert flight.counters().coalesced == 1
+
+    def test_computes_if_other_process_failed(self, flight):
+        cache.add("key:lock", 1)
+        threading.Timer(0.05, cache.delete, args=("key:lock",)).start()
+        compute = SlowComputation(seconds=0)
+        assert flight.cached("key", compute, 60) == "result"
+        assert compute.calls == 1
+
+    def test_uncached_result_not_shared(self, flight):
+        calls = []
+
+        def compute():
+            calls.append(1)
+            time.sleep(0.1)
+            return None
+        results = in_threads(3, lambda: flight.run("key", compute))
+        assert results == [None] * 3
+        assert len(calls) == 1, 'Waiting callers get None and compute on their own'
+        assert flight.counters().coalesced == 0
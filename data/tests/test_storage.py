@@ -0,0 +1,204 @@
+# test_storage.py
+
+import io
+import os
+import tempfile
+from datetime import timedelta
+
+from django.core.files.base import ContentFile
+from django.core.management import call_command
+from django.db import IntegrityError, transaction
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from mixer.backend.django import mixer
+
+from data import snapshot, tiering
+from data.models import StoredBlob, UC2Observation
+from data.storage import content_addressed_storage, is_sharded_name
+
+
+class StorageTestCase(TestCase):
+
+    def setUp(self):
+        self.media_root = tempfile.TemporaryDirectory()
+        self.settings_override = override_settings(
+            MEDIA_ROOT=os.path.join(self.media_root.name, 'hot'),
+            COLD_STORAGE_ROOT=os.path.join(self.media_root.name, 'cold'),
+        )
+        self.settings_override.enable()
+
+    def tearDown(self):
+        self.settings_override.disable()
+        self.media_root.cleanup()
+
+
+class TestContentAddressedStorage(StorageTestCase):
+
+    def test_identical_content_is_stored_once(self):
+        name_1 = content_addressed_storage.save('a.nc', ContentFile(b'same payload'))
+        name_2 = content_addressed_storage.save('b.nc', ContentFile(b'same payload'))
+        name_3 = content_addressed_storage.save('c.nc', ContentFile(b'other payload'))
+
+        self.assertEqual(name_1, name_2)
+        self.assertNotEqual(name_1, name_3)
+        self.assertTrue(is_sharded_name(name_1))
+        self.assertTrue(name_1.endswith('.nc'))
+        self.assertEqual(StoredBlob.objects.get(name=name_1).ref_count, 2)
+
+    def test_failed_insert_takes_no_reference(self):
+        existing = mixer.blend(UC2Observation, file=ContentFile(b'payload', name='a.nc'))
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            mixer.blend(UC2Observation, file=ContentFile(b'payload', name='b.nc'),
+                        file_standard_name=existing.file_standard_name)
+        self.assertEqual(StoredBlob.objects.get(name=existing.file.name).ref_count, 1)
+
+    def test_release_removes_last_reference_only(self):
+        name = content_addressed_storage.save('a.nc', ContentFile(b'payload'))
+        content_addressed_storage.save('b.nc', ContentFile(b'payload'))
+
+        self.assertFalse(content_addressed_storage.release(name))
+        self.assertTrue(content_addressed_storage.exists(name))
+
+        self.assertTrue(content_addressed_storage.release(name))
+        self.assertFalse(content_addressed_storage.exists(name))
+        self.assertFalse(StoredBlob.objects.filter(name=name).exists())
+
+    def test_migrate_file_storage(self):
+        os.makedirs(content_addressed_storage.location)
+        for legacy_name in ['old_1.nc', 'old_2.nc']:
+            with open(content_addressed_storage.path(legacy_name), 'wb') as f:
+                f.write(b'legacy payload')
+        obj_1 = mixer.blend(UC2Observation, file='old_1.nc')
+        obj_2 = mixer.blend(UC2Observation, file='old_2.nc')
+
+        call_command('migrate_file_storage', stdout=io.StringIO())
+
+        obj_1.refresh_from_db()
+        obj_2.refresh_from_db()
+        self.assertTrue(is_sharded_name(obj_1.file.name))
+        self.assertEqual(obj_1.file.name, obj_2.file.name)
+        self.assertEqual(StoredBlob.objects.get(name=obj_1.file.name).ref_count, 2)
+        self.assertFalse(content_addressed_storage.exists('old_1.nc'))
+        with obj_1.file.open('rb') as f:
+            self.assertEqual(f.read(), b'legacy payload')
+
+
+class TestColdTier(StorageTestCase):
+
+    def _observation(self, payload, **kwargs):
+        name = content_addressed_storage.save('a.nc', ContentFile(payload))
+        obj = mixer.blend(UC2Observation, file=name, **kwargs)
+        UC2Observation.objects.filter(pk=obj.pk).update(upload_date=timezone.now() - timedelta(days=10))
+        return obj
+
+    def test_only_retired_files_are_moved(self):
+        payload = b'old netcdf payload ' * 1000
+        old = self._observation(payload, is_old=True)
+        current = self._observation(b'current payload', is_old=False, is_invalid=False)
+
+        call_command('tier_files', '--days', '5', '--codec', StoredBlob.GZIP, stdout=io.StringIO())
+
+        blob = StoredBlob.objects.get(name=old.file.name)
+        self.assertEqual(blob.tier, StoredBlob.COLD)
+        self.assertGreater(blob.compression_ratio, 1)
+        self.assertFalse(content_addressed_storage.exists(blob.name))
+        self.assertEqual(b''.join(tiering.open_stream(blob)), payload)
+
+        self.assertEqual(StoredBlob.objects.get(name=current.file.name).tier, StoredBlob.HOT)
+
+    def test_shared_content_stays_hot(self):
+        payload = b'payload shared by two versions'
+        old = self._observation(payload, is_old=True)
+        self._observation(payload, is_old=False, is_invalid=False)
+
+        call_command('tier_files', '--days', '5', stdout=io.StringIO())
+
+        self.assertEqual(StoredBlob.objects.get(name=old.file.name).tier, StoredBlob.HOT)
+
+    def test_new_upload_rehydrates(self):
+        payload = b'retired payload'
+        old = self._observation(payload, is_old=True)
+        tiering.move_to_cold(StoredBlob.objects.get(name=old.file.name), codec=StoredBlob.GZIP)
+
+        content_addressed_storage.save('b.nc', ContentFile(payload))
+
+        blob = StoredBlob.objects.get(name=old.file.name)
+        self.assertEqual(blob.tier, StoredBlob.HOT)
+        self.assertEqual(blob.ref_count, 2)
+        self.assertTrue(content_addressed_storage.exists(blob.name))
+
+
+class TestScrubber(StorageTestCase):
+
+    def test_report(self):
+        names = [content_addressed_storage.save('a.nc', ContentFile(payload)) for payload in [b'1', b'2', b'3']]
+        for name in names:
+            mixer.blend(UC2Observation, file=name)
+        good, corrupted, missing = names
+        with open(content_addressed_storage.path(corrupted), 'wb') as f:
+            f.write(b'bit rot')
+        os.remove(content_addressed_storage.path(missing))
+        content_addressed_storage.save('orphan.nc', ContentFile(b'not referenced'))
+
+        out = io.StringIO()
+        call_command('scrub_files', '--rate', '0', stdout=out)
+
+        report = out.getvalue()
+        self.assertIn("Checked 4 files: 1 missing, 1 corrupted, 1 orphaned", report)
+        self.assertNotIn(good, report)
+        self.assertFalse(os.path.exists(os.path.join(content_addressed_storage.location, '.scrub_state.json')))
+
+    def test_garbled_cold_copy(self):
+        payloads = [os.urandom(1000) * 50, os.urandom(1000) * 50]
+        names = [content_addressed_storage.save('a.nc', ContentFile(payload)) for payload in payloads]
+        for name in names:
+            mixer.blend(UC2Observation, file=name)
+            tiering.move_to_cold(StoredBlob.objects.get(name=name), codec=StoredBlob.GZIP)
+        garbled, truncated = [StoredBlob.objects.get(name=name).cold_path() for name in names]
+        with open(garbled, 'r+b') as f:
+            f.seek(100)
+            f.write(b'\xff' * 200)
+        with open(truncated, 'r+b') as f:
+            f.truncate(os.path.getsize(truncated) // 2)
+
+        out = io.StringIO()
+        call_command('scrub_files', '--rate', '0', stdout=out)
+        report = out.getvalue()
+        self.assertIn("Checked 2 files: 0 missing, 2 corrupted", report)
+        self.assertIn("read error", report)
+
+    def test_snapshot_not_orphaned(self):
+        from data.benchmarks import Catalog
+        call_command('loaddata', 'groups_and_licenses.json', verbosity=0)
+        catalog = Catalog(3)
+        for obj in UC2Observation.objects.all():
+            obj.file = content_addressed_storage.save('a.nc', ContentFile(str(obj.pk).encode()))
+            obj.save()
+        snapshot_root = os.path.join(content_addressed_storage.location, 'snapshot')
+        with override_settings(FILE_SNAPSHOT_ROOT=snapshot_root):
+            snapshot.build('http://testserver/')
+            self.assertTrue(os.path.exists(os.path.join(snapshot_root, 'catalog.json.gz')))
+            out = io.StringIO()
+            call_command('scrub_files', '--rate', '0', stdout=out)
+        self.assertIn("Checked %s files: 0 missing, 0 corrupted, 0 orphaned" % catalog.n, out.getvalue())
+
+    def test_rolled_back_upload_removed(self):
+        try:
+            with transaction.atomic():
+                name = content_addressed_storage.save('a.nc', ContentFile(b'rolled back'))
+                raise RuntimeError
+        except RuntimeError:
+            pass
+        self.assertTrue(content_addressed_storage.exists(name))
+        self.assertFalse(StoredBlob.objects.filter(name=name).exists())
+
+        out = io.StringIO()
+        call_command('scrub_files', '--rate', '0', '--delete-orphans', stdout=out)
+        self.assertTrue(content_addressed_storage.exists(name), 'Too young, the upload may still be in progress')
+
+        old = (timezone.now() - timedelta(hours=2)).timestamp()
+        os.utime(content_addressed_storage.path(name), (old, old))
+        out = io.StringIO()
+        call_command('scrub_files', '--rate', '0', '--delete-orphans', stdout=out)
+        self.assertIn("no stored blob, removed", out.getvalue())
+        self.assertFalse(content_addressed_storage.exists(name))
@@ -7,7 +7,7 @@ from django.core.handlers.wsgi import WSGIRequest
 
 
 from rest_framework import status
-from rest_framework.test import APIRequestFactory, APITestCase
+from rest_framework.test import APIRequestFactory, APITestCase, APITransactionTestCase
 
 from data.models import *
 from auth.models import User
@@ -23,9 +23,28 @@ import uc2data
 from pathlib import Path
 import json
 
-from .. import views
+from .. import snapshot, views
 from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.core.files.base import ContentFile
+from django.db import connection, transaction
+from django.test import SimpleTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from mixer.backend.django import mixer
+from data.storage import content_addressed_storage
+from data.benchmarks import Catalog
+from data.filters import UC2Filter
+from django.http import QueryDict
+from django.utils.dateparse import parse_datetime
+from django.core.cache import cache, caches
+from unittest import mock
+from data.rows import RowSerializer
+from data.autocomplete import autocomplete
 import io
+import tempfile
+import csv
+import gzip
+import datetime
 
 
 def make_fixture(path, model_str, ignore_pk=True, ignore_fields=None, append=False):
@@ -49,7 +68,30 @@ def make_fixture(path, model_str, ignore_pk=True, ignore_fields=None, append=Fal
         json.dump(dc, f, indent=4, ensure_ascii=False)
 
 
-class TestFileView(APITestCase):
+class MediaRootMixin:
+    """
+    Stores the files saved by the tests, e.g. those mixer blends for UC2Observation, in a temporary MEDIA_ROOT
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.media_root = tempfile.TemporaryDirectory()
+        cls.media_root_override = override_settings(MEDIA_ROOT=cls.media_root.name)
+        cls.media_root_override.enable()
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        cls.media_root_override.disable()
+        cls.media_root.cleanup()
+
+
+class MediaRootTestCase(MediaRootMixin, APITestCase):
+    pass
+
+
+class TestFileView(MediaRootTestCase):
     file_dir = Path(__file__).parent / "test_files"
     fixtures = ['groups_and_licenses.json',
                 'data/tests/fixtures/institutions.json',
@@ -353,3 +395,1112 @@ class TestVariableView(APITestCase):
         update = list(Variable.objects.filter(long_name='albedo type classification'))
         self.assertEqual(len(update), 2)
         self.assertEqual(update[0].deprecated, True)
+
+
+class TestConditionalRequests(MediaRootTestCase):
+    fixtures = ['groups_and_licenses.json', 'data/tests/fixtures/institutions.json']
+
+    def setUp(self):
+        self.super_user = User.objects.create_superuser(username="TestUser", email="test@user.com", password="test")
+        self.client.force_login(self.super_user)
+
+    def test_file_list(self):
+        mixer.cycle(3).blend(UC2Observation)
+        url = reverse('file-list')
+        resp = self.client.get(url)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        etag = resp['ETag']
+        self.assertTrue(etag.startswith('W/'))
+
+        resp = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        resp = self.client.get(url, {'limit': 1}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK, "Another page has another ETag")
+
+        UC2Observation.objects.first().save()
+        resp = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK, "A modified entry changes the ETag")
+
+    def test_file_list_after_deletion(self):
+        mixer.cycle(3).blend(UC2Observation)
+        Generation.objects.update(changed=datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(hours=1))
+        url = reverse('file-list')
+        resp = self.client.get(url)
+        last_modified, etag = resp['Last-Modified'], resp['ETag']
+        resp = self.client.get(url, HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        UC2Observation.objects.first().delete()
+        resp = self.client.get(url, HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK, "A deletion advances Last-Modified")
+
+        resp = self.client.get(url)
+        etag = resp['ETag']
+        License.objects.get(short_name=UC2Observation.objects.first().licence.short_name).view_groups.add(
+            Group.objects.create(name='readers'))
+        resp = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK, "Changed licence groups change the ETag")
+
+    def test_file_download(self):
+        name = content_addressed_storage.save('a.nc', ContentFile(b'payload'))
+        obj = mixer.blend(UC2Observation, file=name)
+        url = reverse('file-detail', args=[obj.pk])
+        resp = self.client.get(url)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp['ETag'], '"%s"' % StoredBlob.objects.get(name=name).checksum)
+
+        resp = self.client.get(url, HTTP_IF_NONE_MATCH=resp['ETag'])
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        obj.refresh_from_db()
+        self.assertEqual(obj.download_count, 1, "A 304 is not a download")
+
+    def test_reference_list(self):
+        url = reverse('institution-list')
+        resp = self.client.get(url)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+
+        resp_2 = self.client.get(url, HTTP_IF_NONE_MATCH=resp['ETag'])
+        self.assertEqual(resp_2.status_code, status.HTTP_304_NOT_MODIFIED)
+        resp_2 = self.client.get(url, HTTP_IF_MODIFIED_SINCE=resp['Last-Modified'])
+        self.assertEqual(resp_2.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        Institution.objects.create(ge_title='Neu', en_title='New', acronym='NEW')
+        resp_2 = self.client.get(url, HTTP_IF_NONE_MATCH=resp['ETag'])
+        self.assertEqual(resp_2.status_code, status.HTTP_200_OK)
+
+
+class TestFileListQueries(MediaRootTestCase):
+    """
+    The number of queries of a list page must not grow with the page size
+    """
+    fixtures = ['groups_and_licenses.json']
+    max_queries = 8
+
+    def page_queries(self, rows, user_name):
+        catalog = Catalog(rows)
+        user = {'member': catalog.member, 'superuser': User.objects.create_superuser(
+            username="TestUser", email="test@user.com", password="test")}[user_name]
+        self.client.force_login(user)
+        url = reverse('file-list')
+        with CaptureQueriesContext(connection) as queries:
+            resp = self.client.get(url, {'limit': rows})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(resp.data['results']), rows)
+        self.assertEqual(len(resp.data['results'][0]['variables']), 3)
+        return len(queries)
+
+    def assert_constant(self, user_name):
+        counts = {}
+        for rows in [10, 100, 1000]:
+            sid = transaction.savepoint()
+            counts[rows] = self.page_queries(rows, user_name)
+            transaction.savepoint_rollback(sid)
+        self.assertEqual(len(set(counts.values())), 1, "Queries per page size: %s" % counts)
+        self.assertLessEqual(counts[10], self.max_queries)
+
+    def test_superuser(self):
+        self.assert_constant('superuser')
+
+    def test_member(self):
+        self.assert_constant('member')
+
+
+class TestSearch(MediaRootTestCase):
+    fixtures = ['groups_and_licenses.json']
+
+    def setUp(self):
+        self.super_user = User.objects.create_superuser(username="TestUser", email="test@user.com", password="test")
+        self.client.force_login(self.super_user)
+        self.site = mixer.blend(Site, site='bamberger', address='Bamberger Str. 1')
+        self.wind = mixer.blend(Variable, variable='ws', long_name='wind speed', standard_name='wind_speed')
+        self.temperature = mixer.blend(Variable, variable='ta', long_name='air temperature')
+        self.wind_file = mixer.blend(UC2Observation, site=self.site, keywords='wind tower')
+        self.wind_file.variables.add(self.wind)
+        self.other_file = mixer.blend(UC2Observation, keywords='roof', data_content='wind wind wind wind wind')
+        self.other_file.variables.add(self.temperature)
+
+    def search(self, term):
+        resp = self.client.get(reverse('file-list'), {'search': term})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        return [row['id'] for row in resp.data]
+
+    def test_related_columns(self):
+        self.assertEqual(self.search('bamberger'), [self.wind_file.pk])
+        self.assertEqual(self.search('temperature'), [self.other_file.pk])
+        self.assertEqual(self.search('speed tow'), [self.wind_file.pk], "Terms are word prefixes combined with and")
+        self.assertEqual(self.search('nothing'), [])
+
+    def test_ranking(self):
+        self.assertEqual(self.search('wind'), [self.other_file.pk, self.wind_file.pk])
+
+    def test_documents_filled_after_migrate(self):
+        from data.search import install_search_index
+        # files stored before the document existed
+        UC2Observation.objects.update(search_document='')
+        self.assertEqual(self.search('bamberger'), [])
+        install_search_index()
+        self.assertEqual(self.search('bamberger'), [self.wind_file.pk])
+        self.assertEqual(self.search('temperature'), [self.other_file.pk])
+
+    def test_document_follows_related_changes(self):
+        self.site.address = 'Hardenbergstr. 36'
+        self.site.save()
+        self.assertEqual(self.search('hardenbergstr'), [self.wind_file.pk])
+        self.assertEqual(self.search('Bamberger Str'), [])
+
+        self.wind_file.variables.remove(self.wind)
+        self.assertEqual(self.search('speed'), [])
+        self.wind.datasets.add(self.other_file)
+        self.assertEqual(self.search('speed'), [self.other_file.pk])
+
+
+class TestBoundingBox(MediaRootTestCase):
+    fixtures = ['groups_and_licenses.json']
+
+    def setUp(self):
+        self.super_user = User.objects.create_superuser(username="TestUser", email="test@user.com", password="test")
+        self.client.force_login(self.super_user)
+        self.berlin = mixer.blend(UC2Observation, ll_lon=13.3, ll_lat=52.4, ur_lon=13.5, ur_lat=52.6,
+                                  ll_e_utm=385000, ll_n_utm=5810000, ur_e_utm=398000, ur_n_utm=5830000)
+        self.stuttgart = mixer.blend(UC2Observation, ll_lon=9.1, ll_lat=48.7, ur_lon=9.3, ur_lat=48.8,
+                                     ll_e_utm=505000, ll_n_utm=5395000, ur_e_utm=520000, ur_n_utm=5406000)
+
+    def bbox(self, **params):
+        resp = self.client.get(reverse('file-list'), params)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        return sorted(row['id'] for row in resp.data)
+
+    def test_intersects(self):
+        self.assertEqual(self.bbox(bbox_intersects='13.4,52.5,14,53'), [self.berlin.pk])
+        self.assertEqual(self.bbox(bbox_intersects='5,45,15,55'), sorted([self.berlin.pk, self.stuttgart.pk]))
+        self.assertEqual(self.bbox(bbox_intersects='10,50,11,51'), [])
+        self.assertEqual(self.bbox(bbox_intersects='13.5,52.6,14,53'), [self.berlin.pk], "Touching counts")
+
+    def test_within(self):
+        self.assertEqual(self.bbox(bbox_within='13.4,52.5,14,53'), [])
+        self.assertEqual(self.bbox(bbox_within='13.3,52.4,13.5,52.6'), [self.berlin.pk])
+        self.assertEqual(self.bbox(bbox_within='9,48,10,49'), [self.stuttgart.pk])
+
+    def test_utm(self):
+        self.assertEqual(self.bbox(utm_bbox_intersects='390000,5800000,391000,5811000'), [self.berlin.pk])
+        self.assertEqual(self.bbox(utm_bbox_within='500000,5390000,520000,5406000'), [self.stuttgart.pk])
+
+    def test_index_follows_changes(self):
+        self.stuttgart.ll_lon, self.stuttgart.ur_lon = 13.35, 13.45
+        self.stuttgart.ll_lat, self.stuttgart.ur_lat = 52.45, 52.55
+        self.stuttgart.save()
+        self.assertEqual(self.bbox(bbox_within='13.3,52.4,13.5,52.6'), sorted([self.berlin.pk, self.stuttgart.pk]))
+        self.berlin.delete()
+        self.assertEqual(self.bbox(bbox_within='13.3,52.4,13.5,52.6'), [self.stuttgart.pk])
+
+    def test_bad_box(self):
+        resp = self.client.get(reverse('file-list'), {'bbox_intersects': '1,2,3'})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class TestKeysetPagination(MediaRootTestCase):
+    fixtures = ['groups_and_licenses.json']
+
+    def setUp(self):
+        self.super_user = User.objects.create_superuser(username="TestUser", email="test@user.com", password="test")
+        self.client.force_login(self.super_user)
+        self.files = mixer.cycle(7).blend(UC2Observation, keywords=mixer.sequence('wind', 'roof'))
+        # ties in upload_date are broken by id
+        UC2Observation.objects.filter(pk__in=[f.pk for f in self.files[2:5]]).update(
+            upload_date=self.files[2].upload_date)
+
+    def crawl(self, url, params):
+        ids = []
+        resp = self.client.get(url, params)
+        while True:
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            self.assertNotIn('count', resp.data)
+            ids.extend(row['id'] for row in resp.data['results'])
+            if resp.data['next'] is None:
+                return ids
+            resp = self.client.get(resp.data['next'])
+
+    def test_crawl(self):
+        expected = list(UC2Observation.objects.order_by('-upload_date', '-id').values_list('id', flat=True))
+        self.assertEqual(self.crawl(reverse('file-list'), {'pagination': 'cursor', 'limit': 3}), expected)
+        self.assertEqual(self.crawl(reverse('file-list'), {'pagination': 'cursor', 'limit': 7}), expected)
+
+    def test_filter_and_search(self):
+        expected = list(UC2Observation.objects.filter(keywords='wind').order_by('-upload_date', '-id')
+                        .values_list('id', flat=True))
+        self.assertEqual(
+            self.crawl(reverse('file-list'), {'pagination': 'cursor', 'limit': 2, 'keywords__icontains': 'wind'}),
+            expected)
+        self.assertEqual(self.crawl(reverse('file-list'), {'pagination': 'cursor', 'limit': 2, 'search': 'wind'}),
+                         expected)
+
+    def test_offset_unchanged(self):
+        resp = self.client.get(reverse('file-list'), {'limit': 3, 'offset': 3})
+        self.assertEqual(resp.data['count'], 7)
+        self.assertEqual(len(resp.data['results']), 3)
+        self.assertEqual(len(self.client.get(reverse('file-list')).data), 7)
+
+    def test_invalid_cursor(self):
+        resp = self.client.get(reverse('file-list'), {'cursor': 'garbage'})
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+
+class TestListFilter(MediaRootTestCase):
+    fixtures = ['groups_and_licenses.json']
+
+    def setUp(self):
+        self.super_user = User.objects.create_superuser(username="TestUser", email="test@user.com", password="test")
+        self.client.force_login(self.super_user)
+        self.institutions = mixer.cycle(10).blend(Institution, acronym=mixer.sequence("Inst{0}"))
+        self.wind = mixer.blend(Variable, variable='ws')
+        self.temperature = mixer.blend(Variable, variable='ta')
+        self.files = [
+            mixer.blend(UC2Observation, acronym=institution, campaign='IOP0%s' % (i % 3), data_content='wind')
+            for i, institution in enumerate(self.institutions)
+        ]
+        for f in self.files[:3]:
+            f.variables.add(self.wind, self.temperature)
+        self.files[3].variables.add(self.temperature)
+
+    def ids(self, **params):
+        resp = self.client.get(reverse('file-list'), params)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        return sorted(row['id'] for row in resp.data)
+
+    def test_acronyms(self):
+        self.assertEqual(self.ids(acronym='inst1, INST2,Inst1,'), [self.files[1].pk, self.files[2].pk])
+        self.assertEqual(self.ids(acronym='nst3,st4'), [self.files[3].pk, self.files[4].pk],
+                         "Partial acronyms match as before")
+        self.assertEqual(self.ids(acronym='Inst'), sorted(f.pk for f in self.files))
+
+    def test_one_query(self):
+        params = QueryDict(mutable=True)
+        params.update({'acronym': ','.join(i.acronym for i in self.institutions), 'campaign': 'IOP00,IOP01',
+                       'variables__variable': 'ws,ta', 'data_content': 'wind'})
+        with CaptureQueriesContext(connection) as ctx:
+            result = list(UC2Filter(params, queryset=UC2Observation.objects.all()).qs)
+        self.assertEqual(len(ctx.captured_queries), 1)
+        self.assertEqual(sorted(f.pk for f in result), [self.files[0].pk, self.files[1].pk, self.files[3].pk])
+
+    def test_variables_without_duplicates(self):
+        self.assertEqual(self.ids(variables__variable='ws,ta'), sorted(f.pk for f in self.files[:4]))
+
+    def test_site(self):
+        site = self.files[5].site
+        self.assertEqual(self.ids(site='%s,unknown' % site.site), [self.files[5].pk])
+
+
+class TestExplainQueries(SimpleTestCase):
+
+    def test_full_scans(self):
+        from data.management.commands.explain_queries import full_scans
+        table = UC2Observation._meta.db_table
+        self.assertEqual(full_scans('sqlite', "5 0 0 SCAN %s USING INDEX data_uc2obs_upload__2e8777_idx" % table),
+                         ["5 0 0 SCAN %s USING INDEX data_uc2obs_upload__2e8777_idx" % table], "Walked in index order")
+        self.assertTrue(full_scans('sqlite', "2 0 0 SCAN TABLE %s" % table))
+        self.assertEqual(full_scans('sqlite', "\n".join([
+            "5 0 0 SEARCH %s USING INDEX data_uc2obs_acronym_4d707a_idx (acronym_id=?)" % table,
+            "11 9 0 SCAN data_institution USING COVERING INDEX sqlite_autoindex_data_institution_3",
+        ])), [])
+        self.assertEqual(full_scans('sqlite', "5 0 0 SCAN %s USING INDEX data_uc2obs_current_idx" % table), [],
+                         "A partial index holds only the rows of its condition")
+
+        walk = "  ->  Index Scan Backward using data_uc2obs_upload__2e8777_idx on %s  (cost=0.29..1.00)" % table
+        self.assertTrue(full_scans('postgresql', "\n".join([walk, "        Filter: (acronym_id = ANY (...))"])))
+        self.assertEqual(full_scans('postgresql', "\n".join([
+            walk.replace("upload__2e8777", "acronym_4d707a"), "        Index Cond: (acronym_id = ANY (...))",
+        ])), [])
+        self.assertTrue(full_scans('postgresql', "  ->  Seq Scan on %s  (cost=0.00..1.00)" % table))
+
+
+class TestEstimatedCount(MediaRootTestCase):
+    fixtures = ['groups_and_licenses.json']
+
+    def setUp(self):
+        caches[settings.FILE_LIST_CACHE].clear()
+        self.super_user = User.objects.create_superuser(username="TestUser", email="test@user.com", password="test")
+        self.client.force_login(self.super_user)
+        self.files = mixer.cycle(5).blend(UC2Observation, keywords='wind')
+
+    def page(self, **params):
+        params.update(count='estimate')
+        resp = self.client.get(reverse('file-list'), params)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        return resp.data
+
+    def test_has_next(self):
+        data = self.page(limit=2, offset=2)
+        self.assertEqual((data['count'], data['count_exact'], data['has_next']), (5, True, True),
+                         "Small results are counted")
+        self.assertEqual(len(data['results']), 2)
+        self.assertIn('offset=4', data['next'])
+        data = self.page(limit=2, offset=4)
+        self.assertEqual((len(data['results']), data['has_next'], data['next']), (1, False, None))
+
+    def test_cached(self):
+        self.page(limit=2)
+        with CaptureQueriesContext(connection) as ctx:
+            self.assertEqual(self.page(limit=2, offset=2)['count'], 5)
+        self.assertFalse([q for q in ctx.captured_queries if 'COUNT' in q['sql']], "Other pages reuse the count")
+        self.assertEqual(self.page(limit=2, keywords__icontains='roof')['count'], 0, "Counted per filter")
+
+    @override_settings(FILE_COUNT_ESTIMATE_THRESHOLD=1000)
+    def test_planner_estimate(self):
+        with mock.patch('data.counts.connection', vendor='postgresql'), \
+                mock.patch('data.counts.planner_estimate', return_value=250000):
+            data = self.page(limit=2)
+        self.assertEqual((data['count'], data['count_exact']), (250000, False))
+        caches[settings.FILE_LIST_CACHE].clear()
+        with mock.patch('data.counts.connection', vendor='postgresql'), \
+                mock.patch('data.counts.planner_estimate', return_value=20):
+            data = self.page(limit=2)
+        self.assertEqual((data['count'], data['count_exact']), (5, True), "Small estimates are counted")
+
+    def test_invalidated_by_uploads_and_deletes(self):
+        self.assertEqual(self.page(limit=2)['count'], 5)
+        mixer.blend(UC2Observation)
+        self.assertEqual(self.page(limit=2)['count'], 6)
+        self.files[0].delete()
+        self.assertEqual(self.page(limit=2)['count'], 5)
+        self.files[1].download_count += 1
+        self.files[1].save(update_fields=['download_count', 'last_modified'])
+        with CaptureQueriesContext(connection) as ctx:
+            self.page(limit=2)
+        self.assertFalse([q for q in ctx.captured_queries if 'COUNT' in q['sql']], "Downloads keep the count")
+
+    def test_invalidated_by_licence_changes(self):
+        self.client.logout()
+        restricted = License.objects.filter(public=False).first()
+        UC2Observation.objects.filter(pk=self.files[0].pk).update(licence=restricted)
+        visible = UC2Observation.objects.filter(licence__public=True).count()
+        self.assertEqual(self.page(limit=2)['count'], visible)
+        restricted.public = True
+        restricted.save()
+        self.assertEqual(self.page(limit=2)['count'], UC2Observation.objects.filter(licence__public=True).count())
+
+
+class TestFacets(MediaRootTestCase):
+    fixtures = ['groups_and_licenses.json']
+
+    def setUp(self):
+        caches[settings.FILE_LIST_CACHE].clear()
+        self.super_user = User.objects.create_superuser(username="TestUser", email="test@user.com", password="test")
+        self.client.force_login(self.super_user)
+        self.site = mixer.blend(Site, site='bamberger')
+        self.wind = mixer.blend(Variable, variable='ws')
+        self.files = [
+            mixer.blend(UC2Observation, site=self.site, campaign='LTO', keywords='wind',
+                        creation_time=datetime.datetime(2019, 5, 1, tzinfo=datetime.timezone.utc)),
+            mixer.blend(UC2Observation, site=self.site, campaign='LTO', keywords='wind',
+                        creation_time=datetime.datetime(2020, 5, 1, tzinfo=datetime.timezone.utc)),
+            mixer.blend(UC2Observation, campaign='IOP01', keywords='roof',
+                        creation_time=datetime.datetime(2020, 6, 1, tzinfo=datetime.timezone.utc)),
+        ]
+        self.files[0].variables.add(self.wind)
+
+    def facets(self, **params):
+        resp = self.client.get(reverse('file-facets'), params)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        return resp.data
+
+    def test_counts(self):
+        facets = self.facets()
+        self.assertEqual(facets['campaign'], [{'value': 'LTO', 'count': 2}, {'value': 'IOP01', 'count': 1}])
+        self.assertEqual(facets['site'][0], {'value': 'bamberger', 'count': 2})
+        self.assertEqual(facets['variable'], [{'value': 'ws', 'count': 1}])
+        self.assertEqual(facets['year'], [{'value': 2019, 'count': 1}, {'value': 2020, 'count': 2}])
+        self.assertEqual(sum(row['count'] for row in facets['institution']), 3)
+
+    def test_filtered(self):
+        self.assertEqual(self.facets(keywords__icontains='wind')['campaign'], [{'value': 'LTO', 'count': 2}])
+        self.assertEqual(self.facets(search='roof')['campaign'], [{'value': 'IOP01', 'count': 1}])
+
+    def test_visibility(self):
+        self.client.logout()
+        public = sum(row['count'] for row in self.facets()['campaign'])
+        self.assertEqual(public, UC2Observation.objects.filter(licence__public=True).count())
+
+    def test_cached_until_ingestion(self):
+        self.facets()
+        with CaptureQueriesContext(connection) as ctx:
+            self.facets()
+        self.assertFalse([q for q in ctx.captured_queries if 'GROUP BY' in q['sql']])
+        mixer.blend(UC2Observation, campaign='LTO')
+        self.assertEqual(self.facets()['campaign'][0], {'value': 'LTO', 'count': 3})
+
+    def test_flight_counters(self):
+        self.facets()
+        self.facets(campaign='LTO')
+        resp = self.client.get(reverse('file-flights'))
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.data['facets'], {'computed': 2, 'coalesced': 0})
+        self.assertIn('file-list', resp.data)
+
+        self.client.logout()
+        resp = self.client.get(reverse('file-flights'))
+        self.assertIn(resp.status_code, [status.HTTP_401_UNAUTHORIZED, status.HTTP_403_FORBIDDEN])
+
+
+class TestSparseFields(MediaRootTestCase):
+    fixtures = ['groups_and_licenses.json']
+
+    def setUp(self):
+        self.super_user = User.objects.create_superuser(username="TestUser", email="test@user.com", password="test")
+        self.client.force_login(self.super_user)
+        self.wind = mixer.blend(Variable, variable='ws', long_name='wind speed')
+        self.files = mixer.cycle(3).blend(UC2Observation)
+        for f in self.files:
+            f.variables.add(self.wind)
+
+    def rows(self, **params):
+        with CaptureQueriesContext(connection) as self.queries:
+            resp = self.client.get(reverse('file-list'), params)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        return resp.data
+
+    def row_query(self):
+        return [q['sql'] for q in self.queries.captured_queries if 'FROM "data_uc2observation"' in q['sql']
+                and 'COUNT' not in q['sql'] and 'MAX' not in q['sql']][-1]
+
+    def test_fields(self):
+        rows = self.rows(fields='id,file_standard_name,site,variables')
+        self.assertEqual(set(rows[0]), {'id', 'file_standard_name', 'site', 'variables'})
+        self.assertEqual(rows[0]['variables'], ['ws'])
+        self.assertNotIn('ll_e_utm', self.row_query())
+        self.assertNotIn('"data_license"', self.row_query(), "Omitted relations are not joined")
+
+    def test_omit(self):
+        rows = self.rows(omit='variables,ll_lon,licence')
+        self.assertNotIn('variables', rows[0])
+        self.assertNotIn('ll_lon', rows[0])
+        self.assertIn('ur_lon', rows[0])
+        self.assertFalse([q for q in self.queries.captured_queries if 'data_variable' in q['sql']],
+                         "Omitted variables are not prefetched")
+
+    def test_expand(self):
+        rows = self.rows(expand='variables', fields='id,variables')
+        self.assertEqual(rows[0]['variables'][0]['long_name'], 'wind speed')
+        self.assertEqual(rows[0]['variables'][0]['id'], self.wind.pk)
+
+    def test_all_fields_by_default(self):
+        full = self.rows()[0]
+        self.assertIn('checkerVersionSub', full)
+        self.assertNotIn('search_document', full)
+        self.assertEqual(full['variables'], ['ws'])
+
+
+class TestRowSerializer(MediaRootTestCase):
+    """
+    The values() based list path must render exactly what the serializers render
+    """
+    fixtures = ['groups_and_licenses.json']
+
+    def setUp(self):
+        self.super_user = User.objects.create_superuser(username="TestUser", email="test@user.com", password="test")
+        self.client.force_login(self.super_user)
+        self.institutions = mixer.cycle(3).blend(Institution)
+        self.variables = mixer.cycle(4).blend(Variable, deprecated=False)
+        for i, site in enumerate(mixer.cycle(3).blend(Site, campaign=Site.LTO)):
+            site.institution.add(*self.institutions[:i + 1])
+        self.variables[0].institution.add(*self.institutions)
+        for i, f in enumerate(mixer.cycle(6).blend(UC2Observation, file=mixer.sequence("ab/cd/{0}.nc"))):
+            f.variables.add(*self.variables[i % 3:i % 3 + 2])
+
+    def compare(self, name, params=None):
+        url = reverse(name)
+        fast = self.client.get(url, params)
+        self.assertEqual(fast.status_code, status.HTTP_200_OK)
+        with mock.patch.object(RowSerializer, 'add_field', return_value=False):
+            slow = self.client.get(url, params)
+        self.assertEqual(json.loads(fast.content), json.loads(slow.content))
+        self.assertEqual(fast.content, slow.content, "Same keys in the same order")
+        return json.loads(fast.content)
+
+    def test_files(self):
+        rows = self.compare('file-list')
+        self.assertEqual(len(rows), 6)
+        self.assertTrue(rows[0]['file'].startswith('http'))
+        self.compare('file-list', {'limit': 4, 'offset': 2})
+        self.compare('file-list', {'pagination': 'cursor', 'limit': 4})
+        self.compare('file-list', {'fields': 'id,site,variables,upload_date', 'search': 'a'})
+        self.compare('file-list', {'omit': 'variables,licence'})
+
+    def test_expand_uses_serializer(self):
+        self.assertFalse(RowSerializer(UC2Serializer(context={'request': mock.Mock(
+            query_params={'expand': 'variables'})})).supported)
+        self.compare('file-list', {'expand': 'variables'})
+
+    def test_reference_lists(self):
+        self.assertEqual(len(self.compare('site-list')), Site.objects.count())
+        self.assertEqual(len(self.compare('variable-list')), Variable.objects.filter(deprecated=False).count())
+        self.compare('institution-list')
+        self.compare('institution-list', {'limit': 2})
+
+
+@override_settings(FILE_STREAM_MIN_ROWS=3)
+class TestStreamedList(MediaRootTestCase):
+    fixtures = ['groups_and_licenses.json']
+
+    def setUp(self):
+        cache.clear()
+        self.super_user = User.objects.create_superuser(username="TestUser", email="test@user.com", password="test")
+        self.client.force_login(self.super_user)
+        for i, f in enumerate(mixer.cycle(7).blend(UC2Observation)):
+            f.variables.add(mixer.blend(Variable))
+
+    def get(self, params, stream):
+        resp = self.client.get(reverse('file-list'), params)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.streaming, stream)
+        return json.loads(b"".join(resp.streaming_content) if stream else resp.content)
+
+    def compare(self, params):
+        streamed = self.get(params, stream=True)
+        with override_settings(FILE_STREAM_MIN_ROWS=1000):
+            rendered = self.get(params, stream=False)
+        self.assertEqual(streamed, rendered)
+        return streamed
+
+    def test_offset(self):
+        data = self.compare({'limit': 3, 'offset': 2})
+        self.assertEqual((data['count'], len(data['results'])), (7, 3))
+        self.assertIsNone(self.compare({'limit': 5, 'offset': 5})['next'])
+
+    def test_estimate(self):
+        self.assertTrue(self.compare({'limit': 3, 'count': 'estimate'})['has_next'])
+        self.assertFalse(self.compare({'limit': 4, 'offset': 3, 'count': 'estimate'})['has_next'])
+
+    def test_cursor(self):
+        ids = []
+        data = self.compare({'pagination': 'cursor', 'limit': 3})
+        while True:
+            ids.extend(row['id'] for row in data['results'])
+            if data['next'] is None:
+                break
+            data = self.get(QueryDict(data['next'].split('?')[1]).dict(), stream=True)
+        self.assertEqual(ids, list(UC2Observation.objects.order_by('-upload_date', '-id').values_list('id', flat=True)))
+
+    def test_unpaginated(self):
+        self.assertEqual(self.get({}, stream=False), self.get({'stream': '1'}, stream=True))
+
+    def test_small_pages_rendered(self):
+        self.get({'limit': 2}, stream=False)
+
+
+@override_settings(FILE_LIST_CACHE_TIMEOUT=300)
+class TestSharedListCache(MediaRootTestCase):
+    fixtures = ['groups_and_licenses.json']
+
+    def setUp(self):
+        caches[settings.FILE_LIST_CACHE].clear()
+        self.catalog = Catalog(30)
+        self.colleague = User.objects.create(username="colleague")
+        self.colleague.groups.add(*self.catalog.member.groups.all())
+
+    def get(self, user, query='limit=5', **headers):
+        """
+        :return: the response and the queries of UC2Observations it needed
+        """
+        self.client.force_login(user)
+        with CaptureQueriesContext(connection) as ctx:
+            resp = self.client.get(reverse('file-list') + '?' + query, **headers)
+        return resp, [q for q in ctx.captured_queries if 'data_uc2observation' in q['sql']]
+
+    def test_shared_by_visibility_class(self):
+        resp, queries = self.get(self.catalog.member)
+        self.assertTrue(queries)
+        cached, queries = self.get(self.colleague)
+        self.assertEqual(queries, [])
+        self.assertEqual(cached.data, resp.data)
+
+        resp, queries = self.get(self.catalog.outsider)
+        self.assertTrue(queries, "Other groups see other files")
+        self.assertLess(resp.data['count'], cached.data['count'])
+
+    def test_normalized_query(self):
+        self.get(self.catalog.member, 'limit=5&source=source%201&source=source%202')
+        resp, queries = self.get(self.colleague, 'source=source%202&limit=5&source=source%201')
+        self.assertEqual(queries, [])
+        resp, queries = self.get(self.colleague, 'source=source%202&limit=5')
+        self.assertTrue(queries)
+
+    def test_not_modified(self):
+        resp, queries = self.get(self.catalog.member)
+        resp, queries = self.get(self.colleague, HTTP_IF_NONE_MATCH=resp['ETag'])
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(queries, [])
+
+    def test_invalidated_by_upload(self):
+        count = self.get(self.catalog.member)[0].data['count']
+        mixer.blend(UC2Observation, licence=self.catalog.public)
+        self.assertEqual(self.get(self.colleague)[0].data['count'], count + 1)
+
+    def test_invalidated_by_invalidation(self):
+        resp, queries = self.get(self.catalog.member, 'limit=5&is_invalid=false')
+        observation = UC2Observation.objects.get(pk=resp.data['results'][0]['id'])
+        observation.is_invalid = True
+        observation.save()
+        self.assertEqual(self.get(self.colleague, 'limit=5&is_invalid=false')[0].data['count'], resp.data['count'] - 1)
+
+    def test_invalidated_by_licence_change(self):
+        count = self.get(self.catalog.outsider)[0].data['count']
+        self.catalog.restricted.public = True
+        self.catalog.restricted.save()
+        self.assertEqual(self.get(self.catalog.outsider)[0].data['count'], self.catalog.n)
+        self.assertLess(count, self.catalog.n)
+
+    def test_off_by_default_in_tests(self):
+        with override_settings(FILE_LIST_CACHE_TIMEOUT=0):
+            self.get(self.catalog.member)
+            self.assertTrue(self.get(self.catalog.member)[1])
+
+
+class TestCatalogSnapshot(MediaRootTestCase):
+    fixtures = ['groups_and_licenses.json']
+
+    def setUp(self):
+        cache.clear()
+        self.root = tempfile.TemporaryDirectory()
+        self.settings_override = override_settings(FILE_SNAPSHOT_ROOT=self.root.name)
+        self.settings_override.enable()
+        self.catalog = Catalog(20)
+
+    def tearDown(self):
+        self.settings_override.disable()
+        self.root.cleanup()
+
+    def rendered_list(self):
+        with override_settings(FILE_SNAPSHOT_ROOT=None):
+            resp = self.client.get(reverse('file-list'))
+        self.assertFalse(resp.streaming)
+        return json.loads(resp.content)
+
+    def body(self, resp):
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        content = b"".join(resp.streaming_content)
+        return gzip.decompress(content) if resp.get('Content-Encoding') == 'gzip' else content
+
+    def test_anonymous_list(self):
+        resp = self.client.get(reverse('file-list'))
+        self.assertTrue(resp.streaming, "Served from the snapshot file")
+        self.assertEqual(json.loads(self.body(resp)), self.rendered_list())
+
+        resp = self.client.get(reverse('file-list'), HTTP_IF_NONE_MATCH=resp['ETag'])
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_only_complete_anonymous_list(self):
+        self.assertFalse(self.client.get(reverse('file-list'), {'limit': 5}).streaming)
+        self.client.force_login(self.catalog.member)
+        self.assertFalse(self.client.get(reverse('file-list')).streaming)
+
+    def test_compressed_ndjson(self):
+        resp = self.client.get(reverse('file-snapshot', kwargs={'kind': 'ndjson'}), HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(resp['Content-Encoding'], 'gzip')
+        self.assertEqual(resp['Content-Type'], 'application/x-ndjson')
+        entries = [json.loads(line) for line in self.body(resp).splitlines()]
+        self.assertEqual(entries, self.rendered_list())
+        self.assertEqual(len(entries), UC2Observation.objects.filter(licence__public=True).count())
+
+    def test_incremental(self):
+        url = reverse('file-snapshot', kwargs={'kind': 'json'})
+        self.body(self.client.get(url))
+        changed, deleted = UC2Observation.objects.filter(licence=self.catalog.public).order_by('id')[:2]
+        changed.keywords = 'changed'
+        changed.save()
+        deleted.delete()
+        mixer.blend(UC2Observation, licence=self.catalog.public)
+        mixer.blend(UC2Observation, licence=self.catalog.restricted)
+
+        self.assertEqual(json.loads(self.body(self.client.get(url))), self.rendered_list())
+        with open(os.path.join(self.root.name, 'manifest.json')) as f:
+            self.assertEqual(json.load(f)['rendered'], 2, "Only the changed and the new public entry")
+
+    def test_full_rebuild_on_licence_change(self):
+        url = reverse('file-snapshot', kwargs={'kind': 'json'})
+        count = len(json.loads(self.body(self.client.get(url))))
+        self.catalog.restricted.public = True
+        self.catalog.restricted.save()
+        self.assertEqual(len(json.loads(self.body(self.client.get(url)))), self.catalog.n)
+        self.assertLess(count, self.catalog.n)
+
+    def test_change_committed_during_build(self):
+        url = reverse('file-snapshot', kwargs={'kind': 'json'})
+        self.body(self.client.get(url))
+        changed = UC2Observation.objects.filter(licence=self.catalog.public).order_by('id').first()
+        changed.keywords = 'changed'
+        changed.save()
+        # saved before the previous build started, committed after it
+        with open(os.path.join(self.root.name, 'manifest.json')) as f:
+            started = parse_datetime(json.load(f)['started'])
+        UC2Observation.objects.filter(pk=changed.pk).update(last_modified=started - datetime.timedelta(seconds=1))
+
+        self.assertEqual(json.loads(self.body(self.client.get(url))), self.rendered_list())
+
+    def test_command_takes_rebuild_lock(self):
+        lock = caches[settings.FILE_LIST_CACHE]
+        lock.add(snapshot.REBUILD_LOCK, 1)  # a request started a rebuild
+        self.addCleanup(lock.delete, snapshot.REBUILD_LOCK)
+        with self.assertRaisesMessage(CommandError, "rebuilt by another process"):
+            call_command('snapshot_catalog', '--base-url', 'http://testserver/', stdout=io.StringIO())
+        self.assertIsNone(snapshot.read_manifest())
+
+        lock.delete(snapshot.REBUILD_LOCK)
+        call_command('snapshot_catalog', '--base-url', 'http://testserver/', stdout=io.StringIO())
+        self.assertIsNotNone(snapshot.read_manifest())
+
+    def test_live_while_rebuilding(self):
+        self.body(self.client.get(reverse('file-list')))
+        mixer.blend(UC2Observation, licence=self.catalog.public)
+        lock = caches[settings.FILE_LIST_CACHE]
+        lock.add(snapshot.REBUILD_LOCK, 1)  # another worker rebuilds
+        self.addCleanup(lock.delete, snapshot.REBUILD_LOCK)
+
+        resp = self.client.get(reverse('file-list'))
+        self.assertFalse(resp.streaming, "The outdated snapshot is not served")
+        self.assertEqual(json.loads(resp.content), self.rendered_list())
+        resp = self.client.get(reverse('file-snapshot', kwargs={'kind': 'ndjson'}), HTTP_ACCEPT_ENCODING='gzip')
+        self.assertNotIn('Content-Encoding', resp)
+        self.assertEqual([json.loads(line) for line in self.body(resp).splitlines()], self.rendered_list())
+
+    def test_background_rebuild(self):
+        with override_settings(FILE_SNAPSHOT_BACKGROUND=True), \
+                mock.patch('data.snapshot.threading.Thread') as thread:
+            resp = self.client.get(reverse('file-list'))
+        self.assertFalse(resp.streaming, "Answered before the rebuild")
+        thread.return_value.start.assert_called_once_with()
+        thread.call_args[1]['target']()  # the rebuild, run here to see the test data
+        self.assertTrue(self.client.get(reverse('file-list')).streaming)
+
+
+class TestChangeFeed(MediaRootTestCase):
+    fixtures = ['groups_and_licenses.json']
+
+    def setUp(self):
+        self.catalog = Catalog(6)  # bulk created, not in the feed
+        # the mirror starts after the resets of setting up the licences
+        self.start = FileChange.objects.order_by('-seq').first().seq
+        self.public = [mixer.blend(UC2Observation, licence=self.catalog.public) for i in range(3)]
+        self.restricted = mixer.blend(UC2Observation, licence=self.catalog.restricted)
+
+    def feed(self, **params):
+        params.setdefault('since', self.start)
+        resp = self.client.get(reverse('file-changes'), params)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        return resp.data
+
+    def test_created(self):
+        data = self.feed()
+        self.assertEqual([c['id'] for c in data['changes']], [obj.pk for obj in self.public])
+        self.assertEqual({c['action'] for c in data['changes']}, {FileChange.CREATED})
+        self.assertEqual(data['changes'][0]['entry']['file_standard_name'], self.public[0].file_standard_name)
+        self.assertIsNone(data['next'])
+
+    def test_visibility(self):
+        self.client.force_login(self.catalog.member)
+        self.assertEqual(len(self.feed()['changes']), 4)
+
+    def test_updates_and_deletions_since(self):
+        last_seq = self.feed()['last_seq']
+        self.assertEqual(self.feed(since=last_seq)['changes'], [])
+
+        first, second, third = self.public
+        first.is_invalid = True
+        first.save()
+        first.download_count += 1
+        first.save(update_fields=['download_count', 'last_modified'])
+        second.variables.add(mixer.blend(Variable))
+        third_pk = third.pk
+        third.delete()
+
+        changes = self.feed(since=last_seq)['changes']
+        self.assertEqual([(c['id'], c['action']) for c in changes], [
+            (first.pk, FileChange.UPDATED), (second.pk, FileChange.UPDATED), (third_pk, FileChange.DELETED)
+        ])
+        self.assertEqual(changes[0]['entry']['download_count'], 1)
+        self.assertTrue(changes[0]['entry']['is_invalid'])
+        self.assertEqual(len(changes[1]['entry']['variables']), 1)
+        self.assertIsNone(changes[2]['entry'])
+
+    def test_resumable(self):
+        seen = []
+        data = self.feed(limit=2)
+        while True:
+            seen.extend(c['id'] for c in data['changes'])
+            if data['next'] is None:
+                break
+            data = self.feed(**QueryDict(data['next'].split('?')[1]).dict())
+        self.assertEqual(seen, [obj.pk for obj in self.public])
+
+    def test_counted_downloads_coalesced(self):
+        last_seq = self.feed()['last_seq']
+        first = self.public[0]
+        first.keywords = 'changed'
+        first.save()
+        for i in range(3):
+            first.download_count += 1
+            first.save(update_fields=['download_count', 'last_modified'])
+        changes = self.feed(since=last_seq)['changes']
+        self.assertEqual([(c['id'], c['action']) for c in changes], [(first.pk, FileChange.UPDATED)])
+        self.assertEqual(changes[0]['entry']['download_count'], 3)
+        self.assertEqual(changes[0]['entry']['keywords'], 'changed')
+        self.assertEqual(FileChange.objects.filter(observation_id=first.pk).count(), 2, "Created and one update")
+
+        last_seq = self.feed()['last_seq']
+        first.download_count += 1
+        first.save(update_fields=['download_count', 'last_modified'])
+        changes = self.feed(since=last_seq)['changes']
+        self.assertEqual([c['entry']['download_count'] for c in changes], [4], "Mirrors past the update see it again")
+
+    def test_licence_moves(self):
+        self.client.force_login(self.catalog.outsider)
+        last_seq = FileChange.objects.order_by('-seq').first().seq
+        first = self.public[0]
+        first.licence = self.catalog.restricted
+        first.save()
+        self.assertEqual([(c['id'], c['action']) for c in self.feed(since=last_seq)['changes']],
+                         [(first.pk, FileChange.DELETED)], "Gone for readers of the public licence only")
+
+        self.client.force_login(self.catalog.member)
+        changes = self.feed(since=last_seq)['changes']
+        self.assertEqual([(c['id'], c['action']) for c in changes], [(first.pk, FileChange.CREATED)])
+        self.assertEqual(changes[0]['entry']['id'], first.pk)
+
+    def test_reset_on_licence_groups(self):
+        self.client.force_login(self.catalog.outsider)
+        last_seq = self.feed()['last_seq']
+        self.catalog.restricted.view_groups.add(Group.objects.create(name='newcomers'))
+        changes = self.feed(since=last_seq)['changes']
+        self.assertEqual([(c['id'], c['action'], c['entry']) for c in changes], [(None, FileChange.RESET, None)],
+                         "Seen by readers of any licence")
+
+    def test_pruned(self):
+        last_seq = self.feed()['last_seq']
+        FileChange.objects.filter(seq__lte=last_seq - 1).update(
+            changed=datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=40))
+        call_command('prune_file_changes', '--days', '30', stdout=io.StringIO())
+        resp = self.client.get(reverse('file-changes'), {'since': 0})
+        self.assertEqual(resp.status_code, status.HTTP_410_GONE)
+        self.assertEqual(resp.data['last_seq'], FileChange.objects.order_by('-seq').first().seq)
+        self.assertEqual(len(self.feed(since=last_seq - 1)['changes']), 1, "Retained changes are served")
+
+    def test_invalid_since(self):
+        resp = self.client.get(reverse('file-changes'), {'since': 'x'})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('since', resp.data)
+
+
+class TestExport(MediaRootTestCase):
+    fixtures = ['groups_and_licenses.json']
+
+    def setUp(self):
+        self.catalog = Catalog(30)
+        self.client.force_login(self.catalog.member)
+
+    def export(self, kind, **params):
+        resp = self.client.get(reverse('file-export', kwargs={'kind': kind}), params)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertTrue(resp.streaming)
+        return resp, b"".join(resp.streaming_content)
+
+    def listed(self, **params):
+        return sorted(self.client.get(reverse('file-list'), params).data, key=lambda entry: entry['id'])
+
+    def test_ndjson(self):
+        resp, body = self.export('ndjson', source='source 1')
+        self.assertEqual(resp['Content-Type'], 'application/x-ndjson')
+        entries = [json.loads(line) for line in body.splitlines()]
+        self.assertEqual(entries, json.loads(json.dumps(self.listed(source='source 1'))))
+        self.assertTrue(entries)
+
+    def test_csv(self):
+        resp, body = self.export('csv', fields='id,file_standard_name,variables')
+        rows = list(csv.DictReader(io.StringIO(body.decode())))
+        listed = self.listed()
+        self.assertEqual(len(rows), len(listed))
+        self.assertEqual(rows[0], {'id': str(listed[0]['id']), 'file_standard_name': listed[0]['file_standard_name'],
+                                   'variables': ' '.join(listed[0]['variables'])})
+
+    def test_gzip(self):
+        plain = self.export('csv')[1]
+        resp, body = self.export('csv', compress='gzip')
+        self.assertEqual(resp['Content-Disposition'], 'attachment; filename=catalog.csv.gz')
+        self.assertEqual(gzip.decompress(body), plain)
+
+    def test_any_accept_header(self):
+        resp = self.client.get(reverse('file-export', kwargs={'kind': 'csv'}), HTTP_ACCEPT='text/csv')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+
+    def test_expand_rejected(self):
+        resp = self.client.get(reverse('file-export', kwargs={'kind': 'ndjson'}), {'expand': 'variables'})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class TestBatchLookup(MediaRootTestCase):
+    fixtures = ['groups_and_licenses.json']
+
+    def setUp(self):
+        self.catalog = Catalog(10)
+        self.public = list(UC2Observation.objects.filter(licence=self.catalog.public).order_by('id'))
+        self.restricted = UC2Observation.objects.filter(licence=self.catalog.restricted).first()
+        self.client.force_login(self.catalog.outsider)
+
+    def lookup(self, query='', **body):
+        return self.client.post(reverse('file-lookup') + query, body, format='json')
+
+    def test_ids_and_names(self):
+        first, second, third = self.public[:3]
+        resp = self.lookup(ids=[third.pk, first.pk, 0, self.restricted.pk],
+                           file_standard_names=[second.file_standard_name, first.file_standard_name, 'unknown'])
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual([entry['id'] for entry in resp.data['results']], [third.pk, first.pk, second.pk])
+        self.assertEqual(resp.data['missing'], {'ids': [0, self.restricted.pk], 'file_standard_names': ['unknown']})
+        self.assertNotIn('download_link', resp.data['results'][0])
+
+    def test_chunked(self):
+        ids = [obj.pk for obj in self.public]
+        with override_settings(FILE_LOOKUP_CHUNK_SIZE=2), CaptureQueriesContext(connection) as ctx:
+            resp = self.lookup('?fields=file_standard_name', ids=ids)
+        self.assertEqual(resp.data['results'], [{'file_standard_name': obj.file_standard_name} for obj in self.public])
+        chunks = [q for q in ctx.captured_queries if 'file_standard_name' in q['sql'] and ' IN ' in q['sql']]
+        self.assertEqual(len(chunks), (len(ids) + 1) // 2)
+
+    def test_limits(self):
+        self.assertEqual(self.lookup().status_code, status.HTTP_400_BAD_REQUEST)
+        with override_settings(FILE_LOOKUP_MAX_ITEMS=2):
+            self.assertEqual(self.lookup(ids=[1, 2, 3]).status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_signed_links(self):
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        with override_settings(MEDIA_ROOT=media_root.name):
+            observation = self.public[0]
+            observation.file = content_addressed_storage.save('a.nc', ContentFile(b'payload'))
+            observation.save()
+            link = self.lookup(ids=[observation.pk], links=True).data['results'][0]['download_link']
+
+            self.client.logout()
+            resp = self.client.get(link)
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            self.assertEqual(resp.content, b'payload')
+
+            self.assertEqual(self.client.get(link[:-3] + 'xyz/').status_code, status.HTTP_403_FORBIDDEN)
+            with override_settings(FILE_LINK_MAX_AGE=-1):
+                self.assertEqual(self.client.get(link).status_code, status.HTTP_403_FORBIDDEN)
+
+            observation.file = content_addressed_storage.save('a.nc', ContentFile(b'new payload'))
+            observation.save()
+            self.assertEqual(self.client.get(link).status_code, status.HTTP_404_NOT_FOUND, "Changed content")
+
+            link = self.lookup_link(observation)
+            observation.is_invalid = True
+            observation.save()
+            self.assertEqual(self.client.get(link).status_code, status.HTTP_404_NOT_FOUND, "Invalidated")
+
+            observation.is_invalid = False
+            observation.licence = self.catalog.restricted
+            observation.save()
+            self.assertEqual(self.client.get(link).status_code, status.HTTP_404_NOT_FOUND, "Moved licence")
+
+    def lookup_link(self, observation):
+        self.client.force_login(self.catalog.outsider)
+        link = self.lookup(ids=[observation.pk], links=True).data['results'][0]['download_link']
+        self.client.logout()
+        return link
+
+
+class TestAutocomplete(MediaRootMixin, APITransactionTestCase):
+    """
+    Commits its changes, the index is updated on commit
+    """
+    fixtures = ['groups_and_licenses.json']
+
+    def setUp(self):
+        self.catalog = Catalog(12)
+        # the index of the process may stem from the rolled back data of another test
+        autocomplete.invalidate()
+
+    def suggest(self, q, **params):
+        resp = self.client.get(reverse('file-autocomplete'), dict(params, q=q))
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        return [(item['kind'], item['value']) for item in resp.data]
+
+    def test_prefixes(self):
+        self.assertIn(('site', 'benchsite1'), self.suggest('BenchSite'))
+        self.assertIn(('keyword', 'humidity'), self.suggest('hum'))
+        self.assertIn(('variable', 'bvar1'), self.suggest('variable 1', limit=20),
+                      'Words of a label match on their own')
+        self.assertIn(('institution', 'BENCH1'), self.suggest('bench inst', kind='institution'))
+        self.assertEqual(self.suggest(''), [])
+
+    def test_weighted(self):
+        resp = self.client.get(reverse('file-autocomplete'), {'q': 'b'})
+        weights = [item['weight'] for item in resp.data]
+        self.assertEqual(weights, sorted(weights, reverse=True))
+        self.assertEqual(resp.data[0], {'kind': 'keyword', 'value': 'bench', 'label': 'bench',
+                                        'weight': UC2Observation.objects.filter(
+                                            licence=self.catalog.public, is_old=False, is_invalid=False).count()})
+
+    def test_restricted_keywords_hidden(self):
+        mixer.blend(UC2Observation, licence=self.catalog.restricted, keywords='secret')
+        autocomplete.invalidate()
+        self.assertEqual(self.suggest('secr'), [])
+
+    def test_only_current_files(self):
+        mixer.blend(UC2Observation, licence=self.catalog.public, keywords='withdrawn', is_invalid=True)
+        mixer.blend(UC2Observation, licence=self.catalog.public, keywords='superseded', is_old=True)
+        autocomplete.invalidate()
+        self.assertEqual(self.suggest('withdr') + self.suggest('supers'), [])
+
+        observation = mixer.blend(UC2Observation, licence=self.catalog.public, keywords='glacier', is_old=False,
+                                  is_invalid=False)
+        observation.variables.add(Variable.objects.first())
+        self.assertEqual(self.suggest('glac'), [('keyword', 'glacier')])
+        weight = autocomplete.lookup(Variable.objects.first().variable, 1, ('variable',))[0]['weight']
+        observation.is_invalid = True
+        observation.save()
+        self.assertEqual(self.suggest('glac'), [], "Invalidated files drop out of the index")
+        self.assertEqual(autocomplete.lookup(Variable.objects.first().variable, 1, ('variable',))[0]['weight'],
+                         weight - 1)
+
+    def test_top_ranked_once_per_change(self):
+        from data.autocomplete import PrefixIndex
+        self.suggest('b')
+        with mock.patch.object(PrefixIndex, 'update_top', autospec=True,
+                               side_effect=PrefixIndex.update_top) as update_top:
+            mixer.blend(UC2Observation, licence=self.catalog.public, keywords='alpine snow ice', is_old=False,
+                        is_invalid=False, site=Site.objects.first(), acronym=Institution.objects.first())
+        self.assertEqual(update_top.call_count, 1)
+
+    def test_incremental(self):
+        self.suggest('b')
+        with mock.patch.object(autocomplete, 'build', wraps=autocomplete.build) as build:
+            site = mixer.blend(Site, site='zugspitze')
+            observation = mixer.blend(UC2Observation, site=site, licence=self.catalog.public, keywords='snow')
+            self.assertEqual(self.suggest('zug'), [('site', 'zugspitze')])
+            self.assertEqual(self.suggest('sno'), [('keyword', 'snow')])
+            observation.delete()
+            self.assertEqual(self.suggest('sno'), [])
+            site.delete()
+            self.assertEqual(self.suggest('zug'), [])
+        build.assert_not_called()
+
+    def test_rolled_back(self):
+        self.suggest('b')
+        with self.assertRaises(RuntimeError), transaction.atomic():
+            mixer.blend(UC2Observation, licence=self.catalog.public, keywords='avalanche', is_old=False,
+                        is_invalid=False)
+            self.assertEqual(self.suggest('avala'), [], "Not suggested before the commit")
+            raise RuntimeError
+        self.assertEqual(self.suggest('avala'), [])
+
+        with transaction.atomic():
+            mixer.blend(UC2Observation, licence=self.catalog.public, keywords='avalanche', is_old=False,
+                        is_invalid=False)
+        self.assertEqual(self.suggest('avala'), [('keyword', 'avalanche')])
+
+    def test_params(self):
+        self.assertEqual(len(self.suggest('b', limit=2)), 2)
+        self.assertTrue(all(kind == 'variable' for kind, value in self.suggest('b', kind='variable')))
+        resp = self.client.get(reverse('file-autocomplete'), {'q': 'b', 'kind': 'file'})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
@@ -0,0 +1,95 @@
+import gzip
+import os
+import tempfile
+import zlib
+
+from django.db import transaction
+from django.db.models import Q
+
+try:
+    import zstandard
+except ImportError:  # zstandard is optional, gzip is always available
+    zstandard = None
+
+from .models import StoredBlob, UC2Observation
+from .storage import content_addressed_storage
+
+STREAM_CHUNK_SIZE = 1024 * 1024
+# raised while reading a damaged cold copy
+READ_ERRORS = (OSError, EOFError, zlib.error) + ((zstandard.ZstdError,) if zstandard else ())
+
+
+def default_codec():
+    return StoredBlob.ZSTD if zstandard else StoredBlob.GZIP
+
+
+def _compressor(codec, fileobj):
+    if codec == StoredBlob.ZSTD:
+        if not zstandard:
+            raise ValueError("zstd compression requires the zstandard package")
+        return zstandard.ZstdCompressor().stream_writer(fileobj)
+    return gzip.GzipFile(fileobj=fileobj, mode='wb')
+
+
+def _decompressor(codec, fileobj):
+    if codec == StoredBlob.ZSTD:
+        if not zstandard:
+            raise ValueError("zstd decompression requires the zstandard package")
+        return zstandard.ZstdDecompressor().stream_reader(fileobj)
+    return gzip.GzipFile(fileobj=fileobj, mode='rb')
+
+
+def cold_candidates(older_than):
+    """
+    Hot blobs referenced only by old or invalid observations uploaded before older_than
+    """
+    retired = Q(is_old=True) | Q(is_invalid=True)
+    still_hot = UC2Observation.objects.exclude(retired & Q(upload_date__lt=older_than)).values('file')
+    retired_names = UC2Observation.objects.filter(retired, upload_date__lt=older_than).values('file')
+    return (
+        StoredBlob.objects.filter(tier=StoredBlob.HOT, name__in=retired_names)
+        .exclude(name__in=still_hot)
+    )
+
+
+def move_to_cold(blob, codec=None):
+    """
+    Compress the hot file into the cold directory and remove the hot copy
+    """
+    codec = codec or default_codec()
+    target = blob.cold_path(codec)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(target))
+    try:
+        with os.fdopen(fd, 'wb') as raw, content_addressed_storage.open(blob.name, 'rb') as source:
+            compressor = _compressor(codec, raw)
+            for chunk in iter(lambda: source.read(STREAM_CHUNK_SIZE), b''):
+                compressor.write(chunk)
+            compressor.close()
+        stored_size = os.path.getsize(tmp_path)
+
+        with transaction.atomic():
+            blob = StoredBlob.objects.select_for_update().get(pk=blob.pk)
+            if blob.tier != StoredBlob.HOT:
+                return blob
+            os.replace(tmp_path, target)
+            blob.tier = StoredBlob.COLD
+            blob.codec = codec
+            blob.stored_size = stored_size
+            blob.save(update_fields=['tier', 'codec', 'stored_size'])
+            content_addressed_storage.delete(blob.name)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return blob
+
+
+def open_stream(blob, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    Generator with the decompressed content of a cold blob
+    """
+    with open(blob.cold_path(), 'rb') as raw:
+        reader = _decompressor(blob.codec, raw)
+        for chunk in iter(lambda: reader.read(chunk_size), b''):
+            yield chunk
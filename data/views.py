@@ -1,12 +1,17 @@
 import json
 import pkg_resources
+from collections import OrderedDict
 
 import uc2data
 
-from django.http import HttpResponse
-from django.contrib.auth.models import AnonymousUser
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Max, Prefetch
+from django.http import HttpResponse, StreamingHttpResponse
+from django.utils.http import quote_etag
 
-from rest_framework import filters, status
+from rest_framework import status
+from rest_framework.exceptions import NotFound, ValidationError
 from rest_framework.permissions import IsAuthenticated, IsAdminUser, AllowAny
 from rest_framework.response import Response
 from rest_framework.viewsets import ModelViewSet, GenericViewSet
@@ -16,10 +21,23 @@ from rest_framework.decorators import action
 
 from django_filters import rest_framework as dj_filters
 
-from guardian.shortcuts import assign_perm, get_objects_for_user
-
 
+from . import tiering
+from .autocomplete import KINDS, autocomplete
+from .conditional import ConditionalListMixin, generation_state, not_modified, set_validators, weak_etag
+from .changes import ENTRY_ACTIONS, ChangesPruned, changes_page, feed_response_data, non_negative
+from .export import export_response
+from .facets import cached_facet_counts
 from .filters import UC2Filter
+from .licences import licence_cache
+from .lookup import download_links, linked_file, lookup_files
+from .pagination import KeysetPagination
+from .responsecache import GENERATION_KEYS, SharedListCacheMixin
+from .rows import RowListMixin, RowSerializer
+from .search import FullTextSearchFilter
+from .singleflight import flight_counters
+from .snapshot import live_response, serves_from_snapshot, snapshot_response
+from .visibility import assign_view_permissions, visibility_class, visible_observations
 from .models import *
 from .serializers import *
 
@@ -75,28 +93,20 @@ def to_bool(input):
         raise ValueError
 
 
-class FileView(mixins.ListModelMixin, GenericViewSet):
-    pagination_class = LimitOffsetPagination
+class FileView(SharedListCacheMixin, ConditionalListMixin, RowListMixin, mixins.ListModelMixin, GenericViewSet):
+    pagination_class = KeysetPagination
+    row_lookups = ("upload_date",)
     permission_classes = (ActionBasedPermission,)
-    action_permissions = {IsAuthenticated: ["create", "set_invalid", "destroy"], AllowAny: ["list", "retrieve"]}
+    action_permissions = {
+        IsAuthenticated: ["create", "set_invalid", "destroy"],
+        AllowAny: ["list", "retrieve", "facets", "snapshot", "changes", "export", "lookup", "download",
+                   "autocomplete"],
+        IsAdminUser: ["flights"],
+    }
 
-    filter_backends = (filters.SearchFilter, dj_filters.DjangoFilterBackend)
+    # the searched columns are listed in search.DOCUMENT_FIELDS
+    filter_backends = (FullTextSearchFilter, dj_filters.DjangoFilterBackend)
     filter_class = UC2Filter
-    search_fields = [
-        "site__site",
-        "site__address",
-        "acronym__ge_title",
-        "acronym__en_title",
-        "acronym__acronym",  # institution
-        "variables__variable",
-        "variables__long_name",
-        "variables__standard_name",
-        "file_standard_name",
-        "keywords",
-        "author",
-        "source",
-        "data_content",
-    ]
 
     serializer_class = UC2Serializer
 
@@ -105,15 +115,70 @@ class FileView(mixins.ListModelMixin, GenericViewSet):
         Ensure that only objects with a licence matching the user are returned
         :return:
         """
-        license_perms = License.objects.all().select_related("view_permission")
-        license_set = set()
-        for license_perm in license_perms:
-            perm_string = license_perm.view_permission.codename
-            license_set.add(perm_string)
+        queryset = visible_observations(self.request.user)
+        if self.action in ["list", "set_invalid", "changes", "export", "lookup"]:
+            queryset = self.project(queryset, self.get_serializer())
+        return queryset
+
+    # slug rendered for each relation of UC2Serializer
+    related_slugs = {"site": "site", "acronym": "acronym", "licence": "short_name", "uploader": "username"}
+
+    def project(self, queryset, serializer):
+        """
+        Load everything the serializer renders per row and nothing else, so a page costs the same number of queries
+        for any size and sparse fieldsets (?fields=, ?omit=) read fewer columns
+        """
+        fields = set(serializer.fields)
+        # the pagination cursor needs the position of each row
+        columns = {"id", "upload_date"}
+        related = []
+        for name in fields:
+            if name in self.related_slugs:
+                related.append(name)
+                columns.update([name, "%s__%s" % (name, self.related_slugs[name])])
+            elif name != "variables":
+                columns.add(name)
+        queryset = queryset.select_related(*related).only(*columns)
+
+        if "variables" in serializer.expanded:
+            queryset = queryset.prefetch_related(
+                Prefetch("variables", queryset=Variable.objects.prefetch_related("institution"))
+            )
+        elif "variables" in fields:
+            queryset = queryset.prefetch_related(
+                Prefetch("variables", queryset=Variable.objects.only("id", "variable").order_by("id"))
+            )
+        return queryset
+
+    def perform_content_negotiation(self, request, force=False):
+        # files answer with their own content type whatever the client accepts
+        force = force or self.action in ["snapshot", "export", "download"]
+        return super().perform_content_negotiation(request, force=force)
+
+    def list(self, request, *args, **kwargs):
+        if serves_from_snapshot(request):
+            response = snapshot_response(request, "json")
+            if response is not None:
+                return response
+        return super().list(request, *args, **kwargs)
 
-        # license
-        uc2_entries = get_objects_for_user(self.request.user, license_set, klass=UC2Observation, any_perm=True)
-        return uc2_entries
+    def list_validators(self, request):
+        """
+        A weak ETag from count and newest change of the visible, filtered entries and the generations of the tables
+        deciding visibility and rendering, no row is serialized for this. Last-Modified is the newest change of those
+        generations, it advances with deletions and licence changes, which leave no newer row behind.
+        """
+        if request.query_params.get(self.paginator.count_query_param) == self.paginator.count_estimate:
+            return None, None  # the validators need the exact count this mode avoids
+        queryset = self.filter_queryset(self.get_queryset())
+        stats = queryset.order_by().aggregate(count=Count("id", distinct=True), last_modified=Max("last_modified"))
+        generation, changed = generation_state(GENERATION_KEYS)
+        # callers of one visibility class share cached pages, so they share the validators as well
+        etag = weak_etag(
+            "file", visibility_class(request.user), generation, stats["count"], stats["last_modified"],
+            request.GET.urlencode()
+        )
+        return etag, changed
 
     def check_object_permissions(self, request, obj):
         if self.action in ["set_invalid", "destroy"]:
@@ -257,13 +322,13 @@ class FileView(mixins.ListModelMixin, GenericViewSet):
 
         if "licence" in new_entry:
             try:
-                i_licence = License.objects.get(full_text=new_entry["licence"])
+                i_licence = licence_cache.get(full_text=new_entry["licence"])
                 new_entry["licence"] = i_licence.short_name
             except ObjectDoesNotExist:
                 i_licence = None
                 result.fatal.append("No matching licence found")
         else:
-            i_licence = License.objects.get(short_name="empty")
+            i_licence = licence_cache.get(short_name="empty")
             new_entry["licence"] = i_licence.short_name
 
         # Add coordinates
@@ -327,23 +392,118 @@ class FileView(mixins.ListModelMixin, GenericViewSet):
         if result.has_fatal:
             return Response(data=result.to_dict(), status=status.HTTP_406_NOT_ACCEPTABLE)
 
-        #  toggle old version before saving -> in case of error we don't pollute the db
-        if version > 1:
-            self._toggle_old_entry(standard_name, version)
+        # the reference on the stored file commits with the insert, a failing save rolls both back
+        with transaction.atomic():
+            #  toggle old version before saving -> in case of error we don't pollute the db
+            if version > 1:
+                self._toggle_old_entry(standard_name, version)
 
-        serializer.save()
-        # assign view permissions
-        if i_licence.public:
-            assign_perm(i_licence.view_permission, AnonymousUser(), serializer.instance)
-            default_gr = Group.objects.get(name="users")
-            assign_perm(i_licence.view_permission, default_gr, serializer.instance)
-        else:
-            for gr in i_licence.view_groups.all():
-                assign_perm(i_licence.view_permission, gr, serializer.instance)
+            serializer.save()
+            assign_view_permissions(i_licence, serializer.instance)
 
         result.result = serializer.data
         return Response(result.to_dict(), status=status.HTTP_201_CREATED)
 
+    @action(detail=False)
+    def facets(self, request):
+        """
+        Counts per institution, site, campaign, featureType, data_content, variable and year of creation of the files
+        matching the list filters and search
+        """
+        queryset = self.filter_queryset(self.get_queryset())
+        return Response(cached_facet_counts(queryset, request))
+
+    @action(detail=False, url_path=r"snapshot/(?P<kind>json|ndjson)")
+    def snapshot(self, request, kind):
+        """
+        All public files as JSON list or as one JSON object per line, compressed if the client accepts it
+        """
+        if settings.FILE_SNAPSHOT_ROOT is None:
+            raise NotFound()
+        response = snapshot_response(request, kind)
+        if response is None:
+            response = live_response(request, kind)
+        return response
+
+    @action(detail=False)
+    def changes(self, request):
+        """
+        Creations, updates and deletions after ?since= (a seq, 0 for all) for mirrors of the catalog, oldest first.
+        Follow next until it is null and continue later with ?since=last_seq. After a "reset", or a 410 for pruned
+        changes, list the catalog again. See data/changes.py.
+        """
+        try:
+            changes, last_seq, more = changes_page(request)
+        except ChangesPruned as e:
+            return Response({"detail": e.detail, "last_seq": e.last_seq}, status=status.HTTP_410_GONE)
+        ids = [change["observation_id"] for change in changes if change["action"] in ENTRY_ACTIONS]
+        queryset = self.get_queryset().filter(pk__in=ids)
+        serializer = self.get_serializer()
+        rows = RowSerializer(serializer)
+        # entries by id, ?fields= may leave out the id
+        if rows.supported:
+            values = list(rows.values(queryset))
+            entries = {row["id"]: entry for row, entry in zip(values, rows.render(values))}
+        else:
+            observations = list(queryset)
+            data = self.get_serializer(observations, many=True).data
+            entries = {obj.pk: entry for obj, entry in zip(observations, data)}
+        return Response(feed_response_data(request, changes, last_seq, more, entries))
+
+    @action(detail=False, url_path=r"export/(?P<kind>ndjson|csv)")
+    def export(self, request, kind):
+        """
+        All visible files matching the list filters and search, one per line as NDJSON or CSV, streamed in chunks
+        from a server side cursor. ?compress=gzip compresses the stream.
+        """
+        rows = RowSerializer(self.get_serializer())
+        if not rows.supported:
+            raise ValidationError({"expand": ["Expanded relations can not be exported"]})
+        queryset = rows.values(self.filter_queryset(self.get_queryset()).order_by("id"))
+        return export_response(rows, queryset, kind, compress=request.query_params.get("compress") == "gzip")
+
+    @action(detail=False, methods=["post"])
+    def lookup(self, request):
+        """
+        Entries of up to FILE_LOOKUP_MAX_ITEMS files by "ids" and "file_standard_names", with signed download links
+        if "links" is true. Ids and names not found or not visible are listed in "missing".
+        """
+        params = FileLookupSerializer(data=request.data)
+        params.is_valid(raise_exception=True)
+        rows = RowSerializer(self.get_serializer())
+        if not rows.supported:
+            raise ValidationError({"expand": ["Expanded relations can not be looked up"]})
+        results, missing = lookup_files(
+            rows, self.get_queryset(), params.validated_data["ids"], params.validated_data["file_standard_names"]
+        )
+        if params.validated_data["links"]:
+            links = download_links(request, results)
+            for pk, entry in results.items():
+                entry["download_link"] = links[pk]
+        return Response(OrderedDict([("results", list(results.values())), ("missing", missing)]))
+
+    @action(detail=False)
+    def autocomplete(self, request):
+        """
+        Site names, institutions, variables and keywords starting with ?q=, the most used first. ?kind= limits them to
+        a comma separated list of kinds, ?limit= to a number of suggestions.
+        """
+        prefix = request.query_params.get("q", "")
+        limit = min(non_negative(request, "limit", 10), settings.FILE_AUTOCOMPLETE_MAX_LIMIT) or 10
+        kinds = request.query_params.get("kind")
+        kinds = tuple(kinds.split(",")) if kinds else KINDS
+        if set(kinds) - set(KINDS):
+            raise ValidationError({"kind": ["Choose from %s" % ", ".join(KINDS)]})
+        return Response(autocomplete.lookup(prefix, limit, kinds))
+
+    @action(detail=False)
+    def flights(self, request):
+        """
+        How often the expensive reads were computed and how often concurrent identical requests waited for another
+        request's result instead
+        """
+        return Response(flight_counters())
+
     @action(detail=True, methods=["patch"])
     def set_invalid(self, request, pk=None):
         entry = self.get_object()
@@ -359,13 +519,37 @@ class FileView(mixins.ListModelMixin, GenericViewSet):
             return Response(result.to_dict(), status=status.HTTP_400_BAD_REQUEST)
 
     def retrieve(self, request, pk=None):
-        obj = self.get_object()
-        response = HttpResponse(obj.file, content_type="multipart/form", status=status.HTTP_200_OK)
+        return self.download_response(request, self.get_object())
+
+    @action(detail=False, url_path=r"download/(?P<token>[^/]+)")
+    def download(self, request, token):
+        """
+        A file through a signed link of lookup, without credentials until the link expires
+        """
+        return self.download_response(request, linked_file(token))
+
+    def download_response(self, request, obj):
+        blob = StoredBlob.objects.filter(name=obj.file.name).first()
+        # the content hash is a strong validator, an unchanged file is answered without touching the disk
+        etag = quote_etag(blob.checksum) if blob else None
+        response = not_modified(request, etag=etag, last_modified=obj.upload_date)
+        if response is not None:
+            return response
+
+        if blob and blob.tier == StoredBlob.COLD:
+            # retired files are decompressed on the fly
+            response = StreamingHttpResponse(
+                tiering.open_stream(blob), content_type="multipart/form", status=status.HTTP_200_OK
+            )
+            response["Content-Length"] = blob.size
+        else:
+            response = HttpResponse(obj.file, content_type="multipart/form", status=status.HTTP_200_OK)
+            response["Content-Length"] = obj.file.size
         response["Content-Disposition"] = "attachment; filename=%s" % str(obj.file_standard_name)
-        response["Content-Length"] = obj.file.size
+        set_validators(response, etag=etag, last_modified=obj.upload_date)
         # change download_count of object
         obj.download_count += 1
-        obj.save()
+        obj.save(update_fields=["download_count", "last_modified"])
         return response
 
     def destroy(self, request, pk=None):
@@ -410,7 +594,8 @@ class FileView(mixins.ListModelMixin, GenericViewSet):
         return True
 
 
-class LicenseView(ModelViewSet):
+class LicenseView(ConditionalListMixin, ModelViewSet):
+    generation_key = "license"
     serializer_class = LicenceSerializer
     queryset = License.objects.all()
     permission_classes = (ActionBasedPermission,)
@@ -420,7 +605,7 @@ class LicenseView(ModelViewSet):
     }
 
 
-class CsvViewSet(mixins.CreateModelMixin, mixins.ListModelMixin, GenericViewSet):
+class CsvViewSet(ConditionalListMixin, RowListMixin, mixins.CreateModelMixin, mixins.ListModelMixin, GenericViewSet):
     """
     A class representing data read from a CSV file
     """
@@ -440,17 +625,19 @@ class CsvViewSet(mixins.CreateModelMixin, mixins.ListModelMixin, GenericViewSet)
 
 
 class InstitutionView(CsvViewSet):
+    generation_key = "institution"
     pagination_class = LimitOffsetPagination
     serializer_class = InstitutionSerializer
     queryset = Institution.objects.all()
 
 
 class SiteView(CsvViewSet):
+    generation_key = "site"
     serializer_class = SiteSerializer
     queryset = Site.objects.all()
 
 
 class VariableView(CsvViewSet):
-
+    generation_key = "variable"
     serializer_class = VariableCsvSerializer
     queryset = Variable.objects.filter(deprecated=False)
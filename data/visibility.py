@@ -0,0 +1,96 @@
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser, Group
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.db.models import Q
+
+from guardian.shortcuts import assign_perm, get_objects_for_user
+
+from .licences import licence_cache
+from .models import LicenceVisibility, License, UC2Observation
+
+INDEX = "index"
+GUARDIAN = "guardian"
+
+
+def assign_view_permissions(licence, obj):
+    """
+    Grant the view permission of the licence on a new upload with guardian
+    :param licence: a LicenceInfo from the licence cache
+    """
+    if licence.public:
+        assign_perm(licence.view_permission, AnonymousUser(), obj)
+        default_gr = Group.objects.get(name="users")
+        assign_perm(licence.view_permission, default_gr, obj)
+    else:
+        for gr in licence.view_groups:
+            assign_perm(licence.view_permission, gr, obj)
+
+
+def rebuild_visibility_index(using=DEFAULT_DB_ALIAS):
+    """
+    Recompute the visibility rows of every licence, the signals only cover licences changed later on
+    :return: the number of licences
+    """
+    licences = list(License.objects.using(using).all())
+    with transaction.atomic(using=using):
+        for licence in licences:
+            LicenceVisibility.rebuild(licence)
+    return len(licences)
+
+
+def install_visibility_index(using=DEFAULT_DB_ALIAS, **kwargs):
+    """
+    post_migrate receiver filling the visibility index for the licences that exist already
+    """
+    rebuild_visibility_index(using)
+
+
+def visible_licences(user):
+    """
+    :return: queryset of the licence ids the user may see or None for superusers, who see everything
+    """
+    if user.is_superuser:
+        return None
+    if user.is_anonymous:
+        condition = Q(anonymous=True)
+    else:
+        condition = Q(group__in=user.groups.all())
+    return LicenceVisibility.objects.filter(condition).values('licence')
+
+
+def index_observations(user):
+    licences = visible_licences(user)
+    if licences is None:
+        return UC2Observation.objects.all()
+    return UC2Observation.objects.filter(licence__in=licences)
+
+
+def guardian_observations(user):
+    """
+    The object permissions assigned with guardian on upload. Kept as reference for the visibility index.
+    """
+    return get_objects_for_user(user, licence_cache.view_codenames(), klass=UC2Observation, any_perm=True)
+
+
+def visibility_class(user):
+    """
+    Users of the same class see the same files, a key to share cached results between them
+    """
+    if user.is_superuser:
+        return "all"
+    if user.is_anonymous:
+        return "anonymous"
+    if getattr(settings, "FILE_VISIBILITY", INDEX) == GUARDIAN:
+        return "user:%s" % user.pk
+    groups = LicenceVisibility.objects.filter(group__in=user.groups.all()).order_by('group').values_list(
+        'group', flat=True).distinct()
+    return "groups:" + ",".join(str(pk) for pk in groups)
+
+
+def visible_observations(user):
+    """
+    All UC2Observations the user is allowed to see and download
+    """
+    if getattr(settings, "FILE_VISIBILITY", INDEX) == GUARDIAN:
+        return guardian_observations(user)
+    return index_observations(user)
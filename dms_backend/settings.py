@@ -32,6 +32,7 @@ if 'DEBUG' in os.environ and bool(int(os.environ.get('DEBUG'))):
     EMAIL_BACKEND = 'django.core.mail.backends.filebased.EmailBackend'
     EMAIL_FILE_PATH = os.path.join(BASE_DIR, "files", 'mails')
     MEDIA_ROOT = os.path.join(BASE_DIR, "files")
+    COLD_STORAGE_ROOT = os.path.join(BASE_DIR, "files_cold")
     STATIC_URL = "/static/"
 else:
     DEBUG = False
@@ -41,6 +42,9 @@ else:
     STATIC_URL = "/"
     STATIC_ROOT = os.environ.get('DMS_STATIC_ROOT')
     MEDIA_ROOT = os.environ.get('DMS_MEDIA_ROOT')
+    # retired file versions compressed by tier_files, next to the media directory unless set
+    COLD_STORAGE_ROOT = os.environ.get('DMS_COLD_STORAGE_ROOT') or (
+        os.path.normpath(MEDIA_ROOT) + "_cold" if MEDIA_ROOT else None)
 
     # Database setup
     DATABASES = {
@@ -207,3 +211,58 @@ FILE_UPLOAD_HANDLERS = [
 
 # FILE Folder
 MEDIA_URL = "/files/"
+
+# which files a user may see: "index" uses the licence / group table LicenceVisibility,
+# "guardian" the object permissions assigned on upload (slow, kept for comparison)
+FILE_VISIBILITY = "index"
+
+# seconds a total count of FileView.list with ?count=estimate is cached, uploads and deletions reset it earlier
+FILE_COUNT_TIMEOUT = 60
+# on PostgreSQL results the planner estimates above this size are not counted exactly with ?count=estimate
+FILE_COUNT_ESTIMATE_THRESHOLD = 100000
+# seconds the facet counts of a filter are cached, uploads and deletions reset them earlier
+FILE_FACETS_TIMEOUT = 300
+# JSON lists with at least this limit are streamed row by row instead of rendered in memory
+FILE_STREAM_MIN_ROWS = 5000
+
+# cache of FileView.list pages shared by the callers who see the same files, see data/responsecache.py, and of the
+# counts and facets of file lists. Each process
+# has its own copy by default, DMS_LIST_CACHE set to a directory shares a file based cache between the workers of a
+# host, set to a redis:// URL (needs django-redis) between all hosts
+FILE_LIST_CACHE = "file-lists"
+_list_cache = os.getenv("DMS_LIST_CACHE", "")
+if _list_cache.startswith("redis://"):
+    _list_cache_backend = {"BACKEND": "django_redis.cache.RedisCache", "LOCATION": _list_cache}
+elif _list_cache:
+    _list_cache_backend = {"BACKEND": "django.core.cache.backends.filebased.FileBasedCache", "LOCATION": _list_cache}
+else:
+    _list_cache_backend = {"BACKEND": "django.core.cache.backends.locmem.LocMemCache", "LOCATION": FILE_LIST_CACHE}
+CACHES = {
+    "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+    FILE_LIST_CACHE: _list_cache_backend,
+}
+# seconds a cached page lives, uploads, invalidations, deletions and licence changes start new pages earlier, 0 turns
+# the cache off
+FILE_LIST_CACHE_TIMEOUT = 300
+# longest seconds concurrent identical requests wait for the one computing their result, see data/singleflight.py,
+# and seconds between looks into the cache while another worker computes
+SINGLE_FLIGHT_WAIT = 30
+SINGLE_FLIGHT_POLL = 0.05
+# directory of the public catalog snapshot, see data/snapshot.py, None turns it off. Below MEDIA_ROOT it can be
+# served by nginx as well
+FILE_SNAPSHOT_ROOT = os.path.join(MEDIA_ROOT, "snapshot") if MEDIA_ROOT else None
+# rebuild an outdated snapshot in a background thread of the request noticing it, else within that request
+FILE_SNAPSHOT_BACKGROUND = True
+# links in the snapshot start with this URL, by default with the one of the request triggering a rebuild
+FILE_SNAPSHOT_BASE_URL = os.getenv("DMS_BASE_URL")
+# days of changes kept in the change feed by ./manage.py prune_file_changes, see data/changes.py
+FILE_CHANGES_RETENTION = 30
+# most ids and names of one batch lookup, and values per IN query resolving them
+FILE_LOOKUP_MAX_ITEMS = 5000
+FILE_LOOKUP_CHUNK_SIZE = 500
+# seconds a signed download link of a batch lookup is valid
+FILE_LINK_MAX_AGE = 3600
+# seconds between checks whether other workers changed the sites, institutions, variables or files of the
+# autocompletion, see data/autocomplete.py, and most suggestions of one request
+FILE_AUTOCOMPLETE_CHECK_INTERVAL = 60
+FILE_AUTOCOMPLETE_MAX_LIMIT = 50
@@ -8,3 +8,10 @@ DATABASES = {
 }
 
 EMAIL_BACKEND = 'django.core.mail.backends.locmem.EmailBackend'
+
+# pages would outlive the rolled back test data, tests turn the shared list cache on explicitly
+FILE_LIST_CACHE_TIMEOUT = 0
+# tests write snapshots to temporary directories
+FILE_SNAPSHOT_ROOT = None
+# a rebuild thread would not see the data of the test transaction
+FILE_SNAPSHOT_BACKGROUND = False